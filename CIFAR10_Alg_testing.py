@@ -207,6 +207,6 @@ OutlierDetection(result_cifar10_train_last_layer, result_cifar10_train_hidden,
                  result_cifar10_test_last_layer, result_cifar10_test_hidden, x_cifar10_test_label,
                  abnormal_datasets_name, abnormal_datasets,
                  sample_size=10000, r_seed=0, n_estimators=1000, verbose=0,
-                 max_samples=10000, contamination=0.01)
+                 max_samples=10000, contamination=0.01, flat_scorer=True)
 
 
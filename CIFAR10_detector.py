@@ -15,6 +15,10 @@ from sklearn.metrics import f1_score
 from sklearn.ensemble import IsolationForest
 from sklearn.manifold import TSNE
 
+from Utils.Detectors import fit_detector, load_detectors, save_detectors
+from Utils.DetectorStore import DetectorStore
+from Utils.ScoreFusion import ScoreFusion
+
 from models import *
 # from models.dla_20_10 import DLA_20_10
 import matplotlib.pyplot as plt
@@ -229,9 +233,15 @@ outlier_detector_l2 = IsolationForest(random_state=r_seed, n_estimators=1000, ve
 
 result_cifar10_train = result_cifar10_train.cpu().numpy()
 result_cifar10_train_base = result_cifar10_train_base.cpu().numpy()
-# data argument
-outlier_detector_l1.fit(result_cifar10_train)
-outlier_detector_l2.fit(result_cifar10_train_base)
+# data argument: reuse the stored detectors while ckpt.pth is unchanged
+detector_store = DetectorStore('./checkpoint/detectors', checkpoint_path='./checkpoint/ckpt.pth')
+detector_hyperparams = dict(r_seed=r_seed, n_estimators=1000, max_samples=10000, flat_scorer=True)
+fitted_detectors = load_detectors(detector_store, ['hidden', 'last_layer'], 0.01, **detector_hyperparams)
+if fitted_detectors is None:
+    fitted_detectors = [fit_detector(outlier_detector_l1, result_cifar10_train, contamination=0.01),
+                        fit_detector(outlier_detector_l2, result_cifar10_train_base, contamination=0.01)]
+    save_detectors(detector_store, ['hidden', 'last_layer'], fitted_detectors, **detector_hyperparams)
+(outlier_detector_l1, train_score_hidden), (outlier_detector_l2, train_score_last_layer) = fitted_detectors
 
 
 
@@ -257,65 +267,33 @@ result_LSUN_resize_test_base = result_LSUN_resize_test_base.cpu().numpy()
 
 
 
-# **************** outlier predict **************** #
+# **************** outlier predict: two layer vote (Utils.ScoreFusion) **************** #
 print('outlier predict')
-outlier_cifar10_train = outlier_detector_l1.predict(result_cifar10_train)
-outlier_cifar10_train += outlier_detector_l2.predict(result_cifar10_train_base)
-
-outlier_cifar10_test = outlier_detector_l1.predict(result_cifar10_test)
-outlier_cifar10_test += outlier_detector_l2.predict(result_cifar10_test_base)
-
-outlier_Imagenet_crop = outlier_detector_l1.predict(result_Imagenet_crop_test)
-outlier_Imagenet_crop += outlier_detector_l2.predict(result_Imagenet_crop_test_base)
-
-outlier_Imagenet_resize = outlier_detector_l1.predict(result_Imagenet_resize_test)
-outlier_Imagenet_resize += outlier_detector_l2.predict(result_Imagenet_resize_test_base)
-
-outlier_LSUN_crop = outlier_detector_l1.predict(result_LSUN_crop_test)
-outlier_LSUN_crop += outlier_detector_l2.predict(result_LSUN_crop_test_base)
-
-outlier_LSUN_resize = outlier_detector_l1.predict(result_LSUN_resize_test)
-outlier_LSUN_resize += outlier_detector_l2.predict(result_LSUN_resize_test_base)
-
-# outlier_iSUN = outlier_detector_l1.predict(result_iSUN_test)
-# outlier_iSUN += outlier_detector_l2.predict(result_iSUN_test_base)
-
-
-# **************** outlier predict final two layer detection **************** #
-outlier_cifar10_train[outlier_cifar10_train <= 1] = -1
-outlier_cifar10_train[outlier_cifar10_train > 1] = 0
-outlier_cifar10_train[outlier_cifar10_train == 0] = \
-    result_cifar10_train_base.argmax(axis=1)[outlier_cifar10_train == 0]
+fusion_engine = ScoreFusion([outlier_detector_l1, outlier_detector_l2], fusion='vote', contamination=0.01)
+train_scores = np.stack([train_score_hidden, train_score_last_layer])
+fusion_engine.fit(train_scores)
+outlier_cifar10_train = fusion_engine.open_set_labels(train_scores, result_cifar10_train_base)
 
-outlier_cifar10_test[outlier_cifar10_test <= 1] = -1
-outlier_cifar10_test[outlier_cifar10_test > 1] = 0
-outlier_cifar10_test[outlier_cifar10_test == 0] = \
-    result_cifar10_test_base.argmax(axis=1)[outlier_cifar10_test == 0]
+outlier_cifar10_test = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_cifar10_test, result_cifar10_test_base]), result_cifar10_test_base)
 
-outlier_Imagenet_crop[outlier_Imagenet_crop <= 1] = -1
-outlier_Imagenet_crop[outlier_Imagenet_crop > 1] = 0
-outlier_Imagenet_crop[outlier_Imagenet_crop == 0] = \
-    result_Imagenet_crop_test_base.argmax(axis=1)[outlier_Imagenet_crop == 0]
+outlier_Imagenet_crop = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_Imagenet_crop_test, result_Imagenet_crop_test_base]),
+    result_Imagenet_crop_test_base)
 
-outlier_Imagenet_resize[outlier_Imagenet_resize <= 1] = -1
-outlier_Imagenet_resize[outlier_Imagenet_resize > 1] = 0
-outlier_Imagenet_resize[outlier_Imagenet_resize == 0] = \
-    result_Imagenet_resize_test_base.argmax(axis=1)[outlier_Imagenet_resize == 0]
+outlier_Imagenet_resize = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_Imagenet_resize_test, result_Imagenet_resize_test_base]),
+    result_Imagenet_resize_test_base)
 
-outlier_LSUN_crop[outlier_LSUN_crop <= 1] = -1
-outlier_LSUN_crop[outlier_LSUN_crop > 1] = 0
-outlier_LSUN_crop[outlier_LSUN_crop == 0] = \
-    result_LSUN_crop_test_base.argmax(axis=1)[outlier_LSUN_crop == 0]
+outlier_LSUN_crop = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_LSUN_crop_test, result_LSUN_crop_test_base]), result_LSUN_crop_test_base)
 
-outlier_LSUN_resize[outlier_LSUN_resize <= 1] = -1
-outlier_LSUN_resize[outlier_LSUN_resize > 1] = 0
-outlier_LSUN_resize[outlier_LSUN_resize == 0] = \
-    result_LSUN_resize_test_base.argmax(axis=1)[outlier_LSUN_resize == 0]
+outlier_LSUN_resize = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_LSUN_resize_test, result_LSUN_resize_test_base]),
+    result_LSUN_resize_test_base)
 
-# outlier_iSUN[outlier_iSUN <= 1] = -1
-# outlier_iSUN[outlier_iSUN > 1] = 0
-# outlier_iSUN[outlier_iSUN == 0] = \
-#     result_iSUN_test_base.argmax(axis=1)[outlier_iSUN == 0]
+# outlier_iSUN = fusion_engine.open_set_labels(
+#     fusion_engine.layer_scores([result_iSUN_test, result_iSUN_test_base]), result_iSUN_test_base)
 
 
 
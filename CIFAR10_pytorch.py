@@ -17,6 +17,7 @@ import numpy as np
 # import pandas as pd
 # from sklearn.metrics import f1_score
 from sklearn.ensemble import IsolationForest
+from Utils.ScoreFusion import ScoreFusion
 # from keras import backend as K
 
 from models import *
@@ -199,26 +200,15 @@ result_Imagenet_crop_test_base = result_Imagenet_crop_test_base.cpu().numpy()
 
 
 
-# **************** outlier predict **************** #
-outlier_cifar10_train = outlier_detector_l1.predict(result_cifar10_train)
-outlier_cifar10_train += outlier_detector_l2.predict(result_cifar10_train_base)
+# **************** outlier predict: two layer vote (Utils.ScoreFusion) **************** #
+fusion_engine = ScoreFusion([outlier_detector_l1, outlier_detector_l2], fusion='vote', contamination=0.05)
+train_scores = fusion_engine.layer_scores([result_cifar10_train, result_cifar10_train_base])
+fusion_engine.fit(train_scores)
+outlier_cifar10_train = fusion_engine.open_set_labels(train_scores, result_cifar10_train_base)
 
-outlier_Imagenet_crop = outlier_detector_l1.predict(result_Imagenet_crop_test)
-outlier_Imagenet_crop += outlier_detector_l2.predict(result_Imagenet_crop_test_base)
-
-
-
-
-# **************** outlier predict final **************** #
-outlier_cifar10_train[outlier_cifar10_train <= 1] = -1
-outlier_cifar10_train[outlier_cifar10_train > 1] = 0
-outlier_cifar10_train[outlier_cifar10_train == 0] = \
-    result_cifar10_train_base.argmax(axis=1)[outlier_cifar10_train == 0]
-
-outlier_Imagenet_crop[outlier_Imagenet_crop <= 1] = -1
-outlier_Imagenet_crop[outlier_Imagenet_crop > 1] = 0
-outlier_Imagenet_crop[outlier_Imagenet_crop == 0] = \
-    result_Imagenet_crop_test_base.argmax(axis=1)[outlier_Imagenet_crop == 0]
+outlier_Imagenet_crop = fusion_engine.open_set_labels(
+    fusion_engine.layer_scores([result_Imagenet_crop_test, result_Imagenet_crop_test_base]),
+    result_Imagenet_crop_test_base)
 
 
 
@@ -10,7 +10,10 @@ import argparse
 import numpy as np
 
 from models.dla_part import DLA6
-from Utils.AUROC_Score import AUROC_score
+from Utils.AUROC_Score import AUROC_score, AUROC_score_sweep
+from Utils.DetectorStore import DetectorStore
+from Utils.GramDetector import GramDetector
+from Utils.LogitScore import extract_embeddings, logit_score_auroc
 from Utils.MyDataLoader import subDataset
 import torch.utils.data.dataloader as DataLoader
 
@@ -150,9 +153,11 @@ if args.resume:
 CIFAR10_train_data = torch.FloatTensor(CIFAR10_train_data)
 outlier_data = torch.FloatTensor(outlier_data)
 
-with torch.no_grad():
-    result_cifar10_train_last_layer, result_cifar10_train_hidden = net(CIFAR10_train_data.to(device))
-    result_cifar10_outlier_last_layer, result_cifar10_outlier_hidden = net(outlier_data.to(device))
+# logit scores (MSP / energy / max-logit) are computed batch by batch during extraction
+(result_cifar10_train_last_layer, result_cifar10_train_hidden), cifar10_train_logit_scores = \
+    extract_embeddings(net, CIFAR10_train_data, device=device)
+(result_cifar10_outlier_last_layer, result_cifar10_outlier_hidden), cifar10_outlier_logit_scores = \
+    extract_embeddings(net, outlier_data, device=device)
 
 # ******************************************************************* #
 #                    Calculating AUROC_score
@@ -160,6 +165,24 @@ with torch.no_grad():
 num_train_sample = CIFAR10_train_data.shape[0]
 num_test_sample = outlier_data.shape[0]
 
+print('===> Logit score baseline')
+logit_score_auroc(cifar10_train_logit_scores, cifar10_outlier_logit_scores)
+
+# gram_detector: Gram-matrix statistics of the DLA Tree levels (Utils.GramDetector), fitted on the
+# training images, reused while ckpt6.pth is unchanged, scored on the test and outlier images
+gram_detector = False
+if gram_detector:
+    print('===> Gram detector')
+    gram_net = net.module if device == 'cuda' else net
+    gram_store = DetectorStore('./checkpoint/detectors', checkpoint_path='./checkpoint/ckpt6.pth')
+    gram_key = gram_store.key('gram', detector='gram', dataset='CIFAR+10', r_seed=r_seed, fit_contamination=0.01)
+    gram, _ = gram_store.load(gram_key)
+    if gram is None:
+        gram = GramDetector(contamination=0.01, device=device, r_seed=r_seed).fit(gram_net, CIFAR10_train_data)
+        gram_store.save(gram_key, gram)
+    logit_score_auroc({'gram': gram.score_samples(gram_net, torch.FloatTensor(CIFAR10_test_data))},
+                      {'gram': gram.score_samples(gram_net, outlier_data)})
+
 print('===> AUROC_score start')
 # ******************* Outlier Detection ********************** #
 # def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
@@ -167,10 +190,17 @@ print('===> AUROC_score start')
 #                 r_seed=0, n_estimators=1000, verbose=0,
 #                 max_samples=10000, contamination=0.01):
 
-# for i in range(2,11,1):
-AUROC_score(F.softmax(result_cifar10_train_last_layer), result_cifar10_train_hidden, num_train_sample,
-            F.softmax(result_cifar10_outlier_last_layer), result_cifar10_outlier_hidden, num_test_sample,
-            r_seed=0, n_estimators=1000, verbose=0, max_samples=1.0, contamination=0.01*4)
+# contamination_sweep: fit both forests once and re-threshold the cached scores for 2..10%
+contamination_sweep = False
+if contamination_sweep:
+    AUROC_score_sweep(F.softmax(result_cifar10_train_last_layer), result_cifar10_train_hidden, num_train_sample,
+                      F.softmax(result_cifar10_outlier_last_layer), result_cifar10_outlier_hidden, num_test_sample,
+                      contaminations=[0.01*i for i in range(2,11,1)],
+                      r_seed=0, n_estimators=1000, verbose=0, max_samples=1.0, flat_scorer=True)
+else:
+    AUROC_score(F.softmax(result_cifar10_train_last_layer), result_cifar10_train_hidden, num_train_sample,
+                F.softmax(result_cifar10_outlier_last_layer), result_cifar10_outlier_hidden, num_test_sample,
+                r_seed=0, n_estimators=1000, verbose=0, max_samples=1.0, contamination=0.01*4, flat_scorer=True)
 
 print('Algorithm End')
 
@@ -12,6 +12,7 @@ import numpy as np
 
 from models.dla_part import DLA6
 from Utils.AUROC_Score_single import AUROC_score
+from Utils.DetectorStore import DetectorStore
 from Utils.MyDataLoader import subDataset
 import torch.utils.data.dataloader as DataLoader
 
@@ -163,10 +164,16 @@ print('===> AUROC_score start')
 #                 r_seed=0, n_estimators=1000, verbose=0,
 #                 max_samples=10000, contamination=0.01):
 
+# adaptive_forest: 'iforest_adaptive' stops adding trees (at most n_estimators) once the held-out score ranking is stable
+adaptive_forest = False
+# fitted detectors are reused while ckpt6.pth and the 6/4 class split are unchanged
+detector_store = DetectorStore('./checkpoint/detectors', checkpoint_path='./checkpoint/ckpt6.pth',
+                               split=selected_class)
 for i in range(2,11,1):
     AUROC_score(result_cifar10_train_last_layer, result_cifar10_train_hidden, num_train_sample,
                 result_cifar10_outlier_last_layer, result_cifar10_outlier_hidden, num_test_sample,
-                r_seed=0, n_estimators=1000, verbose=0, max_samples=1.0, contamination=0.01*i)
+                r_seed=0, n_estimators=1000, verbose=0, max_samples=1.0, contamination=0.01*i,
+                detector_store=detector_store, detector='iforest_adaptive' if adaptive_forest else 'iforest')
 
 print('Algorithm End')
 
@@ -6,10 +6,23 @@ import torch.nn.functional as F
 from sklearn.metrics import roc_auc_score
 from sklearn.ensemble import IsolationForest
 
+from Utils.ClassConditional import ClassConditionalDetector
+from Utils.Coreset import select_coreset
+from Utils.Detectors import LOGIT_DETECTORS, build_detector, decision_scores, fit_detector, score_to_predict, \
+    load_detectors, place_offset, save_detectors
+from Utils.IncrementalForest import fit_incremental
+from Utils.Projection import apply_projections, fit_projections
+from Utils.ScoreFusion import ScoreFusion
+from Utils.ParallelFit import BLOCK_SIZE
+from Utils.ShardedForest import fit_forests_sharded
+
 
 def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
                 test_data_last_layer, test_data_hidden, num_test_sample,
-                r_seed=0, n_estimators=1000, verbose=0, max_samples=10000, contamination=0.01):
+                r_seed=0, n_estimators=1000, verbose=0, max_samples=10000, contamination=0.01,
+                flat_scorer=True, n_jobs=None, detector_store=None, detector='iforest', fusion='vote',
+                projection=None, coreset=None, coreset_method='kcenter', class_conditional=False,
+                incremental=False, shard_size=None):
     """
     The AUROC score Function
     =======================
@@ -17,47 +30,126 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
         train_data      [tensor]: embeded training dataset
         test_data       [tensor]: embeded testing dataset
         num_data_sample         : label of testing dataset
+        detector                : detector name, see Utils.Detectors.build_detector
+        fusion                  : layer score fusion, see Utils.ScoreFusion
+        projection      [dict]  : per-layer reduction before the detector,
+                                  e.g. {'hidden': ('pca', 64)}, see Utils.Projection
+        coreset                 : fit the detectors on a coreset of this many
+                                  training samples (fraction if < 1), see Utils.Coreset
+        coreset_method          : 'kcenter' or 'stratified'
+        class_conditional       : one detector per predicted class, fitted in
+                                  parallel (n_jobs), see Utils.ClassConditional
+        incremental             : keep the forests in detector_store and only fit
+                                  new trees for training rows appended since the
+                                  last call, see Utils.IncrementalForest
+        shard_size              : fit 'iforest' as seeded shards of this many
+                                  trees (BLOCK_SIZE if None and n_jobs > 1)
+                                  over n_jobs workers and merge them, the
+                                  forest does not depend on n_jobs, see
+                                  Utils.ShardedForest; off by default
     data type:
     """
-    outlier_detector_l1 = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose, max_samples=max_samples,
-                                          contamination=contamination)
-    outlier_detector_l2 = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose, max_samples=max_samples,
-                                          contamination=contamination)
+    outlier_detector_l1 = build_detector(detector, r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                         max_samples=max_samples, contamination=contamination, n_jobs=n_jobs)
+    outlier_detector_l2 = build_detector(detector, r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                         max_samples=max_samples, contamination=contamination, n_jobs=n_jobs)
+    if class_conditional:
+        outlier_detector_l1, outlier_detector_l2 = [
+            ClassConditionalDetector(detector, n_jobs=n_jobs, r_seed=r_seed, n_estimators=n_estimators,
+                                     max_samples=max_samples, contamination=contamination, flat_scorer=flat_scorer)
+            for _ in range(2)]
 
     train_data_hidden = train_data_hidden.cpu().numpy()
     train_data_last_layer = train_data_last_layer.cpu().numpy()
+    if detector in LOGIT_DETECTORS:
+        # logit scores only read the logits: the hidden slot scores the last layer too
+        train_data_hidden = train_data_last_layer
+    # predicted labels for the class-conditional detectors
+    train_label = train_data_last_layer.argmax(axis=1)
     # data argument
     print('===> AUROC Detector Fit: Start')
-    outlier_detector_l1.fit(train_data_hidden)
-    outlier_detector_l2.fit(train_data_last_layer)
+    layer_names = ['hidden', 'last_layer']
+    projections = fit_projections(detector_store, layer_names, [train_data_hidden, train_data_last_layer],
+                                  projection, r_seed)
+    train_data_hidden, train_data_last_layer = apply_projections(projections,
+                                                                 [train_data_hidden, train_data_last_layer])
+    hyperparams = dict(detector=detector, r_seed=r_seed, n_estimators=n_estimators, max_samples=max_samples,
+                       flat_scorer=flat_scorer)
+    if projection:
+        hyperparams['projection'] = projection
+    if coreset:
+        hyperparams.update(coreset=coreset, coreset_method=coreset_method)
+    if class_conditional:
+        # the per-class offsets are placed at fit time
+        hyperparams.update(class_conditional=True, fit_contamination=contamination)
+    sharded = detector == 'iforest' and not class_conditional and \
+        (shard_size is not None or (n_jobs is not None and n_jobs > 1))
+    if sharded:
+        shard_size = shard_size or BLOCK_SIZE
+        hyperparams['shard_size'] = shard_size
+    if incremental and (detector != 'iforest' or detector_store is None):
+        raise ValueError('incremental needs detector=\'iforest\' and a detector_store')
+    fitted = None if incremental else load_detectors(detector_store, layer_names, contamination, **hyperparams)
+    if incremental:
+        outlier_detector_l1, outlier_detector_l2 = [
+            fit_incremental(detector_store, layer_name, train_data, contamination, r_seed=r_seed,
+                            n_estimators=n_estimators, max_samples=max_samples)
+            for layer_name, train_data in zip(layer_names, [train_data_hidden, train_data_last_layer])]
+        # the refresh is O(new rows), the AUROC still needs every training row's score
+        train_score_hidden = outlier_detector_l1.decision_function(train_data_hidden)
+        train_score_last_layer = outlier_detector_l2.decision_function(train_data_last_layer)
+    elif fitted is not None:
+        (outlier_detector_l1, train_score_hidden), (outlier_detector_l2, train_score_last_layer) = fitted
+    else:
+        fit_index = select_coreset(train_data_hidden, coreset, coreset_method, train_label, r_seed) \
+            if coreset else slice(None)
+        if sharded:
+            # both detectors, their shards dealt over the same n_jobs workers
+            (outlier_detector_l1, train_score_hidden), (outlier_detector_l2, train_score_last_layer) = \
+                fit_forests_sharded([train_data_hidden[fit_index], train_data_last_layer[fit_index]],
+                                    contamination, n_workers=n_jobs, r_seed=r_seed, n_estimators=n_estimators,
+                                    max_samples=max_samples, shard_size=shard_size, flat_scorer=flat_scorer,
+                                    verbose=verbose)
+        else:
+            outlier_detector_l1, train_score_hidden = fit_detector(
+                outlier_detector_l1, train_data_hidden[fit_index], contamination, flat_scorer, train_label[fit_index])
+            outlier_detector_l2, train_score_last_layer = fit_detector(
+                outlier_detector_l2, train_data_last_layer[fit_index], contamination, flat_scorer,
+                train_label[fit_index])
+        if coreset:
+            # offsets from the scores of the full training set, as without a coreset
+            train_score_hidden = place_offset(outlier_detector_l1, decision_scores(
+                outlier_detector_l1, train_data_hidden, train_label), contamination)
+            train_score_last_layer = place_offset(outlier_detector_l2, decision_scores(
+                outlier_detector_l2, train_data_last_layer, train_label), contamination)
+        save_detectors(detector_store, layer_names,
+                       [(outlier_detector_l1, train_score_hidden), (outlier_detector_l2, train_score_last_layer)],
+                       **hyperparams)
 
     # **************** Tensor2numpy **************** #
     test_data_hidden = test_data_hidden.cpu().numpy()
     test_data_last_layer = test_data_last_layer.cpu().numpy()
+    if detector in LOGIT_DETECTORS:
+        test_data_hidden = test_data_last_layer
 
 
     print('===> outlier dataset prediction')
-    # outlier predict
-    outlier_train_hidden = outlier_detector_l1.predict(train_data_hidden)
-    outlier_train_last_layer = outlier_detector_l2.predict(train_data_last_layer)
-    outlier_train = outlier_train_last_layer + outlier_train_hidden
+    # one pass per detector and matrix: labels and decision scores together
+    fusion_engine = ScoreFusion([outlier_detector_l1, outlier_detector_l2], fusion=fusion,
+                                contamination=contamination)
+    train_scores = np.stack([train_score_hidden, train_score_last_layer])
+    fusion_engine.fit(train_scores)
+    test_scores = fusion_engine.layer_scores(apply_projections(projections, [test_data_hidden, test_data_last_layer]),
+                                             label=test_data_last_layer.argmax(axis=1))
 
-    outlier_test_hidden = outlier_detector_l1.predict(test_data_hidden)
-    outlier_test_last_layer = outlier_detector_l2.predict(test_data_last_layer)
-    outlier_test = outlier_test_last_layer + outlier_test_hidden
+    outlier_train_hidden = score_to_predict(train_scores[0])
+    outlier_test_hidden = score_to_predict(test_scores[0])
 
     print('outlier testing hidden inlier number', np.sum(outlier_test_hidden == 1))
 
     # **************** outlier predict final **************** #
-    outlier_train[outlier_train <= 1] = -1
-    outlier_train[outlier_train > 1] = 0
-    # outlier_train[outlier_train == 0] = \
-    #     train_data_last_layer.argmax(axis=1)[outlier_train == 0]
-
-    outlier_test[outlier_test <= 1] = -1
-    outlier_test[outlier_test > 1] = 0
-    # outlier_test[outlier_test == 0] = \
-    #     test_data_last_layer.argmax(axis=1)[outlier_test == 0]
+    outlier_train = np.where(fusion_engine.predict(train_scores) < 0, -1, 0)
+    outlier_test = np.where(fusion_engine.predict(test_scores) < 0, -1, 0)
 
 
     # **************** Print predict result **************** #
@@ -71,16 +163,7 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
     total_label = np.append(train_label, test_label)
 
     print('===> AUROC Detector Decision Score: Start')
-    train_score_hidden = outlier_detector_l1.decision_function(train_data_hidden)
-    test_score_hidden = outlier_detector_l1.decision_function(test_data_hidden)
-    train_score_last_layer = outlier_detector_l2.decision_function(train_data_last_layer)
-    test_score_last_layer = outlier_detector_l2.decision_function(test_data_last_layer)
-
-    train_score = np.minimum(train_score_hidden, train_score_last_layer)
-    test_score = np.minimum(test_score_hidden, test_score_last_layer)
-    total_data_score = np.append(train_score, test_score)
-
-    total_data_score = total_data_score
+    total_data_score = np.append(fusion_engine.fuse(train_scores), fusion_engine.fuse(test_scores))
 
     AUROC_score = roc_auc_score(total_label, total_data_score)
     print('', contamination)
@@ -88,4 +171,95 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
 
     print('===> AUROC_score End')
 
-    return outlier_train_hidden, outlier_test_hidden
\ No newline at end of file
+    return outlier_train_hidden, outlier_test_hidden
+
+
+def AUROC_score_sweep(train_data_last_layer, train_data_hidden, num_train_sample,
+                      test_data_last_layer, test_data_hidden, num_test_sample,
+                      contaminations=(0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.10),
+                      r_seed=0, n_estimators=1000, verbose=0, max_samples=10000, flat_scorer=True):
+    """
+    The AUROC score sweep Function
+    =======================
+    Same detectors and outputs as AUROC_score, evaluated for a list of
+    contamination levels. contamination only moves the decision offset
+    (a percentile of the training scores), so both forests are fitted once
+    (fit_detector), place_offset moves the offsets for every level and the
+    layers are combined by the same ScoreFusion 'vote' as AUROC_score.
+    Input: (train_data, test_data, contaminations)
+        train_data      [tensor]: embeded training dataset
+        test_data       [tensor]: embeded testing dataset
+        num_data_sample         : label of testing dataset
+        contaminations  [list]  : contamination levels to evaluate
+    Output:
+        {contamination: {'outlier_train_hidden', 'outlier_test_hidden',
+                         'outlier_train', 'outlier_test',
+                         'train_detection_rate', 'test_detection_rate', 'AUROC'}}
+    """
+    outlier_detector_l1 = build_detector('iforest', r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                         max_samples=max_samples)
+    outlier_detector_l2 = build_detector('iforest', r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                         max_samples=max_samples)
+
+    train_data_hidden = train_data_hidden.cpu().numpy()
+    train_data_last_layer = train_data_last_layer.cpu().numpy()
+    print('===> AUROC Detector Fit: Start')
+    outlier_detector_l1, train_score_hidden = fit_detector(outlier_detector_l1, train_data_hidden,
+                                                           contaminations[0], flat_scorer)
+    outlier_detector_l2, train_score_last_layer = fit_detector(outlier_detector_l2, train_data_last_layer,
+                                                               contaminations[0], flat_scorer)
+
+    # **************** Tensor2numpy **************** #
+    test_data_hidden = test_data_hidden.cpu().numpy()
+    test_data_last_layer = test_data_last_layer.cpu().numpy()
+
+    print('===> AUROC Detector Raw Score: Start')
+    # raw test scores once, every level only moves the offsets
+    test_raw_hidden = outlier_detector_l1.score_samples(test_data_hidden)
+    test_raw_last_layer = outlier_detector_l2.score_samples(test_data_last_layer)
+
+    train_label = np.ones(num_train_sample, dtype=int)
+    test_label = np.zeros(num_test_sample, dtype=int)-1
+    total_label = np.append(train_label, test_label)
+
+    results = {}
+    for contamination in contaminations:
+        train_score_hidden = place_offset(outlier_detector_l1, train_score_hidden, contamination)
+        train_score_last_layer = place_offset(outlier_detector_l2, train_score_last_layer, contamination)
+        train_scores = np.stack([train_score_hidden, train_score_last_layer])
+        test_scores = np.stack([test_raw_hidden - outlier_detector_l1.offset_,
+                                test_raw_last_layer - outlier_detector_l2.offset_])
+        fusion_engine = ScoreFusion([outlier_detector_l1, outlier_detector_l2], fusion='vote',
+                                    contamination=contamination)
+        fusion_engine.fit(train_scores)
+
+        # **************** outlier predict **************** #
+        outlier_train_hidden = score_to_predict(train_scores[0])
+        outlier_test_hidden = score_to_predict(test_scores[0])
+
+        # **************** outlier predict final **************** #
+        outlier_train = np.where(fusion_engine.predict(train_scores) < 0, -1, 0)
+        outlier_test = np.where(fusion_engine.predict(test_scores) < 0, -1, 0)
+
+        train_detection_rate = (outlier_train == -1).sum() / outlier_train.shape[0]
+        test_detection_rate = (outlier_test == -1).sum() / outlier_test.shape[0]
+
+        AUROC = roc_auc_score(total_label, np.append(fusion_engine.fuse(train_scores), fusion_engine.fuse(test_scores)))
+
+        # **************** Print predict result **************** #
+        print('', contamination)
+        print('Training dataset outlier detection rate:', train_detection_rate)
+        print('Testing dataset outlier detection rate:', test_detection_rate)
+        print('Outlier AUROC Score:', AUROC)
+
+        results[contamination] = {'outlier_train_hidden': outlier_train_hidden,
+                                  'outlier_test_hidden': outlier_test_hidden,
+                                  'outlier_train': outlier_train,
+                                  'outlier_test': outlier_test,
+                                  'train_detection_rate': train_detection_rate,
+                                  'test_detection_rate': test_detection_rate,
+                                  'AUROC': AUROC}
+
+    print('===> AUROC_score_sweep End')
+
+    return results
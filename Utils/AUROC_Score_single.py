@@ -4,12 +4,15 @@ import torch
 import torch.nn.functional as F
 
 from sklearn.metrics import roc_auc_score
-from sklearn.ensemble import IsolationForest
+from Utils.Coreset import select_coreset
+from Utils.Detectors import build_detector, decision_scores, fit_detector, predict_score, score_to_predict, \
+    load_detectors, place_offset, save_detectors
 
 
 def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
                 test_data_last_layer, test_data_hidden, num_test_sample,
-                r_seed=0, n_estimators=1000, verbose=0, max_samples=10000, contamination=0.01):
+                r_seed=0, n_estimators=1000, verbose=0, max_samples=10000, contamination=0.01,
+                flat_scorer=True, detector_store=None, detector='iforest', coreset=None, coreset_method='kcenter'):
     """
     The AUROC score Function
     =======================
@@ -17,19 +20,42 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
         train_data      [tensor]: embeded training dataset
         test_data       [tensor]: embeded testing dataset
         num_data_sample         : label of testing dataset
+        detector                : detector name, see Utils.Detectors.build_detector
+        coreset                 : fit the detector on a coreset of this many
+                                  training samples (fraction if < 1), see Utils.Coreset
+        coreset_method          : 'kcenter' or 'stratified'
     data type:
     """
     # outlier_detector_l1 = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose, max_samples=max_samples,
     #                                       contamination=contamination)
-    outlier_detector_l2 = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose, max_samples=max_samples,
-                                          contamination=contamination)
+    outlier_detector_l2 = build_detector(detector, r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                         max_samples=max_samples, contamination=contamination)
 
     # train_data_hidden = train_data_hidden.cpu().numpy()
     train_data_last_layer = train_data_last_layer.cpu().numpy()
     # data argument
     print('===> AUROC Detector Fit: Start')
     # outlier_detector_l1.fit(train_data_hidden)
-    outlier_detector_l2.fit(train_data_last_layer)
+    hyperparams = dict(detector=detector, r_seed=r_seed, n_estimators=n_estimators, max_samples=max_samples,
+                       flat_scorer=flat_scorer)
+    if coreset:
+        hyperparams.update(coreset=coreset, coreset_method=coreset_method)
+    fitted = load_detectors(detector_store, ['last_layer'], contamination, **hyperparams)
+    if fitted is not None:
+        (outlier_detector_l2, train_score_last_layer), = fitted
+    else:
+        train_label = train_data_last_layer.argmax(axis=1)
+        fit_index = select_coreset(train_data_last_layer, coreset, coreset_method, train_label, r_seed) \
+            if coreset else slice(None)
+        outlier_detector_l2, train_score_last_layer = fit_detector(outlier_detector_l2,
+                                                                   train_data_last_layer[fit_index],
+                                                                   contamination, flat_scorer, train_label[fit_index])
+        if coreset:
+            # offset from the scores of the full training set, as without a coreset
+            train_score_last_layer = place_offset(outlier_detector_l2, decision_scores(
+                outlier_detector_l2, train_data_last_layer, train_label), contamination)
+        save_detectors(detector_store, ['last_layer'], [(outlier_detector_l2, train_score_last_layer)],
+                       **hyperparams)
 
     # **************** Tensor2numpy **************** #
     # test_data_hidden = test_data_hidden.cpu().numpy()
@@ -39,11 +65,11 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
     print('===> outlier dataset prediction')
     # outlier predict
     # outlier_train_hidden = outlier_detector_l1.predict(train_data_hidden)
-    outlier_train_last_layer = outlier_detector_l2.predict(train_data_last_layer)
+    outlier_train_last_layer = score_to_predict(train_score_last_layer)
     outlier_train = outlier_train_last_layer
 
     # outlier_test_hidden = outlier_detector_l1.predict(test_data_hidden)
-    outlier_test_last_layer = outlier_detector_l2.predict(test_data_last_layer)
+    outlier_test_last_layer, test_score_last_layer = predict_score(outlier_detector_l2, test_data_last_layer)
     outlier_test = outlier_test_last_layer
 
     # print('outlier testing hidden inlier number', np.sum(outlier_test_hidden == 1))
@@ -68,9 +94,6 @@ def AUROC_score(train_data_last_layer, train_data_hidden, num_train_sample,
     print('===> AUROC Detector Decision Score: Start')
     # train_score_hidden = outlier_detector_l1.decision_function(train_data_hidden)
     # test_score_hidden = outlier_detector_l1.decision_function(test_data_hidden)
-    train_score_last_layer = outlier_detector_l2.decision_function(train_data_last_layer)
-    test_score_last_layer = outlier_detector_l2.decision_function(test_data_last_layer)
-
     train_score = train_score_last_layer
     test_score =  test_score_last_layer
     total_data_score = np.append(train_score, test_score)
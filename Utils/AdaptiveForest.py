@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from scipy.stats import spearmanr
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+
+
+class AdaptiveIsolationForest:
+    """
+    The Adaptive IsolationForest
+    =======================
+    Grows an IsolationForest step trees at a time (warm_start) instead of
+    fitting a fixed n_estimators. After every increment only the new trees
+    are walked over a held-out slice of the training data, their path
+    lengths are added to the running sum, and the Spearman rank correlation
+    with the previous ranking is tracked. Growing stops once
+    1 - correlation < tol for patience increments in a row (and at least
+    min_estimators trees exist), or at max_estimators.
+    sklearn draws the tree seeds of a warm start like a single fit, so the
+    result equals IsolationForest(n_estimators=n_estimators_) on the same
+    (non held-out) data.
+    Input:
+        max_estimators          : upper bound, the fixed size used so far
+        step                    : trees added per increment
+        holdout                 : fraction of the training data held out
+                                  (at most max_holdout samples)
+    Output (after fit):
+        forest_                 : fitted sklearn IsolationForest
+        n_estimators_           : number of trees used
+        history_        [list]  : (n_trees, rank correlation) per increment
+    """
+
+    def __init__(self, r_seed=0, max_estimators=1000, step=50, min_estimators=100, tol=1e-2, patience=2,
+                 holdout=0.1, max_holdout=5000, max_samples=10000, contamination=0.01, verbose=0):
+        self.r_seed = r_seed
+        self.max_estimators = max_estimators
+        self.step = step
+        self.min_estimators = min_estimators
+        self.tol = tol
+        self.patience = patience
+        self.holdout = holdout
+        self.max_holdout = max_holdout
+        self.max_samples = max_samples
+        self.contamination = contamination
+        self.verbose = verbose
+
+    @staticmethod
+    def _path_length_sum(forest, first_tree, data, chunk_size=512):
+        # summed path length of data over the new trees estimators_[first_tree:]
+        new_trees = FlatIsolationForest.from_sklearn(SimpleNamespace(
+            estimators_=forest.estimators_[first_tree:], estimators_features_=forest.estimators_features_[first_tree:],
+            max_samples_=forest.max_samples_, offset_=forest.offset_))
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        return np.concatenate([new_trees._path_length_sum(data[start:start + chunk_size])
+                               for start in range(0, data.shape[0], chunk_size)])
+
+    def fit(self, train_data, train_label=None):
+        rng = np.random.RandomState(self.r_seed)
+        order = rng.permutation(train_data.shape[0])
+        n_holdout = max(1, min(int(self.holdout * train_data.shape[0]), self.max_holdout))
+        holdout_data, fit_data = train_data[order[:n_holdout]], train_data[order[n_holdout:]]
+
+        forest = IsolationForest(random_state=self.r_seed, n_estimators=0, warm_start=True, verbose=self.verbose,
+                                 max_samples=self.max_samples, contamination='auto')
+        path_length_sum, previous, n_stable = np.zeros(n_holdout), None, 0
+        self.history_ = []
+        while forest.n_estimators < self.max_estimators:
+            n_trees = forest.n_estimators
+            forest.set_params(n_estimators=min(n_trees + self.step, self.max_estimators))
+            forest.fit(fit_data)
+            path_length_sum += self._path_length_sum(forest, n_trees, holdout_data)
+
+            if previous is not None:
+                correlation = spearmanr(previous, path_length_sum).correlation
+                self.history_.append((forest.n_estimators, correlation))
+                n_stable = n_stable + 1 if 1 - correlation < self.tol else 0
+                if n_stable >= self.patience and forest.n_estimators >= self.min_estimators:
+                    break
+            previous = path_length_sum.copy()
+
+        forest.set_params(contamination=self.contamination)
+        self.forest_ = forest
+        self.n_estimators_ = forest.n_estimators
+        print('===> Adaptive IsolationForest: %d of at most %d trees' % (self.n_estimators_, self.max_estimators),
+              '(rank correlation %.5f)' % self.history_[-1][1] if self.history_ else '')
+        return self
@@ -0,0 +1,128 @@
+import importlib
+
+import numpy as np
+
+from Utils.Detectors import build_detector, fit_detector
+from Utils.ParallelFit import SharedArray, attach_shared_array, process_pool
+
+
+def _fit_class_detector(handle, start, stop, label, detector, build_params, contamination, flat_scorer):
+    shm, train_data = attach_shared_array(handle)
+    try:
+        train_data = train_data[start:stop]
+        build_params = dict(build_params)
+        if isinstance(build_params['max_samples'], int):
+            build_params['max_samples'] = min(build_params['max_samples'], train_data.shape[0])
+        return fit_detector(build_detector(detector, **build_params), train_data, contamination, flat_scorer,
+                            np.full(train_data.shape[0], label))
+    finally:
+        del train_data
+        shm.close()
+
+
+class ClassConditionalDetector:
+    """
+    The Class-Conditional Detector Ensemble
+    =======================
+    One small detector per predicted class instead of one detector over the
+    multimodal mixture of all known classes:
+        fit             : the training embeddings are sorted by their DLA
+                          argmax label, every class block is fitted by its
+                          own detector (n_estimators // n_classes trees for
+                          forests) in a process pool over shared memory
+        score           : every sample is routed to the detector of its
+                          predicted class only; the class blocks are
+                          gathered with one argsort and scattered back
+        score_samples = class detector's decision_function, so every class
+        is thresholded at its own contamination percentile
+    Samples predicted as a class without training samples get the best
+    score over all class detectors.
+    class_routed tells Utils.Detectors.fit_detector and Utils.ScoreFusion to
+    pass the predicted labels along with the data.
+    """
+
+    class_routed = True
+
+    def __init__(self, detector='iforest', n_jobs=None, r_seed=0, n_estimators=1000, max_samples=10000,
+                 contamination=0.01, flat_scorer=True):
+        self.detector = detector
+        self.n_jobs = n_jobs
+        self.r_seed = r_seed
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.contamination = contamination
+        self.flat_scorer = flat_scorer
+        self.offset_ = 0.0
+
+    def fit(self, train_data, train_label):
+        train_label = np.asarray(train_label)
+        order = np.argsort(train_label, kind='stable')
+        self.classes_, class_start, class_count = np.unique(train_label[order], return_index=True,
+                                                            return_counts=True)
+        build_params = dict(r_seed=self.r_seed, n_estimators=max(1, self.n_estimators // len(self.classes_)),
+                            max_samples=self.max_samples, contamination=self.contamination)
+
+        shared_data = SharedArray(train_data[order])
+        try:
+            jobs = [(shared_data.handle, start, start + count, label, self.detector, build_params,
+                     self.contamination, self.flat_scorer)
+                    for label, start, count in zip(self.classes_, class_start, class_count)]
+            if self.n_jobs is not None and self.n_jobs > 1:
+                with process_pool(self.n_jobs) as pool:
+                    fitted = [future.result() for future in [pool.submit(_fit_class_detector, *job) for job in jobs]]
+            else:
+                fitted = [_fit_class_detector(*job) for job in jobs]
+        finally:
+            shared_data.close()
+        self.detectors_ = [class_detector for class_detector, _ in fitted]
+        return self
+
+    def score_samples(self, data, label):
+        label = np.asarray(label)
+        order = np.argsort(label, kind='stable')
+        labels, class_start, class_count = np.unique(label[order], return_index=True, return_counts=True)
+        detector_index = np.searchsorted(self.classes_, labels)
+
+        score = np.empty(data.shape[0])
+        for label_, start, count, index in zip(labels, class_start, class_count, detector_index):
+            rows = order[start:start + count]
+            if index < len(self.classes_) and self.classes_[index] == label_:
+                score[rows] = self.detectors_[index].decision_function(data[rows])
+            else:
+                score[rows] = np.max([class_detector.decision_function(data[rows])
+                                      for class_detector in self.detectors_], axis=0)
+        return score
+
+    def decision_function(self, data, label):
+        return self.score_samples(data, label) - self.offset_
+
+    def predict(self, data, label):
+        return np.where(self.decision_function(data, label) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays, detector_info = {'classes': self.classes_}, []
+        for i, class_detector in enumerate(self.detectors_):
+            class_arrays, class_meta = class_detector.state_dict()
+            arrays.update({'%d_%s' % (i, name): array for name, array in class_arrays.items()})
+            detector_info.append({'class': type(class_detector).__module__ + '.' + type(class_detector).__name__,
+                                  'arrays': sorted(class_arrays), 'meta': class_meta})
+        meta = {'detector': self.detector, 'n_jobs': self.n_jobs, 'r_seed': self.r_seed,
+                'n_estimators': self.n_estimators, 'max_samples': self.max_samples,
+                'contamination': self.contamination, 'flat_scorer': self.flat_scorer,
+                'offset': float(self.offset_), 'detectors': detector_info}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(detector=meta['detector'], n_jobs=meta['n_jobs'], r_seed=meta['r_seed'],
+                       n_estimators=meta['n_estimators'], max_samples=meta['max_samples'],
+                       contamination=meta['contamination'], flat_scorer=meta['flat_scorer'])
+        detector.classes_ = np.asarray(arrays['classes'])
+        detector.detectors_ = []
+        for i, info in enumerate(meta['detectors']):
+            module_name, class_name = info['class'].rsplit('.', 1)
+            detector_class = getattr(importlib.import_module(module_name), class_name)
+            detector.detectors_.append(detector_class.from_state(
+                {name: arrays['%d_%s' % (i, name)] for name in info['arrays']}, info['meta']))
+        detector.offset_ = meta['offset']
+        return detector
@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+
+from sklearn.metrics import roc_auc_score
+
+from Utils.Detectors import build_detector, fit_detector
+from Utils.Projection import Projection
+
+
+def kcenter_greedy(data, n_select, r_seed=0, projection_dim=32, chunk_size=65536):
+    """
+    Greedy k-center selection: every step adds the sample farthest from the
+    centers selected so far. The running minimum distance of all samples is
+    updated chunk by chunk with one matrix-vector product per chunk. With
+    projection_dim the distances are taken in a Gaussian random projection
+    (distances are approximately preserved), which keeps every update pass
+    in cache for millions of embeddings; 0 uses the raw features.
+    Output: indices of the selected samples
+    """
+    rng = np.random.RandomState(r_seed)
+    if projection_dim and projection_dim < data.shape[1]:
+        data = Projection('random', projection_dim, r_seed, batch_size=chunk_size).fit(data).transform(data)
+    else:
+        data = np.asarray(data, dtype=np.float32)
+    n_samples = data.shape[0]
+    squared_norm = np.concatenate([(data[start:start + chunk_size] ** 2).sum(axis=1)
+                                   for start in range(0, n_samples, chunk_size)])
+
+    min_distance = np.full(n_samples, np.inf, dtype=np.float32)
+    selected = np.empty(n_select, dtype=np.int64)
+    selected[0] = rng.randint(n_samples)
+    for i in range(n_select):
+        center = data[selected[i]]
+        for start in range(0, n_samples, chunk_size):
+            distance = squared_norm[start:start + chunk_size] - 2 * data[start:start + chunk_size] @ center \
+                + squared_norm[selected[i]]
+            np.minimum(min_distance[start:start + chunk_size], distance, out=min_distance[start:start + chunk_size])
+        if i + 1 < n_select:
+            selected[i + 1] = min_distance.argmax()
+    return np.sort(selected)
+
+
+def stratified_sample(label, n_select, r_seed=0):
+    """
+    Uniform sample with every class kept at its share of the data.
+    Output: indices of the selected samples
+    """
+    rng = np.random.RandomState(r_seed)
+    label = np.asarray(label)
+    classes, counts = np.unique(label, return_counts=True)
+
+    # largest remainder rounding of the class quotas
+    share = counts * n_select / label.shape[0]
+    quota = np.floor(share).astype(np.int64)
+    quota[np.argsort(quota - share)[:n_select - quota.sum()]] += 1
+
+    # random order inside every class, then the first quota samples of each
+    order = rng.permutation(label.shape[0])
+    order = order[np.argsort(label[order], kind='stable')]
+    rank = np.arange(label.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.sort(order[rank < np.repeat(quota, counts)])
+
+
+def select_coreset(data, coreset, method='kcenter', label=None, r_seed=0):
+    """
+    The Coreset Selection Function
+    =======================
+    Input: (data, coreset, method)
+        data            [numpy] : embeded training dataset (k-center distances)
+        coreset                 : number of samples, or a fraction of the data if < 1
+        method                  : 'kcenter' or 'stratified' (needs label)
+        label           [numpy] : (predicted) labels of the training dataset
+    Output:
+        sorted indices of the coreset
+    """
+    n_select = int(coreset * data.shape[0]) if coreset < 1 else int(coreset)
+    n_select = max(1, min(n_select, data.shape[0]))
+    if method == 'kcenter':
+        index = kcenter_greedy(data, n_select, r_seed)
+    elif method == 'stratified':
+        index = stratified_sample(label, n_select, r_seed)
+    else:
+        raise ValueError('Unknown coreset method: %s' % method)
+    print('===> Coreset:', method, index.shape[0], 'of', data.shape[0], 'training samples')
+    return index
+
+
+def coreset_auroc_loss(train_data, test_data, coreset, method='kcenter', train_label=None, detector='iforest',
+                       r_seed=0, contamination=0.01, **detector_params):
+    """
+    The Coreset AUROC Loss Function
+    =======================
+    Fits the same detector on the full training set and on its coreset and
+    compares the AUROC of training (inlier) vs test (outlier) scores.
+    Input: (train_data, test_data, coreset, method)
+        train_data      [numpy] : embeded training dataset
+        test_data       [numpy] : embeded outlier dataset
+        detector_params         : passed to Utils.Detectors.build_detector
+    Output:
+        {'full': AUROC, 'coreset': AUROC, 'loss': full - coreset,
+         'full_fit_time': seconds, 'coreset_fit_time': seconds (incl. selection)}
+    """
+    total_label = np.append(np.ones(train_data.shape[0], dtype=int), np.zeros(test_data.shape[0], dtype=int) - 1)
+    results = {}
+    for name in ('full', 'coreset'):
+        start_time = time.time()
+        fit_data, fit_label = train_data, train_label
+        if name == 'coreset':
+            index = select_coreset(train_data, coreset, method, train_label, r_seed)
+            fit_data, fit_label = train_data[index], None if train_label is None else train_label[index]
+        fitted, _ = fit_detector(build_detector(detector, r_seed=r_seed, contamination=contamination,
+                                                **detector_params), fit_data, contamination, train_label=fit_label)
+        results[name + '_fit_time'] = time.time() - start_time
+        results[name] = roc_auc_score(total_label, np.append(fitted.decision_function(train_data),
+                                                             fitted.decision_function(test_data)))
+    results['loss'] = results['full'] - results['coreset']
+    print('Full set AUROC: %.6f (%.1fs)  Coreset AUROC: %.6f (%.1fs)  loss: %.6f' % (
+        results['full'], results['full_fit_time'], results['coreset'], results['coreset_fit_time'], results['loss']))
+    return results
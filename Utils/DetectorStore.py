@@ -0,0 +1,89 @@
+import hashlib
+import importlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class DetectorStore:
+    """
+    The Detector Artifact Store
+    =======================
+    Fitted detectors saved on disk, one directory per key:
+        <root>/<key>/meta.json        detector class, scalars (offset_, ...)
+        <root>/<key>/<array>.npy      packed detector arrays, train scores
+    Keys are built from the model checkpoint hash, the known/unknown class
+    split, the layer name and the detector hyperparameters, so a detector is
+    only reused for the exact embeddings it was fitted on. Arrays are loaded
+    back with mmap_mode='r': a repeat evaluation skips fitting and pages the
+    trees in lazily while scoring.
+    Input:
+        root                    : store directory
+        checkpoint_path         : model checkpoint the embeddings come from
+        split           [list]  : known classes of the run (None = all)
+    """
+
+    def __init__(self, root='./checkpoint/detectors', checkpoint_path=None, split=None):
+        self.root = root
+        self.checkpoint_hash = file_hash(checkpoint_path) if checkpoint_path is not None else None
+        self.split = None if split is None else [int(i) for i in split]
+
+    def key(self, layer_name, **hyperparams):
+        description = json.dumps({'checkpoint': self.checkpoint_hash, 'split': self.split,
+                                  'layer': layer_name, 'hyperparams': hyperparams},
+                                 sort_keys=True, default=str)
+        return '%s_%s' % (layer_name, hashlib.sha1(description.encode()).hexdigest()[:16])
+
+    def contains(self, key):
+        return os.path.isfile(os.path.join(self.root, key, 'meta.json'))
+
+    def save(self, key, detector, train_score=None):
+        """
+        Save a detector exposing state_dict() (e.g. FlatIsolationForest) and,
+        optionally, its decision scores on the training data.
+        """
+        if not hasattr(detector, 'state_dict'):
+            raise TypeError('%s cannot be stored, it has no state_dict()' % type(detector).__name__)
+        arrays, meta = detector.state_dict()
+        if train_score is not None:
+            arrays = dict(arrays, train_score=train_score)
+
+        # write next to the final directory and swap it in, readers never see half an artifact
+        path = os.path.join(self.root, key)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'class': type(detector).__module__ + '.' + type(detector).__name__,
+                       'arrays': sorted(arrays), 'meta': meta}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def load(self, key, mmap_mode='r'):
+        """
+        Output: (detector, train_score), (None, None) if the key is not stored
+        """
+        if not self.contains(key):
+            return None, None
+        path = os.path.join(self.root, key)
+        with open(os.path.join(path, 'meta.json')) as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in info['arrays']}
+        train_score = arrays.pop('train_score', None)
+
+        module_name, class_name = info['class'].rsplit('.', 1)
+        detector_class = getattr(importlib.import_module(module_name), class_name)
+        return detector_class.from_state(arrays, info['meta']), train_score
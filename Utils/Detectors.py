@@ -0,0 +1,213 @@
+import numpy as np
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.AdaptiveForest import AdaptiveIsolationForest
+from Utils.DiagonalGMM import ClassGMMDetector
+from Utils.ExtendedIsolationForest import ExtendedIsolationForest
+from Utils.FlatIsolationForest import FlatIsolationForest
+from Utils.HalfSpaceTrees import HalfSpaceTrees
+from Utils.KNNDetector import KNNDetector
+from Utils.LogitScore import LOGIT_SCORERS, LogitDetector
+from Utils.Mahalanobis import MahalanobisDetector
+from Utils.OpenMax import OpenMaxDetector
+from Utils.PrototypeCosine import PrototypeCosineDetector
+from Utils.QuantizedForest import QuantizedIsolationForest
+from Utils.RFFSVM import RFFOneClassSVM
+
+# detectors that only read the logits of the last layer
+LOGIT_DETECTORS = tuple(LOGIT_SCORERS) + ('openmax',)
+# subsample size of the extended isolation trees (Hariri et al.'s default)
+EIF_MAX_SAMPLES = 256
+
+
+def build_detector(detector='iforest', r_seed=0, n_estimators=1000, verbose=0, max_samples=10000,
+                   contamination=0.01, n_jobs=None):
+    """
+    The Detector Build Function
+    =======================
+    Input: (detector, IsolationForest parameters)
+        detector                : 'iforest'     sklearn IsolationForest
+                                  'iforest_adaptive'
+                                                IsolationForest grown until the held-out
+                                                score ranking is stable, at most n_estimators trees
+                                  'iforest_uint8'
+                                                IsolationForest on 256-quantile uint8 bin codes
+                                  'eif'         Extended Isolation Forest (hyperplane splits),
+                                                trees built on n_jobs processes; max_samples is
+                                                capped at EIF_MAX_SAMPLES (the paper's 256), its
+                                                pure-Python tree builder is too slow for 10000
+                                  'mahalanobis' class-conditional Mahalanobis distance
+                                  'knn'         k-th nearest neighbour distance (IVF index)
+                                  'gmm'         diagonal GMM per (predicted) class, mini-batch EM,
+                                                log-likelihood score
+                                  'hst'         streaming Half-Space-Trees, partial_fit per batch
+                                  'rff_svm'     RBF one-class SVM on random Fourier features (SGD)
+                                  'cosine'      projection on the nearest normalized class
+                                                centroid (cosine x feature norm), one GEMM
+                                  'cosine_react'
+                                                'cosine' on features clipped at their 90th
+                                                training percentile (ReAct)
+                                  'msp', 'energy', 'max_logit'
+                                                zero-fit logit scores, last layer only
+                                  'openmax'     EVT-calibrated unknown probability, last layer only
+    Output:
+        unfitted detector for fit_detector
+    """
+    if detector == 'iforest':
+        return IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose,
+                               max_samples=max_samples, contamination=contamination)
+    if detector == 'iforest_adaptive':
+        return AdaptiveIsolationForest(r_seed=r_seed, max_estimators=n_estimators, verbose=verbose,
+                                       max_samples=max_samples, contamination=contamination)
+    if detector == 'iforest_uint8':
+        return QuantizedIsolationForest(r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                        max_samples=max_samples)
+    if detector == 'eif':
+        # a fraction (e.g. 1.0) of the training set is capped as well
+        if isinstance(max_samples, float) or max_samples > EIF_MAX_SAMPLES:
+            print('===> eif: max_samples %s capped at %d' % (max_samples, EIF_MAX_SAMPLES))
+            max_samples = EIF_MAX_SAMPLES
+        return ExtendedIsolationForest(n_estimators=n_estimators, max_samples=max_samples, n_jobs=n_jobs,
+                                       r_seed=r_seed)
+    if detector == 'mahalanobis':
+        return MahalanobisDetector()
+    if detector == 'gmm':
+        return ClassGMMDetector(r_seed=r_seed)
+    if detector == 'knn':
+        return KNNDetector(r_seed=r_seed)
+    if detector == 'rff_svm':
+        return RFFOneClassSVM(r_seed=r_seed)
+    if detector == 'cosine':
+        return PrototypeCosineDetector()
+    if detector == 'cosine_react':
+        return PrototypeCosineDetector(clip_percentile=90)
+    if detector == 'hst':
+        return HalfSpaceTrees(r_seed=r_seed, contamination=contamination)
+    if detector in LOGIT_SCORERS:
+        return LogitDetector(detector)
+    if detector == 'openmax':
+        return OpenMaxDetector()
+    raise ValueError('Unknown detector: %s' % detector)
+
+
+def fit_detector(detector, train_data, contamination=0.01, flat_scorer=True, train_label=None):
+    """
+    The Detector Fit Function
+    =======================
+    Fits a detector and returns its decision scores on the training data.
+    sklearn's fit() scores the training set once more to place offset_ when
+    contamination is not 'auto'; here that single pass is kept and reused as
+    the training decision scores. Other detectors only fit their statistics
+    and get offset_ from the same pass.
+    Input: (detector, train_data, contamination)
+        detector                : unfitted detector with score_samples/offset_
+        train_data      [numpy] : embeded training dataset
+        contamination           : proportion of training outliers
+        flat_scorer             : export a fitted IsolationForest into a
+                                  FlatIsolationForest for batched scoring
+        train_label     [numpy] : (predicted) labels of the training dataset,
+                                  used by class-conditional detectors
+    Output: (detector, train_score)
+        detector                : fitted detector (or its flat scorer)
+        train_score     [numpy] : decision_function(train_data)
+    """
+    if isinstance(detector, AdaptiveIsolationForest):
+        detector = detector.fit(train_data).forest_
+    elif isinstance(detector, IsolationForest):
+        detector.set_params(contamination='auto')
+        detector.fit(train_data)
+        detector.set_params(contamination=contamination)
+    else:
+        detector.fit(train_data, train_label)
+    if flat_scorer and isinstance(detector, IsolationForest):
+        detector = FlatIsolationForest.from_sklearn(detector)
+
+    if getattr(detector, 'class_routed', False):
+        train_raw_score = detector.score_samples(train_data, train_label)
+    elif getattr(detector, 'self_matching', False):
+        # neighbour detectors: a training row must not count itself as a neighbour
+        train_raw_score = detector.score_samples(train_data, exclude_self=True)
+    else:
+        train_raw_score = detector.score_samples(train_data)
+    detector.offset_ = np.percentile(train_raw_score, 100.0 * contamination)
+
+    return detector, train_raw_score - detector.offset_
+
+
+def predict_score(detector, data):
+    """
+    The Detector Predict & Score Function
+    =======================
+    Walks the detector once over data and derives both outputs from that pass.
+    Input: (detector, data)
+        detector                : fitted detector with decision_function
+        data            [numpy] : embeded dataset
+    Output: (predict, score)
+        predict         [numpy] : +1 inlier / -1 outlier, same as detector.predict
+        score           [numpy] : detector.decision_function
+    """
+    score = detector.decision_function(data)
+    return score_to_predict(score), score
+
+
+def score_to_predict(score):
+    # IsolationForest.predict: decision_function < 0 -> outlier
+    return np.where(score < 0, -1, 1)
+
+
+def decision_scores(detector, data, label=None):
+    # class_routed detectors score every sample against its (predicted) class
+    if getattr(detector, 'class_routed', False):
+        return detector.decision_function(data, label)
+    return detector.decision_function(data)
+
+
+def place_offset(detector, train_score, contamination):
+    """
+    Moves offset_ to the contamination percentile of the training scores,
+    as fit_detector places it.
+    Input: (detector, train_score, contamination)
+        train_score     [numpy] : decision_function(train_data) at the current offset_
+    Output:
+        train_score     [numpy] : decision_function(train_data) at the new offset_
+    """
+    train_raw_score = np.asarray(train_score) + detector.offset_
+    detector.offset_ = np.percentile(train_raw_score, 100.0 * contamination)
+    return train_raw_score - detector.offset_
+
+
+def load_detectors(detector_store, layer_names, contamination=None, **hyperparams):
+    """
+    Fitted detectors of all layers from a Utils.DetectorStore, None unless
+    every layer is stored.
+    Keys leave contamination out: it only places offset_, which is moved to
+    the requested contamination after loading (place_offset), so a
+    contamination sweep reuses one fit. Detectors whose fitted state depends
+    on it (per-class offsets, sampled out-of-core offsets) put it into
+    hyperparams themselves.
+    Output:
+        [(detector, train_score), ...] in the order of layer_names
+    """
+    if detector_store is None:
+        return None
+    results = [detector_store.load(detector_store.key(layer_name, **hyperparams)) for layer_name in layer_names]
+    if any(detector is None for detector, _ in results):
+        return None
+    print('===> Detectors loaded from store:', detector_store.root)
+    if contamination is not None:
+        results = [(detector, place_offset(detector, train_score, contamination)) for detector, train_score in results]
+    return results
+
+
+def save_detectors(detector_store, layer_names, results, **hyperparams):
+    if detector_store is None:
+        return
+    if any(not hasattr(detector, 'state_dict') for detector, _ in results):
+        # e.g. a sklearn IsolationForest fitted with flat_scorer=False
+        print('===> Detectors not stored: %s has no state_dict(), use flat_scorer=True to store forests' %
+              ', '.join(sorted({type(detector).__name__ for detector, _ in results
+                                if not hasattr(detector, 'state_dict')})))
+        return
+    for layer_name, (detector, train_score) in zip(layer_names, results):
+        detector_store.save(detector_store.key(layer_name, **hyperparams), detector, train_score)
@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from Utils.Detectors import LOGIT_DETECTORS, build_detector, fit_detector
+from Utils.ParallelFit import SharedArray, attach_shared_array, process_pool
+from Utils.ScoreFusion import ScoreFusion
+
+# pure-Python / per-tree detectors that hold the GIL, run in worker processes;
+# the rest spend their time in BLAS (which releases it) and run on threads
+PROCESS_DETECTORS = ('iforest', 'iforest_adaptive', 'iforest_uint8', 'eif', 'hst')
+
+
+def _fit_score(data, n_train, detector, build_params, contamination, flat_scorer, label):
+    # fit on rows [:n_train], decision scores of all rows
+    fitted, train_score = fit_detector(build_detector(detector, **build_params), data[:n_train], contamination,
+                                       flat_scorer, label[:n_train])
+    if getattr(fitted, 'class_routed', False):
+        return train_score, fitted.decision_function(data[n_train:], label[n_train:])
+    return train_score, fitted.decision_function(data[n_train:])
+
+
+def _fit_score_shared(handle, *args):
+    shm, data = attach_shared_array(handle)
+    try:
+        return _fit_score(data, *args)
+    finally:
+        del data
+        shm.close()
+
+
+class EnsembleRunner:
+    """
+    The Heterogeneous Detector Ensemble Runner
+    =======================
+    Fits and scores several detectors side by side on the same embeddings:
+        buffers         : every layer's training and evaluation rows are
+                          copied block by block into one SharedArray, held
+                          once for all detectors
+        dispatch        : tree detectors (PROCESS_DETECTORS) are fitted and
+                          scored in a process pool attached to the buffers,
+                          BLAS-bound detectors (mahalanobis, knn, gmm, logit
+                          scores, ...) at the same time on a thread pool over
+                          the same arrays; the workers are forked before the
+                          first thread starts
+        combined        : rank average of all detector scores, see
+                          Utils.ScoreFusion ('rank')
+    Logit detectors only score 'last_layer', the others every layer. Wall
+    time is close to the slowest single detector once n_jobs covers the jobs.
+    Input:
+        detectors       [list]  : names, see Utils.Detectors.build_detector
+        n_jobs                  : worker processes and threads each, None runs
+                                  every detector in this process one by one
+    """
+
+    def __init__(self, detectors=('iforest', 'mahalanobis', 'knn', 'energy'), n_jobs=None, r_seed=0,
+                 n_estimators=1000, max_samples=10000, contamination=0.01, flat_scorer=True):
+        self.detectors = detectors
+        self.n_jobs = n_jobs
+        self.build_params = dict(r_seed=r_seed, n_estimators=n_estimators, max_samples=max_samples,
+                                 contamination=contamination)
+        self.contamination = contamination
+        self.flat_scorer = flat_scorer
+
+    def jobs(self, layer_names):
+        return [(detector, layer_name) for detector in self.detectors for layer_name in layer_names
+                if detector not in LOGIT_DETECTORS or layer_name == 'last_layer']
+
+    def run(self, train_layers, eval_layers, train_label, eval_label, fitted_scores=None):
+        """
+        Input:
+            train_layers    [dict]  : {layer name: training embeddings}
+            eval_layers     [dict]  : {layer name: embeddings to score, or a list
+                                       of blocks of them}, same keys
+            train_label, eval_label : predicted labels (class-conditional detectors)
+            fitted_scores   [dict]  : {'detector/layer': (train scores, eval
+                                       scores)} of detectors the caller already
+                                      fitted, these jobs are not run again
+        Output: (scores, train_scores)
+            scores          [dict]  : {'detector/layer': eval decision scores,
+                                       'combined': fused rank score}
+            train_scores    [dict]  : same keys, training decision scores
+        """
+        label = np.append(train_label, eval_label)
+        n_train = len(train_label)
+        fitted_scores = fitted_scores or {}
+        names = [detector + '/' + layer_name for detector, layer_name in self.jobs(list(train_layers))]
+        jobs = [(detector, layer_name) for detector, layer_name in self.jobs(list(train_layers))
+                if detector + '/' + layer_name not in fitted_scores]
+        eval_blocks = {layer_name: list(blocks) if isinstance(blocks, (list, tuple)) else [blocks]
+                       for layer_name, blocks in eval_layers.items()}
+        buffers = {layer_name: SharedArray.concatenate([train_layers[layer_name]] + eval_blocks[layer_name])
+                   for layer_name in train_layers}
+        try:
+            results, start_time = dict(fitted_scores), time.time()
+            if self.n_jobs is None or self.n_jobs <= 1:
+                for detector, layer_name in jobs:
+                    results[detector + '/' + layer_name] = _fit_score(
+                        buffers[layer_name].array, n_train, detector, self.build_params, self.contamination,
+                        self.flat_scorer, label)
+            else:
+                # forking while threads of this process run can deadlock the children: the process jobs are
+                # submitted first (a fork pool starts all its workers on the first submit), the threads after
+                with process_pool(self.n_jobs) as processes, ThreadPoolExecutor(self.n_jobs) as threads:
+                    futures = {detector + '/' + layer_name: processes.submit(
+                        _fit_score_shared, buffers[layer_name].handle, n_train, detector, self.build_params,
+                        self.contamination, self.flat_scorer, label)
+                        for detector, layer_name in jobs if detector in PROCESS_DETECTORS}
+                    futures.update({detector + '/' + layer_name: threads.submit(
+                        _fit_score, buffers[layer_name].array, n_train, detector, self.build_params,
+                        self.contamination, self.flat_scorer, label)
+                        for detector, layer_name in jobs if detector not in PROCESS_DETECTORS})
+                    results.update({name: future.result() for name, future in futures.items()})
+            print('===> Ensemble: %d detector/layer pairs in %.1fs' % (len(jobs), time.time() - start_time))
+        finally:
+            for buffer in buffers.values():
+                buffer.close()
+
+        train_scores = {name: results[name][0] for name in names}
+        scores = {name: results[name][1] for name in names}
+        self.fusion_ = ScoreFusion([None] * len(names), fusion='rank', contamination=self.contamination)
+        train_scores['combined'] = self.fusion_.fit(np.stack([train_scores[name] for name in names]))
+        scores['combined'] = self.fusion_.fuse(np.stack([scores[name] for name in names]))
+        return scores, train_scores
@@ -0,0 +1,212 @@
+import numpy as np
+
+
+def average_path_length(n_samples_leaf):
+    """
+    Average path length of an unsuccessful BST search over n samples,
+    c(n) in the IsolationForest paper (same as sklearn's _average_path_length).
+    """
+    n_samples_leaf = np.asarray(n_samples_leaf, dtype=np.float64)
+    path_length = np.zeros(n_samples_leaf.shape)
+
+    mask_2 = n_samples_leaf == 2
+    not_mask = n_samples_leaf > 2
+    path_length[mask_2] = 1.0
+    path_length[not_mask] = 2.0 * (np.log(n_samples_leaf[not_mask] - 1.0) + np.euler_gamma) \
+        - 2.0 * (n_samples_leaf[not_mask] - 1.0) / n_samples_leaf[not_mask]
+    return path_length
+
+
+def float32_threshold(threshold):
+    """
+    sklearn compares float32 features against float64 thresholds. Rounding
+    each threshold down to the nearest float32 keeps x <= threshold exact
+    while the whole traversal stays in float32.
+    """
+    threshold = np.asarray(threshold, dtype=np.float64)
+    threshold_32 = threshold.astype(np.float32)
+    rounded_up = threshold_32 > threshold
+    threshold_32[rounded_up] = np.nextafter(threshold_32[rounded_up], np.float32(-np.inf))
+    return threshold_32
+
+
+class FlatIsolationForest:
+    """
+    The Flat IsolationForest Scorer
+    =======================
+    A fitted IsolationForest exported into packed node arrays, scored level by
+    level for a whole batch of samples at once.
+        feature         [int32]  : split feature per node (0 on leaves)
+        threshold       [float32]: split threshold per node (+inf on leaves)
+        children        [int32]  : [left, right] child per node, leaves point
+                                   at themselves so every sample can take
+                                   max_depth steps without masking
+        path_length     [float64]: depth(node) + c(n_node_samples)
+        roots           [int32]  : root node of every tree
+        max_samples              : samples drawn per tree (score normalisation)
+    Drop-in for the predict/decision_function/score_samples calls on
+    sklearn.ensemble.IsolationForest.
+    """
+
+    def __init__(self, feature, threshold, children, path_length, roots, max_depth, max_samples,
+                 offset=-0.5, chunk_size=512):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.path_length = path_length
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.max_samples_ = int(max_samples)
+        self.offset_ = offset
+        self.chunk_size = chunk_size
+
+    @property
+    def n_estimators(self):
+        return self.roots.shape[0]
+
+    @classmethod
+    def from_sklearn(cls, forest, chunk_size=512):
+        """
+        Export a fitted sklearn IsolationForest into packed arrays.
+        """
+        feature, threshold, children, path_length, roots = [], [], [], [], []
+        n_nodes, max_depth = 0, 0
+        for tree, tree_features in zip(forest.estimators_, forest.estimators_features_):
+            tree_ = tree.tree_
+            left, right = tree_.children_left, tree_.children_right
+            is_leaf = left == -1
+            node_index = np.arange(tree_.node_count)
+
+            # node depth, one tree level at a time
+            depth = np.zeros(tree_.node_count, dtype=np.int64)
+            level_nodes, level = np.array([0]), 0
+            while level_nodes.size:
+                depth[level_nodes] = level
+                level_nodes = level_nodes[~is_leaf[level_nodes]]
+                level_nodes = np.concatenate([left[level_nodes], right[level_nodes]])
+                level += 1
+
+            tree_children = np.stack([np.where(is_leaf, node_index, left),
+                                      np.where(is_leaf, node_index, right)], axis=1)
+
+            feature.append(np.where(is_leaf, 0, np.asarray(tree_features)[np.maximum(tree_.feature, 0)]))
+            threshold.append(np.where(is_leaf, np.inf, tree_.threshold))
+            children.append(tree_children + n_nodes)
+            path_length.append(depth + average_path_length(tree_.n_node_samples))
+            roots.append(n_nodes)
+
+            n_nodes += tree_.node_count
+            max_depth = max(max_depth, depth.max())
+
+        return cls(np.concatenate(feature).astype(np.int32),
+                   float32_threshold(np.concatenate(threshold)),
+                   np.concatenate(children).astype(np.int32),
+                   np.concatenate(path_length),
+                   np.asarray(roots, dtype=np.int32),
+                   max_depth, forest.max_samples_, offset=forest.offset_, chunk_size=chunk_size)
+
+    def state_dict(self):
+        """
+        (arrays, meta) for Utils.DetectorStore, arrays are saved as .npy files.
+        """
+        arrays = {'feature': self.feature, 'threshold': self.threshold, 'children': self.children,
+                  'path_length': self.path_length, 'roots': self.roots}
+        meta = {'max_depth': self.max_depth, 'max_samples': self.max_samples_,
+                'offset': float(self.offset_), 'chunk_size': self.chunk_size}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        return cls(arrays['feature'], arrays['threshold'], arrays['children'], arrays['path_length'],
+                   arrays['roots'], meta['max_depth'], meta['max_samples'],
+                   offset=meta['offset'], chunk_size=meta['chunk_size'])
+
+    @classmethod
+    def merge(cls, forests):
+        """
+        Merge blocks of trees fitted separately (same max_samples) into one
+        scorer, as if they had been fitted as a single ensemble.
+        """
+        if len(set(forest.max_samples_ for forest in forests)) != 1:
+            raise ValueError('Cannot merge forests fitted with different max_samples')
+
+        node_offsets = np.cumsum([0] + [forest.feature.shape[0] for forest in forests[:-1]])
+        return cls(np.concatenate([forest.feature for forest in forests]),
+                   np.concatenate([forest.threshold for forest in forests]),
+                   np.concatenate([forest.children + offset for forest, offset in zip(forests, node_offsets)]
+                                  ).astype(np.int32),
+                   np.concatenate([forest.path_length for forest in forests]),
+                   np.concatenate([forest.roots + offset for forest, offset in zip(forests, node_offsets)]
+                                  ).astype(np.int32),
+                   max(forest.max_depth for forest in forests), forests[0].max_samples_,
+                   offset=forests[0].offset_, chunk_size=forests[0].chunk_size)
+
+    def slice_trees(self, start, stop=None):
+        """
+        Trees start:stop (in fitting order) as a new scorer.
+        """
+        roots = self.roots[start:stop]
+        node_start = roots[0]
+        node_stop = self.roots[stop] if stop is not None and stop < self.n_estimators else self.feature.shape[0]
+        return FlatIsolationForest(self.feature[node_start:node_stop], self.threshold[node_start:node_stop],
+                                   (self.children[node_start:node_stop] - node_start).astype(np.int32),
+                                   self.path_length[node_start:node_stop], (roots - node_start).astype(np.int32),
+                                   self.max_depth, self.max_samples_, offset=self.offset_, chunk_size=self.chunk_size)
+
+    def _path_length_sum(self, data):
+        # data [chunk, n_features] float32 -> summed path length over all trees
+        n_chunk, n_features = data.shape
+        flat_data = data.ravel()
+        row_start = (np.arange(n_chunk, dtype=np.int32) * n_features)[:, None]
+
+        node = np.broadcast_to(self.roots, (n_chunk, self.n_estimators)).copy()
+        children = self.children.ravel()
+        for _ in range(self.max_depth):
+            value = flat_data.take(row_start + self.feature.take(node))
+            go_right = value > self.threshold.take(node)
+            node = children.take(2 * node + go_right)
+
+        return self.path_length.take(node).sum(axis=1)
+
+    def score_samples(self, data):
+        """
+        Opposite of the anomaly score defined in the original paper,
+        identical to IsolationForest.score_samples.
+        """
+        # uint8 bin codes are walked as they are (Utils.QuantizedForest)
+        data = np.ascontiguousarray(data, dtype=np.uint8 if self.threshold.dtype == np.uint8 else np.float32)
+        depths = np.empty(data.shape[0])
+        for start in range(0, data.shape[0], self.chunk_size):
+            depths[start:start + self.chunk_size] = self._path_length_sum(data[start:start + self.chunk_size])
+
+        denominator = self.n_estimators * average_path_length([self.max_samples_])[0]
+        if denominator == 0:
+            return -np.ones_like(depths)
+        return -2 ** (-depths / denominator)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+
+def test():
+    from sklearn.ensemble import IsolationForest
+
+    rng = np.random.RandomState(0)
+    train_data = rng.randn(3000, 64)
+    test_data = np.concatenate([rng.randn(500, 64), rng.randn(500, 64) * 2 + 1])
+
+    for max_samples in ['auto', 1000, 1.0]:
+        forest = IsolationForest(random_state=0, n_estimators=100, max_samples=max_samples,
+                                 contamination=0.05).fit(train_data)
+        flat_forest = FlatIsolationForest.from_sklearn(forest)
+        for data in [train_data, test_data]:
+            assert np.allclose(flat_forest.score_samples(data), forest.score_samples(data))
+            assert np.array_equal(flat_forest.predict(data), forest.predict(data))
+    print('FlatIsolationForest matches sklearn IsolationForest')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,217 @@
+import time
+
+import numpy as np
+import torch
+
+import torch.nn.functional as F
+
+
+def gram_statistics(feature_map, powers=10):
+    """
+    Higher-order Gram statistics of one activation batch (Sastry & Oore,
+    2020): for every order p, the row sums of the p-th root of the Gram
+    matrix of the p-th power of the feature map.
+    Input:
+        feature_map     [tensor]: [batch, channels, height, width]
+    Output:
+        [batch, powers, channels] statistics
+    """
+    # scaled to |x| <= 1 so the p-th powers cannot overflow float32;
+    # (s^2p G)^(1/p) = s^2 G^(1/p) restores the scale afterwards
+    features = feature_map.detach().flatten(2)
+    scale = features.abs().amax(dim=(1, 2), keepdim=True).clamp(min=1e-12)
+    features = features / scale
+    non_negative = bool((features >= 0).all())
+    statistics, features_p = [], features
+    for p in range(1, powers + 1):
+        if p > 1:
+            features_p = features_p * features
+        gram = torch.bmm(features_p, features_p.transpose(1, 2))
+        root = gram.clamp(min=0) ** (1.0 / p) if non_negative else gram.sign() * gram.abs() ** (1.0 / p)
+        statistics.append(root.sum(dim=2))
+    return torch.stack(statistics, dim=1) * scale ** 2
+
+
+class GramDetector:
+    """
+    The Gram-Matrix Layer-Statistics Detector
+    =======================
+    Forward hooks on the DLA Tree levels (layer3 - layer6) reduce every
+    activation map to its Gram statistics (gram_statistics) as soon as the
+    module has run; the maps themselves are never kept, only one batch of
+    [powers, channels] statistics per layer until the logits are known.
+        fit             : running per-class (predicted label) min / max of
+                          every statistic over a random 1 - holdout of the
+                          training images (permutation seeded by r_seed, so
+                          every class is in both parts), updated with one
+                          scatter_reduce per batch; the mean deviation of the
+                          remaining holdout images normalizes every layer
+        deviation       = sum over statistics of (min - x) / |min| below the
+                          bounds and (x - max) / |max| above, per layer
+        score           = -sum_l deviation_l / mean holdout deviation_l
+    offset_ is the contamination percentile of the holdout scores.
+    Input:
+        layers          [list]  : module names to hook
+        powers                  : highest Gram order
+        holdout                 : fraction of the training images used to
+                                  normalize the layer deviations
+        r_seed                  : seed of the bounds / holdout split
+    """
+
+    def __init__(self, layers=('layer3', 'layer4', 'layer5', 'layer6'), powers=10, holdout=0.1, contamination=0.01,
+                 batch_size=128, device='cpu', r_seed=0):
+        if not 0 < holdout < 1:
+            raise ValueError('holdout must be in (0, 1), got %s' % holdout)
+        self.layers = list(layers)
+        self.powers = powers
+        self.holdout = holdout
+        self.contamination = contamination
+        self.batch_size = batch_size
+        self.device = device
+        self.r_seed = r_seed
+        self.channels_ = None
+        self.offset_ = 0.0
+
+    def _passes(self, net, data, index=None):
+        """
+        Yields (logits, hidden, statistics [batch, powers, all channels]) batch by batch,
+        over the rows index of data (all rows if None) without copying them out first.
+        """
+        batch_statistics = {}
+        modules = dict(net.named_modules())
+
+        def hook(name):
+            def record(module, inputs, output):
+                batch_statistics[name] = gram_statistics(output, self.powers)
+            return record
+
+        handles = [modules[name].register_forward_hook(hook(name)) for name in self.layers]
+        try:
+            with torch.no_grad():
+                n_rows = data.shape[0] if index is None else len(index)
+                for start in range(0, n_rows, self.batch_size):
+                    batch = data[start:start + self.batch_size] if index is None \
+                        else data[torch.as_tensor(index[start:start + self.batch_size])]
+                    logits, hidden = net(batch.to(self.device))
+                    statistics = [batch_statistics.pop(name) for name in self.layers]
+                    if self.channels_ is None:
+                        self.channels_ = [layer_statistics.shape[2] for layer_statistics in statistics]
+                    yield logits, hidden, torch.cat(statistics, dim=2)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def _layer_deviation(self, statistics, label):
+        # [batch, n_layers] deviation from the bounds of the predicted class
+        low, high = self.mins_[label], self.maxs_[label]
+        deviation = F.relu(low - statistics) / (low.abs() + 1e-6) + F.relu(statistics - high) / (high.abs() + 1e-6)
+        return deviation.sum(dim=1) @ self.layer_index_
+
+    def fit(self, net, data):
+        net.eval()
+        n_fit = data.shape[0] - int(np.ceil(self.holdout * data.shape[0]))
+        if n_fit < 1:
+            raise ValueError('no training images left for the bounds with holdout=%s' % self.holdout)
+        # the training set is usually ordered by class: split a seeded permutation, not the tail
+        permutation = np.random.RandomState(self.r_seed).permutation(data.shape[0])
+        fit_index, holdout_index = np.sort(permutation[:n_fit]), np.sort(permutation[n_fit:])
+        self.mins_, self.channels_ = None, None
+        for logits, _, statistics in self._passes(net, data, fit_index):
+            if self.mins_ is None:
+                self.mins_ = torch.full((logits.shape[1],) + statistics.shape[1:], np.inf, device=statistics.device)
+                self.maxs_ = torch.full_like(self.mins_, -np.inf)
+            index = logits.argmax(dim=1)[:, None, None].expand_as(statistics)
+            self.mins_.scatter_reduce_(0, index, statistics, reduce='amin')
+            self.maxs_.scatter_reduce_(0, index, statistics, reduce='amax')
+
+        # classes never predicted on the training images fall back to the bounds over all classes
+        unseen = torch.isinf(self.mins_[:, 0, 0])
+        self.mins_[unseen] = self.mins_[~unseen].min(dim=0)[0]
+        self.maxs_[unseen] = self.maxs_[~unseen].max(dim=0)[0]
+
+        # [all channels, n_layers] one-hot, channel -> hooked layer
+        self.layer_index_ = torch.repeat_interleave(torch.eye(len(self.layers), device=self.mins_.device),
+                                                    torch.tensor(self.channels_, device=self.mins_.device), dim=0)
+
+        holdout_deviation = torch.cat([self._layer_deviation(statistics, logits.argmax(dim=1))
+                                       for logits, _, statistics in self._passes(net, data, holdout_index)])
+        self.expected_deviation_ = holdout_deviation.mean(dim=0).clamp(min=1e-12)
+        holdout_score = -(holdout_deviation / self.expected_deviation_).sum(dim=1).cpu().numpy().astype(np.float64)
+        self.offset_ = np.percentile(holdout_score, 100.0 * self.contamination)
+        return self
+
+    def extract(self, net, data):
+        """
+        Extraction pass with Gram scores, see Utils.LogitScore.extract_embeddings.
+        Output: ((logits, hidden), score)
+            score           [numpy] : score_samples, higher means more in-distribution
+        """
+        net.eval()
+        logits, hidden, score = [], [], []
+        for batch_logits, batch_hidden, statistics in self._passes(net, data):
+            logits.append(batch_logits)
+            hidden.append(batch_hidden)
+            score.append(-(self._layer_deviation(statistics, batch_logits.argmax(dim=1))
+                           / self.expected_deviation_).sum(dim=1).cpu().numpy())
+        return (torch.cat(logits), torch.cat(hidden)), np.concatenate(score).astype(np.float64)
+
+    def score_samples(self, net, data):
+        return self.extract(net, data)[1]
+
+    def decision_function(self, net, data):
+        return self.score_samples(net, data) - self.offset_
+
+    def predict(self, net, data):
+        return np.where(self.decision_function(net, data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'mins': self.mins_.cpu().numpy(), 'maxs': self.maxs_.cpu().numpy(),
+                  'layer_index': self.layer_index_.cpu().numpy(),
+                  'expected_deviation': self.expected_deviation_.cpu().numpy()}
+        meta = {'layers': self.layers, 'powers': self.powers, 'holdout': self.holdout,
+                'contamination': self.contamination, 'batch_size': self.batch_size, 'device': str(self.device),
+                'r_seed': self.r_seed, 'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(layers=meta['layers'], powers=meta['powers'], holdout=meta['holdout'],
+                       contamination=meta['contamination'], batch_size=meta['batch_size'], device=meta['device'],
+                       r_seed=meta['r_seed'])
+        detector.mins_, detector.maxs_, detector.layer_index_, detector.expected_deviation_ = [
+            torch.as_tensor(np.array(arrays[name]), device=meta['device'])
+            for name in ('mins', 'maxs', 'layer_index', 'expected_deviation')]
+        detector.offset_ = meta['offset']
+        return detector
+
+
+def test(n_train=512, n_test=256):
+    """
+    Fits on random-weight DLA activations of one image distribution and
+    reports the AUROC against a shifted one and the peak RSS of the passes.
+    """
+    import resource
+
+    from sklearn.metrics import roc_auc_score
+
+    from models.dla import DLA
+
+    torch.manual_seed(0)
+    net = DLA()
+    net.eval()
+    train_data = torch.rand(n_train, 3, 32, 32)
+    test_data = torch.cat([torch.rand(n_test, 3, 32, 32), torch.randn(n_test, 3, 32, 32) * 2])
+
+    start_time = time.time()
+    detector = GramDetector(batch_size=64).fit(net, train_data)
+    fit_time = time.time() - start_time
+    start_time = time.time()
+    (logits, hidden), score = detector.extract(net, test_data)
+    print('fit %.1fs  extract %.1fs  logits %s  hidden %s  peak RSS %.0f MB  AUROC %.4f' % (
+        fit_time, time.time() - start_time, tuple(logits.shape), tuple(hidden.shape),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        roc_auc_score(np.append(np.ones(n_test), -np.ones(n_test)), score)))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,198 @@
+import numpy as np
+
+
+class HalfSpaceTrees:
+    """
+    The Streaming Half-Space-Trees Detector
+    =======================
+    Mass-based online ensemble (Tan, Ting & Liu, 2011). Every tree is a full
+    binary tree of the given depth that halves a random workspace around the
+    data range on a random feature per node; it is built once, without data,
+    and only its node masses change:
+        latest_         [int32] : mass of the samples of the current window
+        reference_      [int32] : mass of the last complete window, used for
+                                  scoring
+    After every window_size samples the latest window becomes the reference
+    and a new latest window starts, so memory stays constant and the model
+    follows drift without refitting. offset_ (the open-set threshold) is the
+    contamination percentile of the scores the finished window got on
+    arrival, so it follows the drift as well.
+        score = sum over trees of mass(terminal node) * 2^depth, where the
+        terminal node is a leaf or the first node with mass <= size_limit
+    Higher scores are more normal, as for IsolationForest.score_samples.
+    The workspace is drawn from the feature range of the first partial_fit
+    batch, which should be representative (e.g. a full window).
+    """
+
+    def __init__(self, n_trees=25, depth=10, window_size=2048, size_limit=None, contamination=0.01,
+                 r_seed=0, chunk_size=1024):
+        self.n_trees = n_trees
+        self.depth = depth
+        self.window_size = window_size
+        self.size_limit = 0.1 * window_size if size_limit is None else size_limit
+        self.contamination = contamination
+        self.r_seed = r_seed
+        self.chunk_size = chunk_size
+        self.offset_ = 0.0
+
+    @property
+    def n_nodes(self):
+        return 2 ** (self.depth + 1) - 1
+
+    def _build(self, data_min, data_max):
+        rng = np.random.RandomState(self.r_seed)
+        n_features = data_min.shape[0]
+        n_internal = 2 ** self.depth - 1
+
+        # random workspace per tree: s in [min, max], extended by 2 * max(s - min, max - s)
+        s = rng.uniform(data_min, data_max, size=(self.n_trees, n_features))
+        span = 2 * np.maximum(s - data_min, data_max - s)
+        workspace_lo, workspace_hi = s - span, s + span
+
+        # split on the middle of the node's workspace, one level at a time:
+        # the ancestors splitting on the same feature bound that workspace
+        tree_index = np.arange(self.n_trees)[:, None]
+        self.feature_ = rng.randint(n_features, size=(self.n_trees, n_internal)).astype(np.int32)
+        self.threshold_ = np.empty((self.n_trees, n_internal), dtype=np.float32)
+        for level in range(self.depth):
+            nodes = np.arange(2 ** level - 1, 2 ** (level + 1) - 1)
+            feature = self.feature_[:, nodes]
+            lo, hi = workspace_lo[tree_index, feature], workspace_hi[tree_index, feature]
+            node = nodes
+            for _ in range(level):
+                parent = (node - 1) // 2
+                same_feature = self.feature_[:, parent] == feature
+                parent_threshold = self.threshold_[:, parent]
+                is_right = node == 2 * parent + 2
+                lo = np.where(same_feature & is_right, np.maximum(lo, parent_threshold), lo)
+                hi = np.where(same_feature & ~is_right, np.minimum(hi, parent_threshold), hi)
+                node = parent
+            self.threshold_[:, nodes] = (lo + hi) / 2
+
+        self.reference_ = np.zeros((self.n_trees, self.n_nodes), dtype=np.int32)
+        self.latest_ = np.zeros((self.n_trees, self.n_nodes), dtype=np.int32)
+        self.window_scores_ = np.zeros(self.window_size)
+        self.n_latest_ = 0
+        self.n_windows_ = 0
+
+    def _walk(self, data, update):
+        # data [chunk, n_features] float32 -> reference scores, optionally adding to latest_
+        n_chunk, n_features = data.shape
+        flat_data = data.ravel()
+        row_start = (np.arange(n_chunk) * n_features)[:, None]
+        node_offset = np.arange(self.n_trees) * self.n_nodes
+        internal_offset = np.arange(self.n_trees) * (2 ** self.depth - 1)
+        feature, threshold = self.feature_.ravel(), self.threshold_.ravel()
+        reference, latest = self.reference_.ravel(), self.latest_.ravel()
+
+        node = np.zeros((n_chunk, self.n_trees), dtype=np.int64)
+        active = np.ones((n_chunk, self.n_trees), dtype=bool)
+        score = np.zeros(n_chunk)
+        for level in range(self.depth + 1):
+            if update:
+                np.add.at(latest, (node_offset + node).ravel(), 1)
+            mass = reference.take(node_offset + node)
+            terminal = active & ((mass <= self.size_limit) | (level == self.depth))
+            score += np.where(terminal, mass, 0).sum(axis=1) * 2.0 ** level
+            active &= ~terminal
+            if level == self.depth or not (update or active.any()):
+                break
+            internal = internal_offset + node
+            value = flat_data.take(row_start + feature.take(internal))
+            node = 2 * node + 1 + (value > threshold.take(internal))
+        return score
+
+    def partial_fit(self, data, train_label=None):
+        """
+        Add samples to the latest window, swapping windows every window_size
+        samples.
+        """
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if not hasattr(self, 'feature_'):
+            self._build(data.min(axis=0), data.max(axis=0))
+
+        start = 0
+        while start < data.shape[0]:
+            stop = min(data.shape[0], start + self.window_size - self.n_latest_, start + self.chunk_size)
+            score = self._walk(data[start:stop], update=True)
+            self.window_scores_[self.n_latest_:self.n_latest_ + stop - start] = score
+            self.n_latest_ += stop - start
+            if self.n_latest_ == self.window_size:
+                # the first window arrived without a reference, its scores are all 0
+                if self.n_windows_:
+                    self.offset_ = np.percentile(self.window_scores_, 100.0 * self.contamination)
+                self.reference_, self.latest_ = self.latest_, np.zeros_like(self.latest_)
+                self.n_latest_ = 0
+                self.n_windows_ += 1
+            start = stop
+        return self
+
+    def fit(self, train_data, train_label=None):
+        for name in ('feature_', 'threshold_', 'reference_', 'latest_', 'window_scores_'):
+            self.__dict__.pop(name, None)
+        self.partial_fit(train_data)
+        if not self.n_windows_:
+            # less than one window of training data: score against what there is
+            self.reference_, self.latest_ = self.latest_, np.zeros_like(self.latest_)
+            self.n_latest_, self.n_windows_ = 0, 1
+        return self
+
+    def score_many(self, data):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        return np.concatenate([self._walk(data[start:start + self.chunk_size], update=False)
+                               for start in range(0, data.shape[0], self.chunk_size)])
+
+    def score_one(self, sample):
+        return self.score_many(np.asarray(sample)[None, :])[0]
+
+    def score_samples(self, data):
+        return self.score_many(data)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'feature': self.feature_, 'threshold': self.threshold_, 'reference': self.reference_,
+                  'latest': self.latest_, 'window_scores': self.window_scores_}
+        meta = {'n_trees': self.n_trees, 'depth': self.depth, 'window_size': self.window_size,
+                'size_limit': self.size_limit, 'contamination': self.contamination, 'r_seed': self.r_seed,
+                'chunk_size': self.chunk_size, 'n_latest': self.n_latest_, 'n_windows': self.n_windows_,
+                'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(n_trees=meta['n_trees'], depth=meta['depth'], window_size=meta['window_size'],
+                       size_limit=meta['size_limit'], contamination=meta['contamination'], r_seed=meta['r_seed'],
+                       chunk_size=meta['chunk_size'])
+        # the windows keep changing: copy out of a memory-mapped store
+        detector.feature_, detector.threshold_ = arrays['feature'], arrays['threshold']
+        detector.reference_, detector.latest_ = np.array(arrays['reference']), np.array(arrays['latest'])
+        detector.window_scores_ = np.array(arrays['window_scores'])
+        detector.n_latest_, detector.n_windows_ = meta['n_latest'], meta['n_windows']
+        detector.offset_ = meta['offset']
+        return detector
+
+
+def test():
+    from sklearn.metrics import roc_auc_score
+
+    rng = np.random.RandomState(0)
+    detector = HalfSpaceTrees(window_size=1024)
+    for shift in [0.0, 0.0, 3.0, 3.0]:
+        # stream 4 windows, the in-distribution mean drifts after the second
+        inlier = rng.randn(1024, 16) + shift
+        detector.partial_fit(inlier)
+        outlier = rng.randn(256, 16) * 3 + shift
+        label = np.append(np.ones(1024), -np.ones(256))
+        score = detector.score_many(np.concatenate([rng.randn(1024, 16) + shift, outlier]))
+        print('shift %.1f AUROC %.4f inlier detection rate %.4f' % (
+            shift, roc_auc_score(label, score), (detector.predict(rng.randn(1024, 16) + shift) == -1).mean()))
+    assert np.isclose(detector.score_one(outlier[0]), detector.score_many(outlier[:1])[0])
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,177 @@
+import hashlib
+
+import numpy as np
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+
+
+class IncrementalForest:
+    """
+    The Warm-Start Incremental Forest
+    =======================
+    An IsolationForest that grows with the in-distribution training set
+    instead of being refitted on the full history:
+        fit             : n_estimators trees on the initial training set, a
+                          uniform reservoir of reservoir_size samples is kept
+        update          : new trees, as many as the new data's share of the
+                          history (n_estimators * n_new / n_seen), are fitted
+                          on the reservoir plus the fresh samples; the oldest
+                          trees are retired (FIFO) so the ensemble keeps
+                          n_estimators trees, and the fresh samples enter the
+                          reservoir
+    Refresh cost is proportional to the new data, not to the history.
+    reservoir_size defaults to max(4 * max_samples, 10000) samples.
+    forest_ is a FlatIsolationForest with trees in fitting order (oldest
+    first); offset_ is placed by the caller, as in Utils.Detectors.fit_detector.
+    data_hash_ is the prefix_fingerprint of the n_seen_ training rows, set
+    by fit_incremental to check that a later training set extends them.
+    """
+
+    def __init__(self, r_seed=0, n_estimators=1000, max_samples=256, reservoir_size=None, verbose=0):
+        self.r_seed = r_seed
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.reservoir_size = reservoir_size
+        self.verbose = verbose
+        self.data_hash_ = None
+        self.offset_ = 0.0
+
+    def _fit_trees(self, data, n_estimators, seed):
+        forest = IsolationForest(random_state=seed, n_estimators=n_estimators, verbose=self.verbose,
+                                 max_samples=self.max_samples_, contamination='auto').fit(data)
+        return FlatIsolationForest.from_sklearn(forest)
+
+    def _seed(self):
+        return int(np.random.SeedSequence(self.r_seed, spawn_key=(self.n_updates_,)).generate_state(1)[0])
+
+    def _add_to_reservoir(self, data, rng):
+        # Algorithm R for a whole batch: sample t replaces slot j ~ U[0, t] if j < reservoir_size
+        n_free = min(self.reservoir_size - self.reservoir_.shape[0], data.shape[0])
+        self.reservoir_ = np.concatenate([self.reservoir_, data[:n_free]])
+        seen = self.n_seen_ + n_free + np.arange(data.shape[0] - n_free)
+        slot = (rng.random_sample(seen.shape[0]) * (seen + 1)).astype(np.int64)
+        keep = slot < self.reservoir_size
+        self.reservoir_[slot[keep]] = data[n_free:][keep]
+        self.n_seen_ += data.shape[0]
+
+    def fit(self, train_data, train_label=None):
+        train_data = np.asarray(train_data, dtype=np.float32)
+        self.n_updates_, self.n_seen_ = 0, 0
+        # a fractional max_samples is resolved once, all later trees use the same sample size
+        self.max_samples_ = int(self.max_samples * train_data.shape[0]) if isinstance(self.max_samples, float) \
+            else min(self.max_samples, train_data.shape[0])
+        if self.reservoir_size is None:
+            self.reservoir_size = max(4 * self.max_samples_, 10000)
+        self.forest_ = self._fit_trees(train_data, self.n_estimators, self._seed())
+        self.reservoir_ = np.empty((0, train_data.shape[1]), dtype=np.float32)
+        self._add_to_reservoir(train_data, np.random.RandomState(self._seed()))
+        return self
+
+    def update(self, new_data):
+        new_data = np.asarray(new_data, dtype=np.float32)
+        self.n_updates_ += 1
+        n_new_trees = int(np.clip(np.ceil(self.n_estimators * new_data.shape[0] / (self.n_seen_ + new_data.shape[0])),
+                                  1, self.n_estimators))
+        if self.reservoir_.shape[0] + new_data.shape[0] < self.max_samples_:
+            raise ValueError('Reservoir plus new data hold fewer than max_samples samples')
+        new_trees = self._fit_trees(np.concatenate([self.reservoir_, new_data]), n_new_trees, self._seed())
+
+        forest = FlatIsolationForest.merge([self.forest_, new_trees])
+        self.forest_ = forest.slice_trees(max(0, forest.n_estimators - self.n_estimators))
+        self._add_to_reservoir(new_data, np.random.RandomState(self._seed()))
+        print('===> Incremental forest: %d new samples, %d trees refitted, %d samples seen' % (
+            new_data.shape[0], n_new_trees, self.n_seen_))
+        return self
+
+    def score_samples(self, data):
+        return self.forest_.score_samples(data)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays, forest_meta = self.forest_.state_dict()
+        arrays = dict(arrays, reservoir=self.reservoir_)
+        meta = {'forest': forest_meta, 'r_seed': self.r_seed, 'n_estimators': self.n_estimators,
+                'max_samples': self.max_samples, 'reservoir_size': self.reservoir_size, 'verbose': self.verbose,
+                'max_samples_fitted': self.max_samples_, 'n_seen': self.n_seen_, 'n_updates': self.n_updates_,
+                'data_hash': self.data_hash_, 'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(r_seed=meta['r_seed'], n_estimators=meta['n_estimators'], max_samples=meta['max_samples'],
+                       reservoir_size=meta['reservoir_size'], verbose=meta['verbose'])
+        arrays = dict(arrays)
+        # the reservoir keeps changing: copy out of a memory-mapped store
+        detector.reservoir_ = np.array(arrays.pop('reservoir'))
+        detector.forest_ = FlatIsolationForest.from_state(arrays, meta['forest'])
+        detector.max_samples_ = meta['max_samples_fitted']
+        detector.n_seen_, detector.n_updates_ = meta['n_seen'], meta['n_updates']
+        detector.data_hash_ = meta['data_hash']
+        detector.offset_ = meta['offset']
+        return detector
+
+
+def prefix_fingerprint(data, n_rows, n_check=1024):
+    """
+    Hash of n_rows and of at most n_check rows spread evenly over
+    data[:n_rows] (first and last row included): a length-prefix check whose
+    cost does not grow with the history.
+    """
+    index = np.unique(np.linspace(0, n_rows - 1, min(n_check, n_rows)).astype(np.int64))
+    sha = hashlib.sha1(str(n_rows).encode())
+    sha.update(np.ascontiguousarray(data[index], dtype=np.float32).tobytes())
+    return sha.hexdigest()
+
+
+def _weighted_percentile(value, weight, q):
+    order = np.argsort(value, kind='stable')
+    cumulative = np.cumsum(weight[order])
+    return value[order][min(np.searchsorted(cumulative, q / 100.0 * cumulative[-1]), value.shape[0] - 1)]
+
+
+def fit_incremental(detector_store, layer_name, train_data, contamination=0.01, **forest_params):
+    """
+    The Incremental Fit Function
+    =======================
+    Loads the layer's incremental forest from a Utils.DetectorStore and
+    updates it with the training rows appended since it was stored, fits it
+    on first use, and stores the updated ensemble. The first n_seen_ rows
+    must match the stored prefix_fingerprint (the training set only grows
+    at the end); otherwise the forest is refitted from scratch. offset_ is
+    the contamination percentile of the scores of the reservoir (weighted
+    for the rows it stands for) plus the new rows, so a refresh costs
+    O(new rows), not O(history).
+    Input: (detector_store, layer_name, train_data, contamination)
+        forest_params           : IncrementalForest parameters
+    Output:
+        detector                : fitted IncrementalForest, offset_ placed
+    """
+    key = detector_store.key(layer_name, stage='incremental', **forest_params)
+    forest, _ = detector_store.load(key)
+    if forest is not None and (train_data.shape[0] < forest.n_seen_ or
+                               prefix_fingerprint(train_data, forest.n_seen_) != forest.data_hash_):
+        print('===> Incremental forest: training set is not an append of the stored one, refitting')
+        forest = None
+    if forest is None:
+        forest = IncrementalForest(**forest_params).fit(train_data)
+        offset_data = forest.reservoir_
+        offset_weight = np.full(offset_data.shape[0], forest.n_seen_ / offset_data.shape[0])
+    else:
+        n_seen, reservoir = forest.n_seen_, forest.reservoir_.copy()
+        new_data = np.asarray(train_data[n_seen:], dtype=np.float32)
+        if new_data.shape[0]:
+            forest.update(new_data)
+        offset_data = np.concatenate([reservoir, new_data])
+        offset_weight = np.append(np.full(reservoir.shape[0], n_seen / reservoir.shape[0]), np.ones(new_data.shape[0]))
+    forest.data_hash_ = prefix_fingerprint(train_data, forest.n_seen_)
+
+    forest.offset_ = _weighted_percentile(forest.score_samples(offset_data), offset_weight, 100.0 * contamination)
+    detector_store.save(key, forest)
+    return forest
@@ -0,0 +1,226 @@
+import json
+
+import numpy as np
+
+
+def squared_distance(data, centers):
+    # [n, d] x [m, d] -> [n, m] squared euclidean distances, one GEMM
+    return np.maximum((data ** 2).sum(axis=1)[:, None] - 2 * data @ centers.T + (centers ** 2).sum(axis=1)[None, :], 0)
+
+
+def kmeans(data, n_clusters, n_iter=20, r_seed=0, chunk_size=8192):
+    """
+    Lloyd's k-means in NumPy, assignments computed chunk by chunk.
+    Output: (centers, assignment)
+    """
+    rng = np.random.RandomState(r_seed)
+    n_clusters = min(n_clusters, data.shape[0])
+    centers = data[rng.choice(data.shape[0], n_clusters, replace=False)].copy()
+    assignment = np.zeros(data.shape[0], dtype=np.int64)
+    for _ in range(n_iter):
+        for start in range(0, data.shape[0], chunk_size):
+            assignment[start:start + chunk_size] = squared_distance(data[start:start + chunk_size],
+                                                                    centers).argmin(axis=1)
+        count = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, assignment, data)
+        empty = count == 0
+        centers[~empty] = sums[~empty] / count[~empty, None]
+        # re-seed empty cells on random points
+        centers[empty] = data[rng.choice(data.shape[0], empty.sum(), replace=False)]
+    return centers, assignment
+
+
+class KNNDetector:
+    """
+    The kNN Distance Detector
+    =======================
+    Distance to the k-th nearest training embedding (L2-normalised), searched
+    through an inverted-file (IVF) index built in NumPy:
+        coarse cells    : k-means centroids, every training embedding is kept
+                          in the inverted list of its closest centroid
+        pq_subspaces    : 0 keeps the raw vectors in the lists; m > 0 stores
+                          product-quantised residuals (m uint8 codes per
+                          vector) and scores them with lookup tables
+        n_probe         : number of closest cells searched per query
+    Queries are processed per probed cell: all queries probing a cell are
+    scored against its list with one GEMM (or table gather) and merged into
+    a running top-k.
+        score_samples = -distance to the k-th nearest neighbour
+    Scoring the training matrix itself (exclude_self=True, used by
+    Utils.Detectors.fit_detector) drops every row's own list entry by its
+    training row id, so a training row gets the k-th neighbour among the
+    other rows, as an unseen sample would.
+    """
+
+    # fit_detector scores the training pass with exclude_self=True
+    self_matching = True
+
+    def __init__(self, k=50, n_cells=256, n_probe=8, pq_subspaces=0, normalize=True, kmeans_iter=20,
+                 r_seed=0, chunk_size=4096):
+        self.k = k
+        self.n_cells = n_cells
+        self.n_probe = n_probe
+        self.pq_subspaces = pq_subspaces
+        self.normalize = normalize
+        self.kmeans_iter = kmeans_iter
+        self.r_seed = r_seed
+        self.chunk_size = chunk_size
+        self.offset_ = 0.0
+
+    def _prepare(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        if self.normalize:
+            data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+        return data
+
+    def fit(self, train_data, train_label=None):
+        train_data = self._prepare(train_data)
+
+        # **************** coarse quantizer **************** #
+        rng = np.random.RandomState(self.r_seed)
+        n_kmeans = min(train_data.shape[0], 64 * self.n_cells)
+        kmeans_sample = train_data[rng.choice(train_data.shape[0], n_kmeans, replace=False)]
+        self.centroids_, _ = kmeans(kmeans_sample, self.n_cells, self.kmeans_iter, self.r_seed)
+
+        cell = np.empty(train_data.shape[0], dtype=np.int64)
+        for start in range(0, train_data.shape[0], self.chunk_size):
+            cell[start:start + self.chunk_size] = \
+                squared_distance(train_data[start:start + self.chunk_size], self.centroids_).argmin(axis=1)
+
+        # **************** inverted lists **************** #
+        order = np.argsort(cell, kind='stable')
+        self.list_offsets_ = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.centroids_.shape[0]))])
+        list_vectors = train_data[order]
+        self.list_ids_ = order
+
+        if self.pq_subspaces:
+            residuals = list_vectors - self.centroids_[cell[order]]
+            subspaces = np.array_split(np.arange(train_data.shape[1]), self.pq_subspaces)
+            self.pq_codebooks_ = []
+            self.list_codes_ = np.empty((train_data.shape[0], self.pq_subspaces), dtype=np.uint8)
+            for j, dims in enumerate(subspaces):
+                sub_residuals = np.ascontiguousarray(residuals[:, dims])
+                n_pq = min(sub_residuals.shape[0], 256 * 64)
+                codebook, _ = kmeans(sub_residuals[rng.choice(sub_residuals.shape[0], n_pq, replace=False)], 256,
+                                     self.kmeans_iter, self.r_seed + j + 1)
+                for start in range(0, sub_residuals.shape[0], self.chunk_size):
+                    self.list_codes_[start:start + self.chunk_size, j] = \
+                        squared_distance(sub_residuals[start:start + self.chunk_size], codebook).argmin(axis=1)
+                self.pq_codebooks_.append(codebook)
+            self.pq_subspace_dims_ = [len(dims) for dims in subspaces]
+        else:
+            self.list_vectors_ = list_vectors
+        return self
+
+    def _cell_distance(self, cell, query):
+        # squared distances of the queries probing one cell to all its list members
+        start, stop = self.list_offsets_[cell], self.list_offsets_[cell + 1]
+        if not self.pq_subspaces:
+            return squared_distance(query, self.list_vectors_[start:stop])
+
+        residual = query - self.centroids_[cell]
+        codes = self.list_codes_[start:stop]
+        distance = np.zeros((query.shape[0], stop - start), dtype=np.float32)
+        dim_start = 0
+        for j, codebook in enumerate(self.pq_codebooks_):
+            dim_stop = dim_start + self.pq_subspace_dims_[j]
+            table = squared_distance(residual[:, dim_start:dim_stop], codebook)  # [n_query, 256]
+            distance += table[:, codes[:, j]]
+            dim_start = dim_stop
+        return distance
+
+    def _search(self, query, probe, query_ids=None):
+        # running top-k squared distances of every query over its probed cells,
+        # list entries with the query's own training row id are skipped
+        best = np.full((query.shape[0], self.k), np.inf, dtype=np.float32)
+        probe_query, probe_cell = np.repeat(np.arange(query.shape[0]), probe.shape[1]), probe.ravel()
+        order = np.argsort(probe_cell, kind='stable')
+        probe_query, probe_cell = probe_query[order], probe_cell[order]
+        cells, cell_start = np.unique(probe_cell, return_index=True)
+        for cell, query_index in zip(cells, np.split(probe_query, cell_start[1:])):
+            if self.list_offsets_[cell] == self.list_offsets_[cell + 1]:
+                continue
+            distance = self._cell_distance(cell, query[query_index])
+            if query_ids is not None:
+                cell_ids = self.list_ids_[self.list_offsets_[cell]:self.list_offsets_[cell + 1]]
+                distance[query_ids[query_index][:, None] == cell_ids[None, :]] = np.inf
+            candidate = np.concatenate([best[query_index], distance], axis=1)
+            best[query_index] = np.partition(candidate, self.k - 1, axis=1)[:, :self.k]
+        return best
+
+    def kth_distance(self, data, exclude_self=False):
+        """
+        exclude_self: data is the training matrix in fit order, row i skips
+        training row i
+        """
+        data = self._prepare(data)
+        n_cells = self.centroids_.shape[0]
+        n_probe = min(self.n_probe, n_cells)
+        kth = np.empty(data.shape[0])
+        for start in range(0, data.shape[0], self.chunk_size):
+            query = data[start:start + self.chunk_size]
+            query_ids = np.arange(start, start + query.shape[0]) if exclude_self else None
+            probe = np.argpartition(squared_distance(query, self.centroids_), n_probe - 1, axis=1)[:, :n_probe]
+            best = self._search(query, probe, query_ids)
+
+            # fewer than k candidates in the probed cells: search every cell
+            missing = np.isinf(best).any(axis=1)
+            if missing.any():
+                best[missing] = self._search(query[missing], np.tile(np.arange(n_cells), (missing.sum(), 1)),
+                                             None if query_ids is None else query_ids[missing])
+            kth[start:start + self.chunk_size] = np.sqrt(best.max(axis=1))
+        return kth
+
+    def score_samples(self, data, exclude_self=False):
+        return -self.kth_distance(data, exclude_self)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'centroids': self.centroids_, 'list_offsets': self.list_offsets_, 'list_ids': self.list_ids_}
+        if self.pq_subspaces:
+            arrays['list_codes'] = self.list_codes_
+            arrays.update({'pq_codebook_%d' % j: codebook for j, codebook in enumerate(self.pq_codebooks_)})
+        else:
+            arrays['list_vectors'] = self.list_vectors_
+        meta = {'k': self.k, 'n_cells': self.n_cells, 'n_probe': self.n_probe, 'pq_subspaces': self.pq_subspaces,
+                'normalize': self.normalize, 'kmeans_iter': self.kmeans_iter, 'r_seed': self.r_seed,
+                'chunk_size': self.chunk_size, 'offset': float(self.offset_)}
+        if self.pq_subspaces:
+            meta['pq_subspace_dims'] = self.pq_subspace_dims_
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(k=meta['k'], n_cells=meta['n_cells'], n_probe=meta['n_probe'],
+                       pq_subspaces=meta['pq_subspaces'], normalize=meta['normalize'],
+                       kmeans_iter=meta['kmeans_iter'], r_seed=meta['r_seed'], chunk_size=meta['chunk_size'])
+        detector.centroids_ = arrays['centroids']
+        detector.list_offsets_, detector.list_ids_ = arrays['list_offsets'], arrays['list_ids']
+        if detector.pq_subspaces:
+            detector.list_codes_ = arrays['list_codes']
+            detector.pq_codebooks_ = [arrays['pq_codebook_%d' % j] for j in range(detector.pq_subspaces)]
+            detector.pq_subspace_dims_ = meta['pq_subspace_dims']
+        else:
+            detector.list_vectors_ = arrays['list_vectors']
+        detector.offset_ = meta['offset']
+        return detector
+
+    def save(self, path):
+        """
+        Save the index to one .npz file.
+        """
+        arrays, meta = self.state_dict()
+        np.savez(path, **arrays, meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            arrays = {name: index[name] for name in index.files if name != 'meta'}
+            meta = json.loads(str(index['meta']))
+        return cls.from_state(arrays, meta)
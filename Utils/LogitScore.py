@@ -0,0 +1,112 @@
+import numpy as np
+import torch
+
+import torch.nn.functional as F
+
+from sklearn.metrics import roc_auc_score
+
+
+def msp_score(logits, temperature=1.0):
+    # maximum softmax probability
+    return F.softmax(logits / temperature, dim=1).max(dim=1)[0]
+
+
+def energy_score(logits, temperature=1.0):
+    # negative free energy, T * logsumexp(logits / T)
+    return temperature * torch.logsumexp(logits / temperature, dim=1)
+
+
+def max_logit_score(logits, temperature=1.0):
+    return logits.max(dim=1)[0]
+
+
+LOGIT_SCORERS = {'msp': msp_score, 'energy': energy_score, 'max_logit': max_logit_score}
+
+
+def extract_embeddings(net, data, batch_size=1000, device='cpu', scorers=('msp', 'energy', 'max_logit'),
+                       temperature=1.0):
+    """
+    The Embedding Extraction Function
+    =======================
+    Runs net in eval mode over data batch by batch and computes the
+    zero-fit logit scores of every batch while its logits are still on the
+    device.
+    Input: (net, data)
+        net                     : model returning (logits, hidden), e.g. DLA6
+        data            [tensor]: input images
+        scorers         [list]  : names in LOGIT_SCORERS
+    Output: ((logits, hidden), scores)
+        logits, hidden  [tensor]: same as net(data)
+        scores          [dict]  : {scorer name: [numpy] score per sample},
+                                  higher means more in-distribution
+    """
+    net.eval()
+    logits, hidden = [], []
+    scores = {name: [] for name in scorers}
+    with torch.no_grad():
+        for start in range(0, data.shape[0], batch_size):
+            batch_logits, batch_hidden = net(data[start:start + batch_size].to(device))
+            logits.append(batch_logits)
+            hidden.append(batch_hidden)
+            for name in scorers:
+                scores[name].append(LOGIT_SCORERS[name](batch_logits, temperature).cpu().numpy())
+
+    scores = {name: np.concatenate(score) for name, score in scores.items()}
+    return (torch.cat(logits), torch.cat(hidden)), scores
+
+
+def logit_score_auroc(in_scores, out_scores):
+    """
+    The Logit Score AUROC Function
+    =======================
+    Baseline AUROC of every extraction-pass score, no detector fitting.
+    Input: (in_scores, out_scores)
+        in_scores       [dict]  : scores of in-distribution samples
+        out_scores      [dict]  : scores of outlier samples
+    Output:
+        {scorer name: AUROC}
+    """
+    results = {}
+    for name in in_scores:
+        total_label = np.append(np.ones(in_scores[name].shape[0], dtype=int),
+                                np.zeros(out_scores[name].shape[0], dtype=int) - 1)
+        results[name] = roc_auc_score(total_label, np.append(in_scores[name], out_scores[name]))
+        print(name, 'AUROC Score:', results[name])
+    return results
+
+
+class LogitDetector:
+    """
+    The Logit Score Detector
+    =======================
+    MSP, energy or max-logit score as a detector: fit() has nothing to learn,
+    offset_ is set by Utils.Detectors.fit_detector from the training scores.
+    Expects raw logits; on softmax outputs only 'msp' keeps its meaning.
+    """
+
+    def __init__(self, score='msp', temperature=1.0):
+        self.score = score
+        self.temperature = temperature
+        self.offset_ = 0.0
+
+    def fit(self, train_data, train_label=None):
+        return self
+
+    def score_samples(self, data):
+        return LOGIT_SCORERS[self.score](torch.as_tensor(np.asarray(data, dtype=np.float32)),
+                                         self.temperature).numpy().astype(np.float64)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        return {}, {'score': self.score, 'temperature': self.temperature, 'offset': float(self.offset_)}
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(score=meta['score'], temperature=meta['temperature'])
+        detector.offset_ = meta['offset']
+        return detector
@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.linalg import solve_triangular
+
+
+class MahalanobisDetector:
+    """
+    The Mahalanobis Detector
+    =======================
+    Class-conditional Gaussians with one shared covariance, fitted on the
+    embeddings and the (predicted) labels of the training dataset. The
+    covariance is whitened once through its Cholesky factor, so scoring is a
+    batched matmul and the minimum squared distance over all class means.
+        score_samples = -min_k (x - mu_k)^T Sigma^-1 (x - mu_k)
+    Same predict/decision_function/score_samples interface as
+    IsolationForest, offset_ is set by Utils.Detectors.fit_detector.
+    """
+
+    def __init__(self, reg=1e-6, chunk_size=8192):
+        self.reg = reg
+        self.chunk_size = chunk_size
+        self.offset_ = 0.0
+
+    def fit(self, train_data, train_label=None):
+        train_data = np.asarray(train_data, dtype=np.float64)
+        if train_label is None:
+            train_label = np.zeros(train_data.shape[0], dtype=int)
+        self.classes_, class_index = np.unique(np.asarray(train_label), return_inverse=True)
+
+        # per-class means via one scatter-add
+        n_classes, n_features = self.classes_.shape[0], train_data.shape[1]
+        class_count = np.bincount(class_index, minlength=n_classes)
+        means = np.zeros((n_classes, n_features))
+        np.add.at(means, class_index, train_data)
+        means /= class_count[:, None]
+
+        # shared within-class covariance, accumulated chunk by chunk
+        covariance = np.zeros((n_features, n_features))
+        for start in range(0, train_data.shape[0], self.chunk_size):
+            centered = train_data[start:start + self.chunk_size] - means[class_index[start:start + self.chunk_size]]
+            covariance += centered.T @ centered
+        covariance /= train_data.shape[0]
+        covariance += self.reg * max(np.trace(covariance) / n_features, 1e-12) * np.eye(n_features)
+
+        # Sigma = L L^T  ->  (x - mu)^T Sigma^-1 (x - mu) = ||(x - mu) L^-T||^2
+        cholesky = np.linalg.cholesky(covariance)
+        self.whitening_ = solve_triangular(cholesky, np.eye(n_features), lower=True).T
+        self.whitened_means_ = means @ self.whitening_
+        return self
+
+    def min_distance(self, data):
+        """
+        Output: (distance, class) squared Mahalanobis distance to, and index of, the closest class mean
+        """
+        data = np.asarray(data, dtype=np.float64)
+        distance = np.empty(data.shape[0])
+        closest = np.empty(data.shape[0], dtype=int)
+        means_norm = (self.whitened_means_ ** 2).sum(axis=1)
+        for start in range(0, data.shape[0], self.chunk_size):
+            whitened = data[start:start + self.chunk_size] @ self.whitening_
+            class_distance = (whitened ** 2).sum(axis=1)[:, None] - 2 * whitened @ self.whitened_means_.T \
+                + means_norm[None, :]
+            closest[start:start + self.chunk_size] = class_distance.argmin(axis=1)
+            distance[start:start + self.chunk_size] = class_distance.min(axis=1)
+        return np.maximum(distance, 0), self.classes_[closest]
+
+    def score_samples(self, data):
+        return -self.min_distance(data)[0]
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'classes': self.classes_, 'whitening': self.whitening_, 'whitened_means': self.whitened_means_}
+        meta = {'reg': self.reg, 'chunk_size': self.chunk_size, 'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(reg=meta['reg'], chunk_size=meta['chunk_size'])
+        detector.classes_ = arrays['classes']
+        detector.whitening_ = arrays['whitening']
+        detector.whitened_means_ = arrays['whitened_means']
+        detector.offset_ = meta['offset']
+        return detector
@@ -0,0 +1,155 @@
+import numpy as np
+
+
+def class_distance(data, means, distance_type='eucos'):
+    """
+    Distance of every sample to every class mean activation vector.
+    Input: (data [n, K], means [K, K])  Output: [n, K]
+    """
+    euclidean = np.sqrt(np.maximum((data ** 2).sum(axis=1)[:, None] - 2 * data @ means.T
+                                   + (means ** 2).sum(axis=1)[None, :], 0))
+    if distance_type == 'euclidean':
+        return euclidean
+    cosine = 1 - (data @ means.T) / np.maximum(np.linalg.norm(data, axis=1)[:, None]
+                                                * np.linalg.norm(means, axis=1)[None, :], 1e-12)
+    # OpenMax 'eucos' distance
+    return euclidean / 200.0 + cosine
+
+
+def fit_weibull(tail, mask, n_iter=100):
+    """
+    Maximum-likelihood two-parameter Weibull fit of every row of tail at once,
+    Newton iterations on the shape parameter.
+    Input: (tail [K, T] positive values, mask [K, T] valid entries)
+    Output: (shape [K], scale [K])
+    """
+    # scale-free fit on tail / max, the scale is multiplied back at the end
+    tail_max = np.where(mask, tail, 0).max(axis=1, keepdims=True)
+    x = np.where(mask, tail / tail_max, 1.0)
+    log_x = np.log(np.maximum(x, 1e-12))
+    n_tail = mask.sum(axis=1)
+    mean_log_x = np.where(mask, log_x, 0).sum(axis=1) / n_tail
+
+    shape = np.ones(tail.shape[0])
+    for _ in range(n_iter):
+        x_k = np.where(mask, x ** shape[:, None], 0)
+        s0, s1, s2 = x_k.sum(axis=1), (x_k * log_x).sum(axis=1), (x_k * log_x ** 2).sum(axis=1)
+        gradient = s1 / s0 - 1 / shape - mean_log_x
+        hessian = (s2 * s0 - s1 ** 2) / s0 ** 2 + 1 / shape ** 2
+        shape = np.clip(shape - gradient / hessian, 1e-3, 1e3)
+
+    scale = (np.where(mask, x ** shape[:, None], 0).sum(axis=1) / n_tail) ** (1 / shape)
+    return shape, scale * tail_max[:, 0]
+
+
+class OpenMaxDetector:
+    """
+    The OpenMax Detector
+    =======================
+    EVT calibration of the logits (Bendale & Boult, 2016), vectorized over
+    classes and samples:
+        fit             : mean activation vector (MAV) per class from the
+                          correctly classified training logits, Weibull fit
+                          to the tailsize largest distances to each MAV
+        score           : the top alpha logits are scaled down by their
+                          Weibull CDF, the removed mass becomes an explicit
+                          "unknown" logit, softmax over K + 1 classes
+        score_samples = -P(unknown)
+    The open-set decision is the argmax over the K + 1 probabilities
+    (predict_labels: class label, -1 when "unknown" wins), also used by
+    predict() and Utils.ScoreFusion.open_set_labels; offset_ (the
+    contamination percentile) only shifts the scores used for the AUROC.
+    "Correctly classified" needs the true training labels; the outlier
+    pipelines (Utils.Detectors.fit_detector) only pass the predicted ones,
+    so there every training sample counts and the MAVs are the means over
+    each predicted class.
+    """
+
+    def __init__(self, tailsize=20, alpha=3, distance_type='eucos'):
+        self.tailsize = tailsize
+        self.alpha = alpha
+        self.distance_type = distance_type
+        self.offset_ = 0.0
+
+    def fit(self, train_data, train_label=None):
+        train_data = np.asarray(train_data, dtype=np.float64)
+        n_classes = train_data.shape[1]
+        prediction = train_data.argmax(axis=1)
+        train_label = prediction if train_label is None else np.asarray(train_label).astype(int)
+        correct = prediction == train_label
+        data, label = train_data[correct], train_label[correct]
+
+        # **************** mean activation vectors **************** #
+        count = np.bincount(label, minlength=n_classes)
+        self.means_ = np.zeros((n_classes, n_classes))
+        np.add.at(self.means_, label, data)
+        self.means_ /= np.maximum(count, 1)[:, None]
+
+        # **************** tail distances per class **************** #
+        distance = class_distance(data, self.means_, self.distance_type)[np.arange(data.shape[0]), label]
+        order = np.lexsort((distance, label))
+        class_end = np.cumsum(count)
+        rank_from_end = class_end[label[order]] - 1 - np.arange(order.shape[0])
+        in_tail = rank_from_end < self.tailsize
+        tail = np.zeros((n_classes, self.tailsize))
+        mask = np.zeros((n_classes, self.tailsize), dtype=bool)
+        tail[label[order][in_tail], rank_from_end[in_tail]] = distance[order][in_tail]
+        mask[label[order][in_tail], rank_from_end[in_tail]] = True
+        mask &= tail > 0
+
+        # classes without a tail are never recalibrated (infinite scale, CDF 0)
+        has_tail = mask.any(axis=1)
+        self.weibull_shape_, self.weibull_scale_ = np.ones(n_classes), np.full(n_classes, np.inf)
+        self.weibull_shape_[has_tail], self.weibull_scale_[has_tail] = fit_weibull(tail[has_tail], mask[has_tail])
+        return self
+
+    def predict_proba(self, data):
+        """
+        Output: [n, K + 1] OpenMax probabilities, column 0 is "unknown"
+        """
+        data = np.asarray(data, dtype=np.float64)
+        n_classes = data.shape[1]
+        distance = class_distance(data, self.means_, self.distance_type)
+        weibull_cdf = 1 - np.exp(-(distance / self.weibull_scale_[None, :]) ** self.weibull_shape_[None, :])
+
+        # alpha weights (alpha - rank) / alpha on the top alpha logits
+        rank = np.argsort(np.argsort(-data, axis=1), axis=1)
+        alpha = min(self.alpha, n_classes)
+        alpha_weight = np.clip((alpha - rank) / alpha, 0, None)
+
+        revised = data * (1 - alpha_weight * weibull_cdf)
+        unknown = (data - revised).sum(axis=1, keepdims=True)
+        logits = np.concatenate([unknown, revised], axis=1)
+        logits -= logits.max(axis=1, keepdims=True)
+        probability = np.exp(logits)
+        return probability / probability.sum(axis=1, keepdims=True)
+
+    def predict_labels(self, data):
+        """
+        Output: class label per sample, -1 when "unknown" is the most likely class
+        """
+        return self.predict_proba(data).argmax(axis=1) - 1
+
+    def score_samples(self, data):
+        return -self.predict_proba(data)[:, 0]
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.predict_labels(data) == -1, -1, 1)
+
+    def state_dict(self):
+        arrays = {'means': self.means_, 'weibull_shape': self.weibull_shape_, 'weibull_scale': self.weibull_scale_}
+        meta = {'tailsize': self.tailsize, 'alpha': self.alpha, 'distance_type': self.distance_type,
+                'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(tailsize=meta['tailsize'], alpha=meta['alpha'], distance_type=meta['distance_type'])
+        detector.means_ = arrays['means']
+        detector.weibull_shape_ = arrays['weibull_shape']
+        detector.weibull_scale_ = arrays['weibull_scale']
+        detector.offset_ = meta['offset']
+        return detector
@@ -0,0 +1,215 @@
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from numpy.lib.format import open_memmap
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+
+
+def load_embeddings(data):
+    """
+    Embeddings as a numpy array without copying memory-mapped files:
+    a .npy path is opened with mmap_mode='r', a tensor is moved to the CPU,
+    arrays (and np.memmap) pass through.
+    """
+    if isinstance(data, (str, os.PathLike)):
+        return np.load(data, mmap_mode='r')
+    if hasattr(data, 'cpu'):
+        return data.cpu().numpy()
+    return data
+
+
+def read_rows(data, index):
+    """
+    Rows index (a slice or indices) of data as a float32 array. Rows of a
+    memory-mapped file are read with pread instead of through the mapping:
+    page-cache pages touched through a mapping count towards the process RSS
+    (and fault-around maps their neighbours too), rows read into a buffer
+    leave nothing behind. Indices are sorted and each run of contiguous rows
+    is one pread; the rows come back in the order of index.
+    """
+    if not (isinstance(data, np.memmap) and data.filename is not None and data.flags.c_contiguous):
+        return np.asarray(data[index], dtype=np.float32)
+    row_bytes = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+    with open(data.filename, 'rb') as file:
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(data.shape[0])
+            buffer = os.pread(file.fileno(), (stop - start) * row_bytes, data.offset + start * row_bytes)
+            order = None
+        else:
+            index = np.asarray(index, dtype=np.int64)
+            order = np.argsort(index, kind='stable')
+            rows = index[order]
+            # a run starts wherever the next row is not the previous one + 1
+            run_start = np.flatnonzero(np.diff(rows, prepend=rows[:1] - 2) != 1)
+            run_stop = np.append(run_start[1:], rows.shape[0])
+            buffer = b''.join([os.pread(file.fileno(), int(rows[stop - 1] - rows[start] + 1) * row_bytes,
+                                        data.offset + int(rows[start]) * row_bytes)
+                               for start, stop in zip(run_start, run_stop)])
+    rows_read = np.frombuffer(buffer, dtype=data.dtype).reshape((-1,) + data.shape[1:])
+    if order is not None:
+        # back from sorted to requested order
+        rows_read = rows_read[np.argsort(order, kind='stable')]
+    return rows_read.astype(np.float32, copy=False)
+
+
+def argmax_rows(data, chunk_size=65536):
+    """
+    Row-wise argmax of data read chunk by chunk with read_rows, so the
+    predicted labels of memory-mapped logits do not map the whole file.
+    """
+    return np.concatenate([read_rows(data, slice(start, start + chunk_size)).argmax(axis=1)
+                           for start in range(0, data.shape[0], chunk_size)]) \
+        if data.shape[0] else np.zeros(0, dtype=np.int64)
+
+
+def score_memmap(detector, data, out_path=None, chunk_size=65536, method='decision_function'):
+    """
+    The Streamed Scoring Function
+    =======================
+    Scores data chunk by chunk and writes the scores into a memory-mapped
+    .npy file, so neither the embeddings nor the scores have to fit in RAM.
+    Input: (detector, data, out_path)
+        data     [numpy/memmap] : embeddings, [n_samples, n_features]
+        out_path                : output .npy file; if None an anonymous
+                                  temporary file, removed once unmapped
+    Output:
+        np.memmap of n_samples float64 scores
+    """
+    temporary = out_path is None
+    if temporary:
+        handle, out_path = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+    score = open_memmap(out_path, mode='w+', dtype=np.float64, shape=(data.shape[0],))
+    if temporary:
+        # the mapping keeps the unlinked file alive
+        os.remove(out_path)
+    scorer = getattr(detector, method)
+    for start in range(0, data.shape[0], chunk_size):
+        score[start:start + chunk_size] = scorer(read_rows(data, slice(start, start + chunk_size)))
+        score.flush()
+    return score
+
+
+class MemmapIsolationForest:
+    """
+    The Out-of-Core Isolation Forest
+    =======================
+    An IsolationForest fitted from a memory-mapped embedding file without
+    loading it:
+        fit             : every tree draws its own max_samples random row
+                          indices (seeded from one SeedSequence), only these
+                          rows are read from the file and one sklearn tree
+                          is fitted on them; the trees are packed into a
+                          FlatIsolationForest, so scoring is the batched
+                          NumPy traversal
+        offset_         : contamination percentile of the scores of an
+                          offset_samples random subsample of the training
+                          rows (all rows if offset_samples is None)
+    Peak memory is one subsample, one 65536-row offset chunk and the packed
+    trees, whatever the number of training rows. The trees equal those of an
+    IsolationForest fitted in memory up to the sampling of the subsamples.
+    """
+
+    def __init__(self, r_seed=0, n_estimators=1000, max_samples=10000, contamination=0.01, offset_samples=100000,
+                 verbose=0):
+        self.r_seed = r_seed
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.contamination = contamination
+        self.offset_samples = offset_samples
+        self.verbose = verbose
+        self.offset_ = 0.0
+
+    def _sample_index(self, seed, n_samples, n_sub):
+        return np.sort(np.random.RandomState(seed).choice(n_samples, n_sub, replace=False))
+
+    def fit(self, train_data, train_label=None):
+        train_data = load_embeddings(train_data)
+        n_samples = train_data.shape[0]
+        n_sub = int(self.max_samples * n_samples) if isinstance(self.max_samples, float) \
+            else min(self.max_samples, n_samples)
+        seeds = [int(seed.generate_state(1)[0])
+                 for seed in np.random.SeedSequence(self.r_seed).spawn(self.n_estimators + 1)]
+
+        trees = []
+        for i, seed in enumerate(seeds[:-1]):
+            subsample = read_rows(train_data, self._sample_index(seed, n_samples, n_sub))
+            tree = IsolationForest(n_estimators=1, max_samples=n_sub, random_state=seed, contamination='auto')
+            trees.append(FlatIsolationForest.from_sklearn(tree.fit(subsample)))
+            if self.verbose and (i + 1) % 100 == 0:
+                print('===> Out-of-core forest: %d / %d trees' % (i + 1, self.n_estimators))
+        self.forest_ = FlatIsolationForest.merge(trees)
+
+        offset_index = np.arange(n_samples) if self.offset_samples is None or self.offset_samples >= n_samples \
+            else self._sample_index(seeds[-1], n_samples, self.offset_samples)
+        offset_score = np.concatenate([
+            self.forest_.score_samples(read_rows(train_data, offset_index[start:start + 65536]))
+            for start in range(0, offset_index.shape[0], 65536)])
+        self.offset_ = np.percentile(offset_score, 100.0 * self.contamination)
+        return self
+
+    def score_samples(self, data):
+        return self.forest_.score_samples(data)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays, forest_meta = self.forest_.state_dict()
+        meta = {'r_seed': self.r_seed, 'n_estimators': self.n_estimators, 'max_samples': self.max_samples,
+                'contamination': self.contamination, 'offset_samples': self.offset_samples,
+                'verbose': self.verbose, 'offset': float(self.offset_), 'forest': forest_meta}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(r_seed=meta['r_seed'], n_estimators=meta['n_estimators'], max_samples=meta['max_samples'],
+                       contamination=meta['contamination'], offset_samples=meta['offset_samples'],
+                       verbose=meta['verbose'])
+        detector.forest_ = FlatIsolationForest.from_state(arrays, meta['forest'])
+        detector.offset_ = meta['offset']
+        return detector
+
+
+def test(n_samples=200000, n_features=256, n_estimators=100):
+    """
+    Fits and scores a forest from a .npy file larger than the subsamples
+    and reports the peak RSS next to the file size.
+    """
+    from sklearn.metrics import roc_auc_score
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'train.npy')
+    header_size = open_memmap(path, mode='w+', dtype=np.float32, shape=(n_samples, n_features)).offset
+    rng = np.random.RandomState(0)
+    with open(path, 'r+b') as train_file:
+        train_file.seek(header_size)
+        for start in range(0, n_samples, 65536):
+            rng.randn(min(65536, n_samples - start), n_features).astype(np.float32).tofile(train_file)
+
+    start_time = time.time()
+    detector = MemmapIsolationForest(n_estimators=n_estimators, max_samples=10000).fit(path)
+    fit_time = time.time() - start_time
+    start_time = time.time()
+    train_score = score_memmap(detector, load_embeddings(path), os.path.join(folder, 'train_score.npy'))
+    score_time = time.time() - start_time
+
+    test_data = np.concatenate([rng.randn(2000, n_features), rng.randn(2000, n_features) * 1.5]).astype(np.float32)
+    test_label = np.append(np.ones(2000), -np.ones(2000))
+    print('file %.0f MB  fit %.1fs  score %.1fs  peak RSS %.0f MB  training outlier rate %.4f  AUROC %.4f' % (
+        os.path.getsize(path) / 2 ** 20, fit_time, score_time,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, (train_score < 0).mean(),
+        roc_auc_score(test_label, detector.decision_function(test_data))))
+
+
+if __name__ == '__main__':
+    test()
@@ -1,19 +1,31 @@
 import numpy as np
 
-from sklearn.metrics import f1_score
-from sklearn.ensemble import IsolationForest
+from sklearn.metrics import f1_score, roc_auc_score
+
+from Utils.ClassConditional import ClassConditionalDetector
+from Utils.Coreset import select_coreset
+from Utils.Detectors import LOGIT_DETECTORS, build_detector, decision_scores, fit_detector, load_detectors, \
+    place_offset, save_detectors
+from Utils.EnsembleRunner import EnsembleRunner
+from Utils.OutOfCore import MemmapIsolationForest, argmax_rows, load_embeddings, score_memmap
+from Utils.ParallelFit import BLOCK_SIZE, fit_forests_parallel
+from Utils.Projection import apply_projections, fit_projections
+from Utils.ScoreFusion import ScoreFusion
 
 
 def OutlierDetection(train_data_last_layer, train_data_hidden,
                      test_data_last_layer, test_data_hidden, test_data_label,
                      abnormal_datasets_name, abnormal_datasets,
                      sample_size=10000, r_seed=0, n_estimators=1000, verbose=0,
-                     max_samples=10000, contamination=0.01):
+                     max_samples=10000, contamination=0.01, flat_scorer=True, n_jobs=None,
+                     detector_store=None, detector='iforest', fusion='vote', projection=None, coreset=None,
+                     coreset_method='kcenter', class_conditional=False, out_of_core=False,
+                     ensemble=None, shard_size=None):
     """
     The Outlier Detection Function
     =======================
     Input: (train_data, test_data, outlier_data)
-        train_data      [tensor]: embeded training dataset
+        train_data      [tensor]: embeded training dataset (or np.memmap / .npy path)
         test_data       [tensor]: embeded testing dataset
         test_data_label [tensor]: label of testing dataset
 
@@ -22,6 +34,34 @@ def OutlierDetection(train_data_last_layer, train_data_hidden,
         outlier_dataset [tensor]: embeded outlier datasets
             [outlier_dataset_1_last_layer, outlier_dataset_1_data_hidden, ... ]
 
+        flat_scorer             : score with FlatIsolationForest (batched NumPy
+                                  traversal) instead of sklearn's per-tree walk
+        n_jobs                  : fit both detectors and their tree blocks in
+                                  a process pool over shared-memory embeddings
+        detector_store          : Utils.DetectorStore, reuse detectors fitted
+                                  on the same checkpoint/split/hyperparameters
+        detector                : detector name, see Utils.Detectors.build_detector
+        fusion                  : layer score fusion, see Utils.ScoreFusion
+        projection      [dict]  : per-layer reduction before the detector,
+                                  e.g. {'hidden': ('pca', 64)}, see Utils.Projection
+        coreset                 : fit the detectors on a coreset of this many
+                                  training samples (fraction if < 1), see Utils.Coreset
+        coreset_method          : 'kcenter' or 'stratified'
+        class_conditional       : one detector per predicted class, fitted in
+                                  parallel (n_jobs), see Utils.ClassConditional
+        out_of_core             : fit the forests from memory-mapped training
+                                  embeddings by per-tree random row reads and
+                                  stream the training scores into memory-mapped
+                                  files, see Utils.OutOfCore ('iforest' only)
+        ensemble        [list]  : also fit these detectors side by side on the
+                                  same embeddings (threads / processes, n_jobs)
+                                  and report each one's AUROC and their rank
+                                  average, see Utils.EnsembleRunner; detector
+                                  itself reuses the fit above
+        shard_size              : fit 'iforest' as seeded blocks of this many
+                                  trees (BLOCK_SIZE if None and n_jobs > 1),
+                                  the forest does not depend on n_jobs, see
+                                  Utils.ParallelFit; off by default
     data type:
     """
 
@@ -30,44 +70,104 @@ def OutlierDetection(train_data_last_layer, train_data_hidden,
     # build outlier detection model
     print('===> Outlier detector: starting')
     print('===> Parameter setting threshold:', contamination)
-    outlier_detector_last_layer = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose,
-                                                  max_samples=max_samples, contamination=contamination)
-    outlier_detector_hidden = IsolationForest(random_state=r_seed, n_estimators=n_estimators, verbose=verbose, max_samples=max_samples,
-                                              contamination=contamination)
-
-    train_data_last_layer = train_data_last_layer.cpu().numpy()
-    train_data_hidden = train_data_hidden.cpu().numpy()
+    outlier_detector_last_layer = build_detector(detector, r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                                 max_samples=max_samples, contamination=contamination, n_jobs=n_jobs)
+    outlier_detector_hidden = build_detector(detector, r_seed=r_seed, n_estimators=n_estimators, verbose=verbose,
+                                             max_samples=max_samples, contamination=contamination, n_jobs=n_jobs)
+    if class_conditional:
+        outlier_detector_last_layer, outlier_detector_hidden = [
+            ClassConditionalDetector(detector, n_jobs=n_jobs, r_seed=r_seed, n_estimators=n_estimators,
+                                     max_samples=max_samples, contamination=contamination, flat_scorer=flat_scorer)
+            for _ in range(2)]
+
+    train_data_last_layer = load_embeddings(train_data_last_layer)
+    train_data_hidden = load_embeddings(train_data_hidden)
+    if detector in LOGIT_DETECTORS:
+        # logit scores only read the logits: the hidden slot scores the last layer too
+        train_data_hidden = train_data_last_layer
+    # predicted labels for the class-conditional detectors, chunk by chunk for memory-mapped logits
+    train_label = argmax_rows(train_data_last_layer)
 
     print('===> outlier detector:training')
     # data argument
-    outlier_detector_last_layer.fit(train_data_last_layer)
-    outlier_detector_hidden.fit(train_data_hidden)
+    layer_names = ['last_layer', 'hidden']
+    projections = fit_projections(detector_store, layer_names, [train_data_last_layer, train_data_hidden],
+                                  projection, r_seed)
+    train_input_last_layer, train_input_hidden = apply_projections(projections,
+                                                                   [train_data_last_layer, train_data_hidden])
+    hyperparams = dict(detector=detector, r_seed=r_seed, n_estimators=n_estimators, max_samples=max_samples,
+                       flat_scorer=flat_scorer)
+    if projection:
+        hyperparams['projection'] = projection
+    if coreset:
+        hyperparams.update(coreset=coreset, coreset_method=coreset_method)
+    if class_conditional:
+        # the per-class offsets are placed at fit time
+        hyperparams.update(class_conditional=True, fit_contamination=contamination)
+    if out_of_core:
+        if detector != 'iforest' or projection or coreset or class_conditional:
+            raise ValueError('out_of_core supports the plain iforest detector only')
+        # offset_ comes from a row sample at fit time
+        hyperparams.update(out_of_core=True, fit_contamination=contamination)
+    sharded = detector == 'iforest' and not (class_conditional or out_of_core) and \
+        (shard_size is not None or (n_jobs is not None and n_jobs > 1))
+    if sharded:
+        shard_size = shard_size or BLOCK_SIZE
+        hyperparams['shard_size'] = shard_size
+    fitted = load_detectors(detector_store, layer_names, contamination, **hyperparams)
+    if fitted is not None:
+        (outlier_detector_last_layer, train_score_last_layer), (outlier_detector_hidden, train_score_hidden) = fitted
+    else:
+        fit_index = select_coreset(train_input_hidden, coreset, coreset_method, train_label, r_seed) \
+            if coreset else slice(None)
+        if out_of_core:
+            outlier_detector_last_layer, outlier_detector_hidden = [
+                MemmapIsolationForest(r_seed, n_estimators, max_samples, contamination, verbose=verbose).fit(data)
+                for data in (train_data_last_layer, train_data_hidden)]
+            train_score_last_layer = score_memmap(outlier_detector_last_layer, train_data_last_layer)
+            train_score_hidden = score_memmap(outlier_detector_hidden, train_data_hidden)
+        elif sharded:
+            (outlier_detector_last_layer, train_score_last_layer), (outlier_detector_hidden, train_score_hidden) = \
+                fit_forests_parallel([train_input_last_layer[fit_index], train_input_hidden[fit_index]],
+                                     contamination, n_jobs=n_jobs or 1, r_seed=r_seed, n_estimators=n_estimators,
+                                     max_samples=max_samples, block_size=shard_size, flat_scorer=flat_scorer,
+                                     verbose=verbose)
+        else:
+            outlier_detector_last_layer, train_score_last_layer = fit_detector(
+                outlier_detector_last_layer, train_input_last_layer[fit_index], contamination, flat_scorer,
+                train_label[fit_index])
+            outlier_detector_hidden, train_score_hidden = fit_detector(
+                outlier_detector_hidden, train_input_hidden[fit_index], contamination, flat_scorer,
+                train_label[fit_index])
+        if coreset:
+            # offsets from the scores of the full training set, as without a coreset
+            train_score_last_layer = place_offset(outlier_detector_last_layer, decision_scores(
+                outlier_detector_last_layer, train_input_last_layer, train_label), contamination)
+            train_score_hidden = place_offset(outlier_detector_hidden, decision_scores(
+                outlier_detector_hidden, train_input_hidden, train_label), contamination)
+        save_detectors(detector_store, layer_names,
+                       [(outlier_detector_last_layer, train_score_last_layer),
+                        (outlier_detector_hidden, train_score_hidden)], **hyperparams)
+
+    fusion_engine = ScoreFusion([outlier_detector_last_layer, outlier_detector_hidden], fusion=fusion,
+                                contamination=contamination)
+    train_scores = np.stack([train_score_last_layer, train_score_hidden])
+    fusion_engine.fit(train_scores)
 
     print('===> outlier dataset prediction')
-    # outlier predict
-    outlier_train_hidden = outlier_detector_hidden.predict(train_data_hidden)
-    outlier_train_last_layer = outlier_detector_last_layer.predict(train_data_last_layer)
-    outlier_train = outlier_train_last_layer + outlier_train_hidden
+    # outlier predict: reuse the scores of the fitting pass
+    outlier_train = fusion_engine.open_set_labels(train_scores, train_data_last_layer)
 
     # **************** Tensor2numpy **************** #
-    test_data_last_layer = test_data_last_layer.cpu().numpy()
-    test_data_hidden = test_data_hidden.cpu().numpy()
-
-    outlier_test_hidden = outlier_detector_hidden.predict(test_data_hidden)
-    outlier_test_last_layer = outlier_detector_last_layer.predict(test_data_last_layer)
-    outlier_test = outlier_test_last_layer + outlier_test_hidden
-
+    test_data_last_layer = load_embeddings(test_data_last_layer)
+    test_data_hidden = load_embeddings(test_data_hidden)
+    if detector in LOGIT_DETECTORS:
+        test_data_hidden = test_data_last_layer
 
     # **************** outlier predict final **************** #
-    outlier_train[outlier_train <= 1] = -1
-    outlier_train[outlier_train > 1] = 0
-    outlier_train[outlier_train == 0] = \
-        train_data_last_layer.argmax(axis=1)[outlier_train == 0]
-
-    outlier_test[outlier_test <= 1] = -1
-    outlier_test[outlier_test > 1] = 0
-    outlier_test[outlier_test == 0] = \
-        test_data_last_layer.argmax(axis=1)[outlier_test == 0]
+    test_scores = fusion_engine.layer_scores(apply_projections(projections, [test_data_last_layer, test_data_hidden]),
+                                             label=argmax_rows(test_data_last_layer))
+    outlier_test = fusion_engine.open_set_labels(test_scores, test_data_last_layer)
 
 
     # **************** Print predict result **************** #
@@ -76,29 +176,28 @@ def OutlierDetection(train_data_last_layer, train_data_hidden,
 
 
     num_of_datasets = len(abnormal_datasets_name)
+    eval_scores = [test_scores]
     for i in range(num_of_datasets):
         # **************** Tensor2numpy **************** #
-        abnormal_datasets_last_layer = abnormal_datasets[2*i].cpu().numpy()
-        abnormal_datasets_hidden = abnormal_datasets[2*i+1].cpu().numpy()
-
-
-        outlier_datasets_last_layer = outlier_detector_last_layer.predict(abnormal_datasets_last_layer)
-        outlier_datasets_hidden = outlier_detector_hidden.predict(abnormal_datasets_hidden)
-        outlier_datasets_sum = outlier_datasets_last_layer + outlier_datasets_hidden
+        abnormal_datasets_last_layer = load_embeddings(abnormal_datasets[2*i])
+        abnormal_datasets_hidden = load_embeddings(abnormal_datasets[2*i+1])
+        if detector in LOGIT_DETECTORS:
+            abnormal_datasets_hidden = abnormal_datasets_last_layer
 
 
         # **************** outlier predict final **************** #
-        outlier_datasets_sum[outlier_datasets_sum <= 1] = -1
-        outlier_datasets_sum[outlier_datasets_sum > 1] = 0
-        outlier_datasets_sum[outlier_datasets_sum == 0] = \
-            abnormal_datasets_last_layer.argmax(axis=1)[outlier_datasets_sum == 0]
+        abnormal_scores = fusion_engine.layer_scores(
+            apply_projections(projections, [abnormal_datasets_last_layer, abnormal_datasets_hidden]),
+            label=argmax_rows(abnormal_datasets_last_layer))
+        outlier_datasets_sum = fusion_engine.open_set_labels(abnormal_scores, abnormal_datasets_last_layer)
+        eval_scores.append(abnormal_scores)
 
         # **************** Print predict result **************** #
         print(abnormal_datasets_name[i], ' outlier detection rate:',
               (outlier_datasets_sum == -1).sum() / outlier_datasets_sum.shape[0])
 
         # **************** F1 Score result **************** #
-        base_pred = test_data_last_layer.argmax(axis=1)
+        base_pred = argmax_rows(test_data_last_layer)
         base_pred[outlier_test == -1] = -1
 
         # total 20000 samples: 10000 cifar10, 10000 other samples
@@ -111,5 +210,28 @@ def OutlierDetection(train_data_last_layer, train_data_hidden,
 
         print(abnormal_datasets_name[i], 'detection f1 score:', outlier_datasets_f1)
 
+    if ensemble:
+        # test and outlier rows as the blocks of one evaluation buffer per layer
+        eval_sets = [(test_data_last_layer, test_data_hidden)] + [
+            (load_embeddings(abnormal_datasets[2*i]), load_embeddings(abnormal_datasets[2*i+1]))
+            for i in range(num_of_datasets)]
+        eval_size = np.cumsum([0] + [last_layer.shape[0] for last_layer, _ in eval_sets])
+        # the detectors fitted above are not fitted again
+        eval_scores = np.concatenate(eval_scores, axis=1)
+        fitted_scores = {detector + '/last_layer': (train_score_last_layer, eval_scores[0]),
+                         detector + '/hidden': (train_score_hidden, eval_scores[1])}
+        runner = EnsembleRunner(ensemble, n_jobs=n_jobs, r_seed=r_seed, n_estimators=n_estimators,
+                                max_samples=max_samples, contamination=contamination, flat_scorer=flat_scorer)
+        ensemble_scores, _ = runner.run(
+            {'last_layer': train_data_last_layer, 'hidden': train_data_hidden},
+            {'last_layer': [last_layer for last_layer, _ in eval_sets], 'hidden': [hidden for _, hidden in eval_sets]},
+            train_label, np.concatenate([argmax_rows(last_layer) for last_layer, _ in eval_sets]), fitted_scores)
+        for name, score in ensemble_scores.items():
+            for i in range(num_of_datasets):
+                abnormal_score = score[eval_size[i + 1]:eval_size[i + 2]]
+                total_label = np.append(np.ones(eval_size[1]), -np.ones(abnormal_score.shape[0]))
+                print(abnormal_datasets_name[i], name, 'AUROC Score:',
+                      roc_auc_score(total_label, np.append(score[:eval_size[1]], abnormal_score)))
+
     print('End')
 
@@ -0,0 +1,173 @@
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+
+# trees per seeded block of a forest fitted in blocks (tree_blocks)
+BLOCK_SIZE = 50
+
+
+class SharedArray:
+    """
+    A numpy array living in one shared-memory block. Workers attach to it by
+    name instead of receiving a pickled copy of the embeddings.
+    """
+
+    def __init__(self, data):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        self._allocate(data.shape)
+        self.array[:] = data
+
+    def _allocate(self, shape):
+        self.shape, self.dtype = tuple(shape), np.dtype(np.float32).str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * 4, 1))
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """
+        Blocks stacked along the first axis, copied straight into the shared
+        block without an intermediate concatenated array.
+        """
+        shared = cls.__new__(cls)
+        shared._allocate((sum(block.shape[0] for block in blocks),) + tuple(blocks[0].shape[1:]))
+        start = 0
+        for block in blocks:
+            shared.array[start:start + block.shape[0]] = block
+            start += block.shape[0]
+        return shared
+
+    @property
+    def handle(self):
+        return self.shm.name, self.shape, self.dtype
+
+    @property
+    def array(self):
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_shared_array(handle):
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def process_pool(n_jobs):
+    # fork keeps the (unguarded) experiment scripts from being re-run in workers
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=n_jobs, mp_context=context)
+
+
+def fit_tree_block(train_data, n_trees, seed, max_samples, flat_scorer=True, verbose=0):
+    """
+    One seeded block of a forest fitted in blocks (tree_blocks): n_trees
+    sklearn trees, packed into a FlatIsolationForest if flat_scorer. Both the
+    process pool here and Utils.ShardedForest fit their blocks with it.
+    """
+    forest = IsolationForest(random_state=seed, n_estimators=n_trees, max_samples=max_samples,
+                             contamination='auto', verbose=verbose).fit(train_data)
+    return FlatIsolationForest.from_sklearn(forest) if flat_scorer else forest
+
+
+def _fit_forest_block(handle, n_estimators, max_samples, seed, flat_scorer=True, verbose=0):
+    shm, train_data = attach_shared_array(handle)
+    try:
+        return fit_tree_block(train_data, n_estimators, seed, max_samples, flat_scorer, verbose)
+    finally:
+        del train_data
+        shm.close()
+
+
+def split_estimators(n_estimators, n_blocks):
+    n_blocks = max(1, min(n_blocks, n_estimators))
+    return [len(block) for block in np.array_split(np.arange(n_estimators), n_blocks)]
+
+
+def tree_blocks(n_estimators, block_size=BLOCK_SIZE, r_seed=0):
+    """
+    Tree counts and seeds of fixed-size blocks of one forest. Both only
+    depend on n_estimators, block_size and r_seed, never on the number of
+    workers, so a forest assembled from its blocks is the same for any n_jobs.
+    Output: [(n_trees, seed), ...] in block order
+    """
+    block_sizes = split_estimators(n_estimators, int(np.ceil(n_estimators / block_size)))
+    block_seeds = [int(seed.generate_state(1)[0])
+                   for seed in np.random.SeedSequence(r_seed).spawn(len(block_sizes))]
+    return list(zip(block_sizes, block_seeds))
+
+
+def merge_sklearn_forests(forests):
+    """
+    Blocks of fitted sklearn IsolationForests (same max_samples) as one
+    IsolationForest, for flat_scorer=False.
+    """
+    forest = copy.copy(forests[0])
+    for name in ('estimators_', 'estimators_features_', '_seeds', '_average_path_length_per_tree',
+                 '_decision_path_lengths'):
+        if hasattr(forests[0], name):
+            setattr(forest, name, [item for block in forests for item in getattr(block, name)])
+    forest.n_estimators = len(forest.estimators_)
+    return forest
+
+
+def merge_tree_blocks(blocks, flat_scorer=True):
+    """
+    Fitted blocks (fit_tree_block) of one forest, in block order, as one forest.
+    """
+    return FlatIsolationForest.merge(blocks) if flat_scorer else merge_sklearn_forests(blocks)
+
+
+def fit_forests_parallel(train_datas, contamination=0.01, n_jobs=2, r_seed=0, n_estimators=1000,
+                         max_samples=10000, block_size=BLOCK_SIZE, flat_scorer=True, verbose=0):
+    """
+    The Parallel Forest Fit Function
+    =======================
+    Fits one IsolationForest per training matrix (e.g. last layer and hidden
+    layer) in a process pool. Every forest is split into fixed blocks of
+    block_size trees, each block is an independent job with its own seed
+    from r_seed (tree_blocks), and the blocks are merged back into one
+    forest per matrix, so the result does not depend on n_jobs. Workers
+    read the embeddings from shared memory.
+    Input: (train_datas, contamination)
+        train_datas     [list]  : embeded training datasets [numpy]
+        contamination           : proportion of training outliers
+        n_jobs                  : number of worker processes
+        block_size              : trees per block
+        flat_scorer             : merge into a FlatIsolationForest, else into
+                                  one sklearn IsolationForest
+    Output:
+        [(detector, train_score), ...] in the order of train_datas, same as
+        Utils.Detectors.fit_detector
+    """
+    blocks = tree_blocks(n_estimators, block_size, r_seed)
+
+    shared_datas = [SharedArray(train_data) for train_data in train_datas]
+    try:
+        with process_pool(n_jobs) as pool:
+            futures = [[pool.submit(_fit_forest_block, shared_data.handle, n_trees, max_samples, seed, flat_scorer,
+                                    verbose)
+                        for n_trees, seed in blocks]
+                       for shared_data in shared_datas]
+            forests = [merge_tree_blocks([future.result() for future in block_futures], flat_scorer)
+                       for block_futures in futures]
+
+        results = []
+        for forest, shared_data in zip(forests, shared_datas):
+            train_raw_score = forest.score_samples(shared_data.array)
+            forest.offset_ = np.percentile(train_raw_score, 100.0 * contamination)
+            results.append((forest, train_raw_score - forest.offset_))
+    finally:
+        for shared_data in shared_datas:
+            shared_data.close()
+
+    return results
@@ -0,0 +1,93 @@
+import numpy as np
+
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import GaussianRandomProjection
+
+
+class Projection:
+    """
+    The Projection Stage
+    =======================
+    Linear reduction of one layer's embeddings in front of its detector:
+        'pca'           : IncrementalPCA, fitted batch by batch
+        'random'        : Gaussian random projection
+    Only the mean and the [n_features, n_components] matrix are kept, so the
+    stage can be cached in a Utils.DetectorStore; transform() is one matmul
+    per batch.
+    """
+
+    def __init__(self, method='pca', n_components=64, r_seed=0, batch_size=4096):
+        if method not in ('pca', 'random'):
+            raise ValueError('Unknown projection: %s' % method)
+        self.method = method
+        self.n_components = n_components
+        self.r_seed = r_seed
+        self.batch_size = batch_size
+
+    def fit(self, train_data, train_label=None):
+        if self.method == 'pca':
+            pca = IncrementalPCA(n_components=self.n_components, batch_size=max(self.batch_size, self.n_components))
+            pca.fit(train_data)
+            self.mean_ = pca.mean_.astype(np.float32)
+            self.components_ = pca.components_.T.astype(np.float32)
+        else:
+            projection = GaussianRandomProjection(n_components=self.n_components, random_state=self.r_seed)
+            projection.fit(train_data)
+            self.mean_ = np.zeros(train_data.shape[1], dtype=np.float32)
+            self.components_ = projection.components_.T.astype(np.float32)
+        return self
+
+    def transform(self, data):
+        projected = np.empty((data.shape[0], self.components_.shape[1]), dtype=np.float32)
+        for start in range(0, data.shape[0], self.batch_size):
+            batch = np.asarray(data[start:start + self.batch_size], dtype=np.float32)
+            projected[start:start + self.batch_size] = (batch - self.mean_) @ self.components_
+        return projected
+
+    def state_dict(self):
+        arrays = {'mean': self.mean_, 'components': self.components_}
+        meta = {'method': self.method, 'n_components': self.n_components, 'r_seed': self.r_seed,
+                'batch_size': self.batch_size}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        projection = cls(method=meta['method'], n_components=meta['n_components'], r_seed=meta['r_seed'],
+                         batch_size=meta['batch_size'])
+        projection.mean_ = arrays['mean']
+        projection.components_ = arrays['components']
+        return projection
+
+
+def fit_projections(detector_store, layer_names, train_datas, projection, r_seed=0):
+    """
+    The Projection Fit Function
+    =======================
+    Fits (or loads from the store) the projection of every layer listed in
+    projection, e.g. {'hidden': ('pca', 64)}; other layers pass through.
+    Output:
+        [Projection or None] in the order of layer_names
+    """
+    projections = []
+    for layer_name, train_data in zip(layer_names, train_datas):
+        if not projection or layer_name not in projection:
+            projections.append(None)
+            continue
+        method, n_components = projection[layer_name]
+        layer_projection, key = None, None
+        if detector_store is not None:
+            key = detector_store.key(layer_name, stage='projection', method=method, n_components=n_components,
+                                     r_seed=r_seed)
+            layer_projection, _ = detector_store.load(key)
+        if layer_projection is None:
+            layer_projection = Projection(method, n_components, r_seed).fit(train_data)
+            if detector_store is not None:
+                detector_store.save(key, layer_projection)
+        print('===> Projection', layer_name, ':', method, train_data.shape[1], '->', n_components)
+        projections.append(layer_projection)
+    return projections
+
+
+def apply_projections(projections, datas):
+    return [data if layer_projection is None else layer_projection.transform(data)
+            for layer_projection, data in zip(projections, datas)]
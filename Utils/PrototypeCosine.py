@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class PrototypeCosineDetector:
+    """
+    The Prototype-Cosine Detector
+    =======================
+    Cosine similarity to the nearest known-class prototype, scaled by the
+    feature norm:
+        fit             : class centroids of the (predicted) labels,
+                          L2-normalized once into a [n_classes, n_features]
+                          prototype matrix
+        score_samples   = max_k cos(x, mu_k) * ||x||^norm_power, one GEMM
+                          and one max per batch (norm_power 1 is the plain
+                          projection x . mu_k / ||mu_k||, 0 the cosine alone)
+    clip_percentile turns on ReAct activation clipping: every feature is
+    clipped at this percentile of all training activations, computed once
+    in fit, before the centroids and the scores are taken.
+    """
+
+    def __init__(self, clip_percentile=None, norm_power=1.0, chunk_size=8192):
+        self.clip_percentile = clip_percentile
+        self.norm_power = norm_power
+        self.chunk_size = chunk_size
+        self.offset_ = 0.0
+
+    def _clip(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        return data if self.clip_ is None else np.minimum(data, self.clip_)
+
+    def fit(self, train_data, train_label=None):
+        train_data = np.asarray(train_data, dtype=np.float32)
+        self.clip_ = None if self.clip_percentile is None else np.float32(np.percentile(train_data,
+                                                                                       self.clip_percentile))
+        if train_label is None:
+            train_label = np.zeros(train_data.shape[0], dtype=int)
+        self.classes_, class_index = np.unique(np.asarray(train_label), return_inverse=True)
+
+        # class sums as one-hot^T @ batch per batch
+        centroids = np.zeros((self.classes_.shape[0], train_data.shape[1]))
+        one_hot = np.eye(self.classes_.shape[0], dtype=np.float32)
+        for start in range(0, train_data.shape[0], self.chunk_size):
+            centroids += one_hot[class_index[start:start + self.chunk_size]].T @ \
+                self._clip(train_data[start:start + self.chunk_size])
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        self.prototypes_ = centroids.astype(np.float32)
+        return self
+
+    def score_samples(self, data):
+        score = np.empty(data.shape[0])
+        for start in range(0, data.shape[0], self.chunk_size):
+            batch = self._clip(data[start:start + self.chunk_size])
+            projection = (batch @ self.prototypes_.T).max(axis=1).astype(np.float64)
+            norm = np.maximum(np.linalg.norm(batch, axis=1).astype(np.float64), 1e-12)
+            score[start:start + self.chunk_size] = projection * norm ** (self.norm_power - 1)
+        return score
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'classes': self.classes_, 'prototypes': self.prototypes_}
+        meta = {'clip_percentile': self.clip_percentile, 'norm_power': self.norm_power,
+                'chunk_size': self.chunk_size, 'clip': None if self.clip_ is None else float(self.clip_),
+                'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(clip_percentile=meta['clip_percentile'], norm_power=meta['norm_power'],
+                       chunk_size=meta['chunk_size'])
+        detector.classes_, detector.prototypes_ = arrays['classes'], arrays['prototypes']
+        detector.clip_ = None if meta['clip'] is None else np.float32(meta['clip'])
+        detector.offset_ = meta['offset']
+        return detector
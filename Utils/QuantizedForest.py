@@ -0,0 +1,110 @@
+import numpy as np
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+
+
+class QuantizedIsolationForest:
+    """
+    The Quantized-Threshold IsolationForest
+    =======================
+    Every feature is binned once into 256 quantiles of the training set and
+    the forest is fitted on the uint8 bin codes. sklearn draws every split
+    threshold t uniformly in [min, max) of the node's codes, so on integer
+    codes x <= t is code <= floor(t), and t is stored exactly as the uint8
+    floor(t). Queries are quantized once, chunk by chunk, and walked by
+    the FlatIsolationForest traversal on uint8 codes and uint8 thresholds:
+    the feature matrix and the threshold array are 4x smaller than float32.
+    Quantization is a lookup: the range between the outer quantiles is cut
+    into n_cells uniform cells, each mapped to the quantile bin of its
+    center, so a code is one multiply-add and one table gather (codes can
+    be off by one bin next to a quantile edge; train and queries share the
+    same mapping).
+        lut_            [uint8]  : [n_features, n_cells] cell -> bin code
+        forest_                  : FlatIsolationForest with uint8 thresholds
+                                   (leaves hold 255, never taken right)
+    """
+
+    def __init__(self, r_seed=0, n_estimators=1000, max_samples=10000, verbose=0, n_cells=4096, chunk_size=8192):
+        self.r_seed = r_seed
+        self.n_estimators = n_estimators
+        self.max_samples = max_samples
+        self.verbose = verbose
+        self.n_cells = n_cells
+        self.chunk_size = chunk_size
+        self.offset_ = 0.0
+
+    def quantize(self, data):
+        # cell 0 is below the lowest edge, n_cells - 1 above the highest
+        codes = np.empty(data.shape, dtype=np.uint8)
+        lut, lut_offset = self.lut_.ravel(), np.arange(data.shape[1], dtype=np.int32) * self.n_cells
+        for start in range(0, data.shape[0], self.chunk_size):
+            chunk = np.asarray(data[start:start + self.chunk_size], dtype=np.float32)
+            cell = np.clip((chunk - self.low_) * self.inv_width_ + 1, 0, self.n_cells - 1).astype(np.int32)
+            codes[start:start + self.chunk_size] = lut.take(cell + lut_offset)
+        return codes
+
+    def fit(self, train_data, train_label=None):
+        # bin code = number of the 255 quantile edges below the value, 0..255
+        edges = np.quantile(train_data, np.arange(1, 256) / 256, axis=0).T
+        width = (edges[:, -1] - edges[:, 0]) / (self.n_cells - 2)
+        width[width <= 0] = 1.0
+        cell_center = edges[:, :1] + (np.arange(self.n_cells) - 0.5) * width[:, None]
+        self.lut_ = np.stack([np.searchsorted(feature_edges, feature_centers)
+                              for feature_edges, feature_centers in zip(edges, cell_center)]).astype(np.uint8)
+        self.low_ = edges[:, 0].astype(np.float32)
+        self.inv_width_ = (1.0 / width).astype(np.float32)
+        codes = self.quantize(train_data)
+
+        forest = IsolationForest(random_state=self.r_seed, n_estimators=self.n_estimators, verbose=self.verbose,
+                                 max_samples=self.max_samples, contamination='auto').fit(codes)
+        self.forest_ = FlatIsolationForest.from_sklearn(forest)
+        # split thresholds floor to the last bin code going left, leaves (+inf) to 255
+        self.forest_.threshold = np.minimum(np.floor(self.forest_.threshold), 255).astype(np.uint8)
+        return self
+
+    def score_samples(self, data):
+        return self.forest_.score_samples(data if data.dtype == np.uint8 else self.quantize(data))
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays, meta = self.forest_.state_dict()
+        arrays = dict(arrays, lut=self.lut_, low=self.low_, inv_width=self.inv_width_)
+        meta = {'forest': meta, 'r_seed': self.r_seed, 'n_estimators': self.n_estimators,
+                'max_samples': self.max_samples, 'verbose': self.verbose, 'n_cells': self.n_cells,
+                'chunk_size': self.chunk_size,
+                'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(r_seed=meta['r_seed'], n_estimators=meta['n_estimators'], max_samples=meta['max_samples'],
+                       verbose=meta['verbose'], n_cells=meta['n_cells'], chunk_size=meta['chunk_size'])
+        arrays = dict(arrays)
+        detector.lut_, detector.low_ = arrays.pop('lut'), arrays.pop('low')
+        detector.inv_width_ = arrays.pop('inv_width')
+        detector.forest_ = FlatIsolationForest.from_state(arrays, meta['forest'])
+        detector.offset_ = meta['offset']
+        return detector
+
+
+def test():
+    rng = np.random.RandomState(0)
+    train_data = rng.randn(3000, 64).astype(np.float32)
+    test_data = np.concatenate([rng.randn(500, 64), rng.randn(500, 64) * 2 + 1]).astype(np.float32)
+
+    detector = QuantizedIsolationForest(n_estimators=100, max_samples=1000).fit(train_data)
+    forest = IsolationForest(random_state=0, n_estimators=100, max_samples=1000).fit(detector.quantize(train_data))
+    for data in [train_data, test_data]:
+        assert np.allclose(detector.score_samples(data), forest.score_samples(detector.quantize(data)))
+    print('QuantizedIsolationForest matches sklearn IsolationForest on the bin codes')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,74 @@
+import numpy as np
+
+from sklearn.linear_model import SGDOneClassSVM
+
+
+class RFFOneClassSVM:
+    """
+    The Random-Fourier-Feature One-Class SVM
+    =======================
+    Linear-time approximation of an RBF one-class SVM:
+        features        : z(x) = sqrt(2 / D) * cos(x W + b), W ~ N(0, 2 gamma),
+                          b ~ U(0, 2 pi), so z(x) . z(y) ~ exp(-gamma |x - y|^2)
+        solver          : SGDOneClassSVM, partial_fit on mini-batches of mapped
+                          features for n_epochs shuffled passes
+        score_samples   = z(x) . w, higher is more normal
+    Only one mini-batch of mapped features exists at a time, for fitting and
+    for scoring.
+    Input:
+        n_components            : number of random features D
+        gamma                   : RBF width, 'scale' = 1 / (n_features * var(X))
+        nu                      : SVM bound on the fraction of training outliers
+    """
+
+    def __init__(self, n_components=1024, gamma='scale', nu=0.05, n_epochs=5, batch_size=4096, r_seed=0):
+        self.n_components = n_components
+        self.gamma = gamma
+        self.nu = nu
+        self.n_epochs = n_epochs
+        self.batch_size = batch_size
+        self.r_seed = r_seed
+        self.offset_ = 0.0
+
+    def _features(self, data):
+        projection = np.asarray(data, dtype=np.float32) @ self.weights_ + self.bias_
+        return np.sqrt(2.0 / self.n_components, dtype=np.float32) * np.cos(projection)
+
+    def fit(self, train_data, train_label=None):
+        rng = np.random.RandomState(self.r_seed)
+        gamma = 1.0 / (train_data.shape[1] * train_data.var()) if self.gamma == 'scale' else self.gamma
+        self.weights_ = (rng.normal(size=(train_data.shape[1], self.n_components)) * np.sqrt(2 * gamma)
+                         ).astype(np.float32)
+        self.bias_ = rng.uniform(0, 2 * np.pi, self.n_components).astype(np.float32)
+
+        svm = SGDOneClassSVM(nu=self.nu, random_state=self.r_seed)
+        for _ in range(self.n_epochs):
+            order = rng.permutation(train_data.shape[0])
+            for start in range(0, train_data.shape[0], self.batch_size):
+                svm.partial_fit(self._features(train_data[np.sort(order[start:start + self.batch_size])]))
+        self.coef_ = svm.coef_.astype(np.float32)
+        return self
+
+    def score_samples(self, data):
+        return np.concatenate([self._features(data[start:start + self.batch_size]) @ self.coef_
+                               for start in range(0, data.shape[0], self.batch_size)]).astype(np.float64)
+
+    def decision_function(self, data):
+        return self.score_samples(data) - self.offset_
+
+    def predict(self, data):
+        return np.where(self.decision_function(data) < 0, -1, 1)
+
+    def state_dict(self):
+        arrays = {'weights': self.weights_, 'bias': self.bias_, 'coef': self.coef_}
+        meta = {'n_components': self.n_components, 'gamma': self.gamma, 'nu': self.nu, 'n_epochs': self.n_epochs,
+                'batch_size': self.batch_size, 'r_seed': self.r_seed, 'offset': float(self.offset_)}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        detector = cls(n_components=meta['n_components'], gamma=meta['gamma'], nu=meta['nu'],
+                       n_epochs=meta['n_epochs'], batch_size=meta['batch_size'], r_seed=meta['r_seed'])
+        detector.weights_, detector.bias_, detector.coef_ = arrays['weights'], arrays['bias'], arrays['coef']
+        detector.offset_ = meta['offset']
+        return detector
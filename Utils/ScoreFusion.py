@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class ScoreFusion:
+    """
+    The Score Fusion Engine
+    =======================
+    Combines one fitted detector per tapped layer into a single open-set
+    decision. Per-layer decision scores are stacked into one
+    [n_layers, n_samples] matrix and fused in one array operation:
+        'vote'  : inlier if at least min_votes layers say inlier, i.e. the
+                  min_votes-th largest layer score >= 0 (min_votes defaults
+                  to all layers, the scripts' two-detector vote)
+        'min'   : minimum layer score >= 0 (same as 'vote' with all layers)
+        'mean'  : mean layer score, thresholded at the contamination
+                  percentile of the training data
+        'rank'  : mean empirical CDF of every layer score against that
+                  layer's training scores, thresholded the same way
+    Every mode returns a fused decision score, >= 0 means inlier.
+    Input:
+        detectors       [list]  : fitted detectors, one per layer
+        fusion                  : 'vote', 'min', 'mean' or 'rank'
+        contamination           : proportion of training outliers ('mean'/'rank')
+        min_votes               : inlier votes needed ('vote')
+    """
+
+    def __init__(self, detectors, fusion='vote', contamination=0.01, min_votes=None):
+        if fusion not in ('vote', 'min', 'mean', 'rank'):
+            raise ValueError('Unknown fusion: %s' % fusion)
+        self.detectors = detectors
+        self.fusion = fusion
+        self.contamination = contamination
+        self.min_votes = len(detectors) if min_votes is None else min_votes
+        self.offset_ = 0.0
+
+    def fit(self, train_scores):
+        """
+        Input:
+            train_scores    [numpy] : [n_layers, n_train] decision scores of
+                                      the training data, e.g. from fit_detector
+        Output:
+            fused decision scores of the training data
+        """
+        train_scores = np.asarray(train_scores)
+        self.sorted_train_scores_ = np.sort(train_scores, axis=1)
+        self.offset_ = 0.0
+        if self.fusion in ('mean', 'rank'):
+            self.offset_ = np.percentile(self._fuse(train_scores), 100.0 * self.contamination)
+        return self.fuse(train_scores)
+
+    def layer_scores(self, layers, scores=None, label=None):
+        """
+        Input:
+            layers          [list]  : one embedding matrix per layer
+            scores          [list]  : already computed layer scores, None
+                                      entries are scored by their detector
+            label           [numpy] : predicted labels, routed to class-conditional
+                                      detectors (Utils.ClassConditional)
+        Output:
+            [n_layers, n_samples] decision scores
+        """
+        scores = [None] * len(layers) if scores is None else scores
+        return np.stack([score if score is not None
+                         else detector.decision_function(layer, label) if getattr(detector, 'class_routed', False)
+                         else detector.decision_function(layer)
+                         for detector, layer, score in zip(self.detectors, layers, scores)])
+
+    def _fuse(self, scores):
+        if self.fusion == 'min':
+            return scores.min(axis=0)
+        if self.fusion == 'vote':
+            return np.sort(scores, axis=0)[scores.shape[0] - self.min_votes]
+        if self.fusion == 'mean':
+            return scores.mean(axis=0)
+        # 'rank': empirical CDF of every layer score among its training scores
+        n_train = self.sorted_train_scores_.shape[1]
+        return np.mean([np.searchsorted(sorted_train, score, side='right') / n_train
+                        for sorted_train, score in zip(self.sorted_train_scores_, scores)], axis=0)
+
+    def fuse(self, scores):
+        return self._fuse(np.asarray(scores)) - self.offset_
+
+    def predict(self, scores):
+        return np.where(self.fuse(scores) < 0, -1, 1)
+
+    def open_set_labels(self, scores, logits):
+        """
+        Output: argmax of the logits for inliers, -1 for outliers; detectors
+        with their own open-set rule on the logits (predict_labels, e.g.
+        OpenMax) decide instead of the fused scores
+        """
+        if all(hasattr(detector, 'predict_labels') for detector in self.detectors):
+            return self.detectors[-1].predict_labels(logits)
+        return np.where(self.fuse(scores) < 0, -1, np.asarray(logits).argmax(axis=1))
@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+import time
+
+import joblib
+import numpy as np
+
+from Utils.DetectorStore import DetectorStore
+from Utils.ParallelFit import BLOCK_SIZE, fit_tree_block, merge_tree_blocks, process_pool, tree_blocks
+
+
+def shard_plan(n_estimators, shard_size=BLOCK_SIZE, r_seed=0):
+    """
+    Tree counts and seeds of the shards of one forest, see
+    Utils.ParallelFit.tree_blocks: independent of the number of workers.
+    Output: [(n_trees, seed), ...] in shard order
+    """
+    return tree_blocks(n_estimators, shard_size, r_seed)
+
+
+def shard_key(matrix_index, shard_index):
+    return 'matrix%d_shard%05d' % (matrix_index, shard_index)
+
+
+def save_shard(shard_dir, key, shard):
+    # FlatIsolationForest shards are store entries, sklearn ones (no state_dict()) are pickled next to them
+    if hasattr(shard, 'state_dict'):
+        DetectorStore(shard_dir).save(key, shard)
+    else:
+        joblib.dump(shard, os.path.join(shard_dir, key + '.joblib'))
+
+
+def load_shard(shard_dir, key):
+    path = os.path.join(shard_dir, key + '.joblib')
+    return joblib.load(path) if os.path.isfile(path) else DetectorStore(shard_dir).load(key)[0]
+
+
+def _run_worker(shard_dir, matrix_index, shard_indices, plan, max_samples, flat_scorer, verbose):
+    # stand-in for a remote host: reads the training matrix from and writes
+    # its shards to the shared shard directory
+    train_data = np.load(os.path.join(shard_dir, 'train_%d.npy' % matrix_index), mmap_mode='r')
+    for shard_index in shard_indices:
+        n_trees, seed = plan[shard_index]
+        save_shard(shard_dir, shard_key(matrix_index, shard_index),
+                   fit_tree_block(train_data, n_trees, seed, max_samples, flat_scorer, verbose))
+    return shard_indices
+
+
+class ShardCoordinator:
+    """
+    The Sharded Forest Coordinator
+    =======================
+    Local stand-in for fitting one IsolationForest on several hosts:
+        plan            : the forest is cut into fixed shards of shard_size
+                          trees, every shard has its own seed from one
+                          SeedSequence (Utils.ShardedForest.shard_plan)
+        dispatch        : the training matrices are written to shard_dir,
+                          shards are dealt round robin to n_workers worker
+                          processes, each fits its shards from the file with
+                          Utils.ParallelFit.fit_tree_block and writes them
+                          back as Utils.DetectorStore entries (pickled
+                          sklearn forests if not flat_scorer)
+        merge           : shards are loaded in shard order and merged with
+                          Utils.ParallelFit.merge_tree_blocks
+    A shard is the same on whichever worker it runs, so the merged forest
+    does not depend on n_workers; n_workers <= 1 fits the shards in this
+    process without touching the disk.
+    Input:
+        shard_dir               : directory shared with the workers, a
+                                  temporary directory (removed after) if None
+    """
+
+    def __init__(self, n_workers=1, shard_size=BLOCK_SIZE, shard_dir=None, flat_scorer=True, verbose=0):
+        self.n_workers = n_workers
+        self.shard_size = shard_size
+        self.shard_dir = shard_dir
+        self.flat_scorer = flat_scorer
+        self.verbose = verbose
+
+    def fit(self, train_datas, r_seed=0, n_estimators=1000, max_samples=10000):
+        """
+        Output: [forest, ...] in the order of train_datas, FlatIsolationForest
+                or sklearn IsolationForest (flat_scorer)
+        """
+        plan = shard_plan(n_estimators, self.shard_size, r_seed)
+        if self.n_workers is None or self.n_workers <= 1:
+            return [merge_tree_blocks([fit_tree_block(train_data, n_trees, seed, max_samples, self.flat_scorer,
+                                                      self.verbose)
+                                       for n_trees, seed in plan], self.flat_scorer)
+                    for train_data in train_datas]
+
+        shard_dir = tempfile.mkdtemp() if self.shard_dir is None else self.shard_dir
+        os.makedirs(shard_dir, exist_ok=True)
+        try:
+            for matrix_index, train_data in enumerate(train_datas):
+                np.save(os.path.join(shard_dir, 'train_%d.npy' % matrix_index),
+                        np.ascontiguousarray(train_data, dtype=np.float32))
+            n_workers = min(self.n_workers, len(plan))
+            with process_pool(n_workers) as pool:
+                futures = [pool.submit(_run_worker, shard_dir, matrix_index,
+                                       list(range(worker, len(plan), n_workers)), plan, max_samples,
+                                       self.flat_scorer, self.verbose)
+                           for matrix_index in range(len(train_datas)) for worker in range(n_workers)]
+                for future in futures:
+                    future.result()
+
+            return [merge_tree_blocks([load_shard(shard_dir, shard_key(matrix_index, shard_index))
+                                       for shard_index in range(len(plan))], self.flat_scorer)
+                    for matrix_index in range(len(train_datas))]
+        finally:
+            if self.shard_dir is None:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def fit_forests_sharded(train_datas, contamination=0.01, n_workers=1, r_seed=0, n_estimators=1000,
+                        max_samples=10000, shard_size=BLOCK_SIZE, shard_dir=None, flat_scorer=True, verbose=0):
+    """
+    The Sharded Forest Fit Function
+    =======================
+    Fits one IsolationForest per training matrix through a ShardCoordinator
+    and places the offsets as Utils.Detectors.fit_detector does.
+    Input: (train_datas, contamination)
+        train_datas     [list]  : embeded training datasets [numpy]
+        n_workers               : worker processes (1 = in this process)
+        shard_size              : trees per shard
+        flat_scorer             : merge into a FlatIsolationForest, else into
+                                  one sklearn IsolationForest
+    Output:
+        [(detector, train_score), ...] in the order of train_datas
+    """
+    forests = ShardCoordinator(n_workers, shard_size, shard_dir, flat_scorer, verbose).fit(
+        train_datas, r_seed, n_estimators, max_samples)
+    results = []
+    for forest, train_data in zip(forests, train_datas):
+        train_raw_score = forest.score_samples(train_data)
+        forest.offset_ = np.percentile(train_raw_score, 100.0 * contamination)
+        results.append((forest, train_raw_score - forest.offset_))
+    return results
+
+
+def compare(n_workers=(1, 2, 4), n_estimators=200):
+    """
+    Fit time for several worker counts, and a check that every merged
+    forest scores exactly like the single-process fit.
+    """
+    rng = np.random.RandomState(0)
+    train_data = rng.randn(20000, 128).astype(np.float32)
+    test_data = rng.randn(2000, 128).astype(np.float32) * 1.5
+
+    reference = None
+    for workers in n_workers:
+        start_time = time.time()
+        (forest, train_score), = fit_forests_sharded([train_data], n_workers=workers, n_estimators=n_estimators)
+        fit_time = time.time() - start_time
+        score = forest.decision_function(test_data)
+        if reference is None:
+            reference = score
+        print('%d workers  fit %.2fs  identical to single process: %s' % (
+            workers, fit_time, np.array_equal(score, reference)))
+
+
+if __name__ == '__main__':
+    compare()
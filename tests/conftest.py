@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the Utils package is imported from the repository root, as the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def embeddings():
+    """
+    Small synthetic (last layer, hidden) embeddings of 10 classes, plus
+    test rows of the same classes and shifted outlier rows.
+    """
+    rng = np.random.RandomState(0)
+    centers = rng.randn(10, 10) * 3
+
+    def sample(n, shift=0.0):
+        label = rng.randint(10, size=n)
+        last_layer = (centers[label] + rng.randn(n, 10) + shift).astype(np.float32)
+        hidden = np.hstack([last_layer, rng.randn(n, 6).astype(np.float32) * (1 + shift)])
+        return last_layer, hidden, label
+
+    return sample(1000), sample(200), sample(200, 2.0)
@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.AUROC_Score import AUROC_score, AUROC_score_sweep
+
+FOREST = dict(r_seed=0, n_estimators=100, max_samples=256)
+
+
+def _auroc(embeddings, **kwargs):
+    (train_last, train_hidden, _), (test_last, test_hidden, _), _ = embeddings
+    return AUROC_score(torch.from_numpy(train_last), torch.from_numpy(train_hidden), train_last.shape[0],
+                       torch.from_numpy(test_last), torch.from_numpy(test_hidden), test_last.shape[0], **FOREST,
+                       **kwargs)
+
+
+def test_default_matches_sklearn_baseline(embeddings):
+    (_, train_hidden, _), (_, test_hidden, _), _ = embeddings
+    # the pre-detector-registry pipeline: one sklearn IsolationForest per layer
+    forest = IsolationForest(random_state=FOREST['r_seed'], n_estimators=FOREST['n_estimators'],
+                             max_samples=FOREST['max_samples'], contamination=0.01).fit(train_hidden)
+    for flat_scorer in (True, False):
+        outlier_train_hidden, outlier_test_hidden = _auroc(embeddings, flat_scorer=flat_scorer)
+        np.testing.assert_array_equal(outlier_train_hidden, forest.predict(train_hidden))
+        np.testing.assert_array_equal(outlier_test_hidden, forest.predict(test_hidden))
+
+
+def test_sharding_independent_of_n_jobs(embeddings):
+    sharded = [_auroc(embeddings, shard_size=50), _auroc(embeddings, n_jobs=2),
+               _auroc(embeddings, n_jobs=2, flat_scorer=False)]
+    for result in sharded[1:]:
+        for labels, sharded_labels in zip(result, sharded[0]):
+            np.testing.assert_array_equal(labels, sharded_labels)
+
+
+def test_sweep_matches_auroc_score(embeddings):
+    (train_last, train_hidden, _), (test_last, test_hidden, _), _ = embeddings
+    sweep = AUROC_score_sweep(torch.from_numpy(train_last), torch.from_numpy(train_hidden), train_last.shape[0],
+                              torch.from_numpy(test_last), torch.from_numpy(test_hidden), test_last.shape[0],
+                              contaminations=(0.02, 0.05), **FOREST)
+    for contamination, result in sweep.items():
+        outlier_train_hidden, outlier_test_hidden = _auroc(embeddings, contamination=contamination)
+        np.testing.assert_array_equal(result['outlier_train_hidden'], outlier_train_hidden)
+        np.testing.assert_array_equal(result['outlier_test_hidden'], outlier_test_hidden)
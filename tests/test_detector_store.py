@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+
+from Utils.AUROC_Score import AUROC_score
+from Utils.DetectorStore import DetectorStore
+from Utils.Detectors import build_detector, fit_detector, load_detectors, save_detectors
+
+FOREST = dict(r_seed=0, n_estimators=50, max_samples=256)
+
+
+def test_store_round_trip_moves_offset(embeddings, tmp_path):
+    (train_data, _, _), (test_data, _, _), _ = embeddings
+    store = DetectorStore(str(tmp_path))
+    fitted = fit_detector(build_detector('iforest', contamination=0.05, **FOREST), train_data, 0.05)
+    save_detectors(store, ['last_layer'], [fitted], detector='iforest', flat_scorer=True, **FOREST)
+
+    (detector, train_score), = load_detectors(store, ['last_layer'], 0.05, detector='iforest', flat_scorer=True,
+                                              **FOREST)
+    np.testing.assert_allclose(detector.decision_function(test_data), fitted[0].decision_function(test_data))
+    np.testing.assert_allclose(train_score, fitted[1])
+
+    # another contamination reuses the stored forest, only offset_ moves
+    (detector, train_score), = load_detectors(store, ['last_layer'], 0.1, detector='iforest', flat_scorer=True,
+                                              **FOREST)
+    refit, refit_train_score = fit_detector(build_detector('iforest', contamination=0.1, **FOREST), train_data, 0.1)
+    np.testing.assert_allclose(detector.offset_, refit.offset_)
+    np.testing.assert_allclose(train_score, refit_train_score, atol=1e-12)
+
+
+def test_store_key_has_flat_scorer(tmp_path):
+    store = DetectorStore(str(tmp_path))
+    assert store.key('hidden', detector='iforest', flat_scorer=True) != \
+        store.key('hidden', detector='iforest', flat_scorer=False)
+
+
+def test_sklearn_forest_is_not_stored(embeddings, tmp_path):
+    (train_data, _, _), _, _ = embeddings
+    store = DetectorStore(str(tmp_path))
+    fitted = fit_detector(build_detector('iforest', **FOREST), train_data, 0.01, flat_scorer=False)
+    save_detectors(store, ['hidden'], [fitted], detector='iforest', flat_scorer=False, **FOREST)
+    assert load_detectors(store, ['hidden'], 0.01, detector='iforest', flat_scorer=False, **FOREST) is None
+
+
+def _auroc(embeddings, **kwargs):
+    (train_last, train_hidden, _), (test_last, test_hidden, _), _ = embeddings
+    return AUROC_score(torch.from_numpy(train_last), torch.from_numpy(train_hidden), train_last.shape[0],
+                       torch.from_numpy(test_last), torch.from_numpy(test_hidden), test_last.shape[0], **FOREST,
+                       **kwargs)
+
+
+def test_auroc_store_contamination_sweep(embeddings, tmp_path):
+    store = DetectorStore(str(tmp_path))
+    _auroc(embeddings, contamination=0.02, detector_store=store)
+    loaded = _auroc(embeddings, contamination=0.08, detector_store=store)
+    fresh = _auroc(embeddings, contamination=0.08)
+    for loaded_labels, fresh_labels in zip(loaded, fresh):
+        np.testing.assert_array_equal(loaded_labels, fresh_labels)
+
+
+def test_auroc_flat_scorer_false_with_store(embeddings, tmp_path):
+    store = DetectorStore(str(tmp_path))
+    first = _auroc(embeddings, flat_scorer=False, detector_store=store)
+    second = _auroc(embeddings, flat_scorer=False, detector_store=store)
+    for first_labels, second_labels in zip(first, second):
+        np.testing.assert_array_equal(first_labels, second_labels)
+
+
+def test_coreset_offset_from_full_training_set(embeddings):
+    (train_last, _, _), _, _ = embeddings
+    contamination = 0.05
+    outlier_train_hidden, _ = _auroc(embeddings, contamination=contamination, coreset=400)
+    # the offsets sit at the contamination percentile of the full-set scores
+    assert abs((outlier_train_hidden == -1).mean() - contamination) <= 1.0 / train_last.shape[0]
+
+
+def test_coreset_with_class_conditional(embeddings):
+    (train_last, _, _), _, _ = embeddings
+    outlier_train_hidden, outlier_test_hidden = _auroc(embeddings, contamination=0.05, coreset=400,
+                                                       class_conditional=True)
+    assert outlier_train_hidden.shape == (train_last.shape[0],)
+    # 5 trees per class: tied scores around the offset
+    assert abs((outlier_train_hidden == -1).mean() - 0.05) < 0.01
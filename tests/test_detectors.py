@@ -0,0 +1,7 @@
+from Utils.Detectors import EIF_MAX_SAMPLES, build_detector
+
+
+def test_eif_max_samples_capped():
+    assert build_detector('eif', max_samples=10000).max_samples == EIF_MAX_SAMPLES
+    assert build_detector('eif', max_samples=1.0).max_samples == EIF_MAX_SAMPLES
+    assert build_detector('eif', max_samples=128).max_samples == 128
@@ -0,0 +1,30 @@
+import numpy as np
+
+from Utils.EnsembleRunner import EnsembleRunner
+
+
+def test_parallel_run_matches_serial(embeddings):
+    (train_last, train_hidden, train_label), (test_last, test_hidden, test_label), _ = embeddings
+    runs = []
+    for n_jobs in (None, 2):
+        runner = EnsembleRunner(('iforest', 'mahalanobis', 'energy'), n_jobs=n_jobs, n_estimators=50,
+                                max_samples=256)
+        runs.append(runner.run({'last_layer': train_last, 'hidden': train_hidden},
+                               {'last_layer': test_last, 'hidden': test_hidden}, train_label, test_label)[0])
+    assert sorted(runs[0]) == sorted(runs[1])
+    for name, score in runs[0].items():
+        np.testing.assert_allclose(runs[1][name], score)
+
+
+def test_fitted_scores_are_not_refitted(embeddings):
+    (train_last, train_hidden, train_label), (test_last, test_hidden, test_label), _ = embeddings
+    runner = EnsembleRunner(('iforest', 'energy'), n_jobs=2, n_estimators=50, max_samples=256)
+    scores, train_scores = runner.run({'last_layer': train_last, 'hidden': train_hidden},
+                                      {'last_layer': [test_last[:100], test_last[100:]],
+                                       'hidden': [test_hidden[:100], test_hidden[100:]]}, train_label, test_label)
+    fitted_scores = {name: (train_scores[name], scores[name]) for name in ('iforest/last_layer', 'iforest/hidden')}
+    reused = EnsembleRunner(('iforest', 'energy'), n_jobs=2, n_estimators=1, max_samples=2).run(
+        {'last_layer': train_last, 'hidden': train_hidden}, {'last_layer': test_last, 'hidden': test_hidden},
+        train_label, test_label, fitted_scores)[0]
+    for name, score in scores.items():
+        np.testing.assert_allclose(reused[name], score)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import torch
+
+from models.dla import DLA
+from Utils.DetectorStore import DetectorStore
+from Utils.GramDetector import GramDetector
+
+
+@pytest.mark.parametrize('holdout', [0, 1, -0.1, 1.5])
+def test_holdout_out_of_range(holdout):
+    with pytest.raises(ValueError):
+        GramDetector(holdout=holdout)
+
+
+def test_fit_store_round_trip(tmp_path):
+    torch.manual_seed(0)
+    net = DLA()
+    train_data, test_data = torch.rand(40, 3, 32, 32), torch.randn(16, 3, 32, 32)
+    detector = GramDetector(powers=2, holdout=0.25, batch_size=16).fit(net, train_data)
+    assert detector.channels_ == [64, 128, 256, 512]
+
+    store = DetectorStore(str(tmp_path))
+    store.save('gram', detector)
+    loaded, _ = store.load('gram')
+    np.testing.assert_allclose(loaded.decision_function(net, test_data), detector.decision_function(net, test_data),
+                               rtol=1e-6)
+
+
+def test_holdout_drawn_across_training_set():
+    torch.manual_seed(0)
+    net = DLA()
+    detector, indices = GramDetector(powers=2, holdout=0.25, batch_size=16), []
+    passes = detector._passes
+    detector._passes = lambda net, data, index=None: (indices.append(index), passes(net, data, index))[1]
+    detector.fit(net, torch.rand(40, 3, 32, 32))
+
+    fit_index, holdout_index = indices
+    assert len(holdout_index) == 10 and np.array_equal(np.sort(np.append(fit_index, holdout_index)), np.arange(40))
+    # a class-ordered training set has both halves in the holdout
+    assert (holdout_index < 20).any() and (holdout_index >= 20).any()
@@ -0,0 +1,34 @@
+import numpy as np
+
+from Utils.DetectorStore import DetectorStore
+from Utils.IncrementalForest import fit_incremental, prefix_fingerprint
+
+FOREST = dict(r_seed=0, n_estimators=40, max_samples=128)
+
+
+def test_prefix_fingerprint():
+    data = np.random.RandomState(0).randn(5000, 4).astype(np.float32)
+    fingerprint = prefix_fingerprint(data, 3000)
+    assert prefix_fingerprint(data[:3000], 3000) == fingerprint
+    assert prefix_fingerprint(data, 2999) != fingerprint
+    changed = data.copy()
+    changed[2999] += 1
+    assert prefix_fingerprint(changed, 3000) != fingerprint
+
+
+def test_incremental_update_and_refit(embeddings, tmp_path):
+    (train_data, _, _), (new_data, _, _), _ = embeddings
+    store = DetectorStore(str(tmp_path))
+    forest = fit_incremental(store, 'hidden', train_data, 0.05, **FOREST)
+    assert forest.n_updates_ == 0
+
+    # appended rows add trees to the stored forest
+    data = np.concatenate([train_data, new_data])
+    forest = fit_incremental(store, 'hidden', data, 0.05, **FOREST)
+    assert forest.n_updates_ == 1 and forest.n_seen_ == data.shape[0]
+    # the reservoir holds every row here: the offset is the full-set percentile
+    assert abs((forest.decision_function(data) < 0).mean() - 0.05) <= 2.0 / data.shape[0]
+
+    # changed rows are not an append: refit from scratch
+    forest = fit_incremental(store, 'hidden', np.concatenate([new_data, train_data]), 0.05, **FOREST)
+    assert forest.n_updates_ == 0
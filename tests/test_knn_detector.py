@@ -0,0 +1,23 @@
+import numpy as np
+
+from Utils.Detectors import fit_detector
+from Utils.KNNDetector import KNNDetector
+
+
+def _brute_force_kth(query, train_data, k, exclude_self=False):
+    query = query / np.linalg.norm(query, axis=1, keepdims=True)
+    train_data = train_data / np.linalg.norm(train_data, axis=1, keepdims=True)
+    distance = np.sqrt(np.maximum(((query[:, None, :] - train_data[None, :, :]) ** 2).sum(axis=2), 0))
+    if exclude_self:
+        np.fill_diagonal(distance, np.inf)
+    return np.sort(distance, axis=1)[:, k - 1]
+
+
+def test_training_pass_excludes_self(embeddings):
+    (_, train_data, _), (_, test_data, _), _ = embeddings
+    train_data, test_data = train_data[:300].astype(np.float64), test_data.astype(np.float64)
+    detector, train_score = fit_detector(KNNDetector(k=5, n_cells=4, n_probe=4), train_data, 0.05)
+    np.testing.assert_allclose(-(train_score + detector.offset_), _brute_force_kth(train_data, train_data, 5, True),
+                               rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(detector.kth_distance(test_data), _brute_force_kth(test_data, train_data, 5),
+                               rtol=1e-4, atol=1e-5)
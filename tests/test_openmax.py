@@ -0,0 +1,22 @@
+import numpy as np
+
+from Utils.Detectors import fit_detector
+from Utils.OpenMax import OpenMaxDetector
+from Utils.ScoreFusion import ScoreFusion
+
+
+def test_open_set_labels_are_the_openmax_argmax(embeddings):
+    (train_logits, _, _), (test_logits, _, _), _ = embeddings
+    detector, train_score = fit_detector(OpenMaxDetector(), train_logits, 0.01)
+    # flat logits, far from every class mean: "unknown" wins
+    data = np.concatenate([test_logits, np.full((50, test_logits.shape[1]), train_logits.mean())])
+
+    labels = detector.predict_labels(data)
+    assert (labels[-50:] == -1).all()
+    np.testing.assert_array_equal(labels, detector.predict_proba(data).argmax(axis=1) - 1)
+    np.testing.assert_array_equal(detector.predict(data), np.where(labels == -1, -1, 1))
+
+    fusion_engine = ScoreFusion([detector, detector])
+    fusion_engine.fit(np.stack([train_score, train_score]))
+    scores = fusion_engine.layer_scores([data, data])
+    np.testing.assert_array_equal(fusion_engine.open_set_labels(scores, data), labels)
@@ -0,0 +1,17 @@
+import numpy as np
+
+from numpy.lib.format import open_memmap
+
+from Utils.OutOfCore import argmax_rows, load_embeddings, read_rows
+
+
+def test_read_rows_keeps_requested_order(embeddings, tmp_path):
+    (train_data, _, _), _, _ = embeddings
+    path = str(tmp_path / 'train.npy')
+    open_memmap(path, mode='w+', dtype=np.float32, shape=train_data.shape)[:] = train_data
+    data = load_embeddings(path)
+
+    for index in [np.array([5, 3, 4, 999, 0, 1, 2, 500, 501]), np.array([7, 7, 8]), np.array([], dtype=np.int64),
+                  np.sort(np.random.RandomState(0).choice(train_data.shape[0], 300, replace=False))]:
+        np.testing.assert_array_equal(read_rows(data, index), train_data[index].astype(np.float32))
+    np.testing.assert_array_equal(argmax_rows(data, chunk_size=64), train_data.argmax(axis=1))
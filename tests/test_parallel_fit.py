@@ -0,0 +1,38 @@
+import numpy as np
+
+from sklearn.ensemble import IsolationForest
+
+from Utils.FlatIsolationForest import FlatIsolationForest
+from Utils.ParallelFit import fit_forests_parallel
+from Utils.ShardedForest import fit_forests_sharded
+
+
+def test_parallel_fit_independent_of_n_jobs(embeddings):
+    (train_data, _, _), (test_data, _, _), _ = embeddings
+    scores = []
+    for n_jobs in (2, 3):
+        (forest, _), = fit_forests_parallel([train_data], n_jobs=n_jobs, n_estimators=60, max_samples=128)
+        assert isinstance(forest, FlatIsolationForest)
+        scores.append(forest.decision_function(test_data))
+    np.testing.assert_array_equal(scores[0], scores[1])
+
+
+def test_parallel_fit_sklearn_forest(embeddings):
+    (train_data, _, _), (test_data, _, _), _ = embeddings
+    (flat, _), = fit_forests_parallel([train_data], n_jobs=2, n_estimators=60, max_samples=128)
+    (forest, train_score), = fit_forests_parallel([train_data], n_jobs=2, n_estimators=60, max_samples=128,
+                                                  flat_scorer=False)
+    assert isinstance(forest, IsolationForest) and len(forest.estimators_) == 60
+    np.testing.assert_allclose(forest.decision_function(test_data), flat.decision_function(test_data))
+    assert abs((train_score < 0).mean() - 0.01) < 0.005
+
+
+def test_sharded_fit_matches_parallel_fit(embeddings, tmp_path):
+    (train_data, _, _), (test_data, _, _), _ = embeddings
+    for flat_scorer in (True, False):
+        (parallel, _), = fit_forests_parallel([train_data], n_jobs=2, n_estimators=60, max_samples=128,
+                                              flat_scorer=flat_scorer)
+        (sharded, _), = fit_forests_sharded([train_data], n_workers=2, n_estimators=60, max_samples=128,
+                                            shard_dir=str(tmp_path / str(flat_scorer)), flat_scorer=flat_scorer)
+        assert type(sharded) is type(parallel)
+        np.testing.assert_array_equal(sharded.decision_function(test_data), parallel.decision_function(test_data))